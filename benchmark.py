@@ -0,0 +1,778 @@
+"""Benchmarks of the ETL building blocks and of the map queries.
+
+Usage:
+    python benchmark.py --action parsers \\
+        --file PrixCarburants_instantane_ruptures.xml
+    python benchmark.py --action workers \\
+        --file PrixCarburants_instantane_ruptures.xml
+    python benchmark.py --action etl --sizes 1000 10000 100000
+    python benchmark.py --action concurrency --sizes 20000 \\
+        --profiles legacy dev prod
+    python benchmark.py --action viewports --sizes 10000 100000 1000000
+    python benchmark.py --action markers --sizes 100 300 1000
+"""
+
+import argparse
+import functools
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import folium
+import numpy as np
+import sqlalchemy as sa
+
+from fetch import open_feed
+from history import open_archive
+from markers import MARKER_MODES
+from models import Base, Station
+from parsers import PARSER_BACKENDS, iter_stations
+from pipeline import FEED_FOOTER, run_pipeline, split_feed
+from spatial import CatalogPrices, StationCatalog
+from storage import create_reader_engine, create_writer_engine
+from synthetic import LATITUDES, LONGITUDES, feed_state, write_runs
+from tiles import station_features
+
+RESULTS_DIR = "benchmarks"
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of the current process, in MB.
+
+    Returns:
+        float
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    if sys.platform == "darwin":
+        return max_rss / 1024 / 1024
+    return max_rss / 1024
+
+
+def _count_tree(xmlfile):
+    # former approach, the whole tree is kept in memory
+    root = ET.parse(xmlfile).getroot()
+    total = len(root.findall("pdv"))
+    prices = sum(len(pdv.findall("prix")) for pdv in root.iter("pdv"))
+    return total, prices
+
+
+def _run_parser(backend, xmlfile):
+    start = time.perf_counter()
+    if backend == "tree":
+        stations, prices = _count_tree(xmlfile)
+    else:
+        stations, prices = 0, 0
+        for record in iter_stations(xmlfile, backend=backend):
+            stations += 1
+            prices += len(record.prices)
+    elapsed = time.perf_counter() - start
+    return {
+        "backend": backend,
+        "stations": stations,
+        "prices": prices,
+        "seconds": round(elapsed, 3),
+        "stations_per_second": round(stations / elapsed),
+        "mb_per_second": round(
+            os.path.getsize(xmlfile) / 1024 / 1024 / elapsed, 2
+        ),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def bench_parsers(xmlfile, backends=None):
+    """
+    Compare throughput and peak RSS of the parser backends.
+
+    Each backend runs in a fresh process, so that the peak RSS of one run
+    is not polluted by the previous ones. The ``tree`` entry is the former
+    ``ET.parse`` approach, kept as a baseline.
+
+    Args:
+        xmlfile (str): path of the XML feed
+        backends (list): backends to compare, default to all of them
+
+    Returns:
+        list of dict: one result per backend
+    """
+    if backends is None:
+        backends = ["tree", *PARSER_BACKENDS]
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for backend in backends:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            try:
+                result = pool.apply(_run_parser, (backend, xmlfile))
+            except ImportError as e:
+                print(f"Skipping {backend}: {e}")
+                continue
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def sample_feed(xmlfile, stations=None):
+    """
+    Read the first stations of the feed as a standalone document.
+
+    Args:
+        xmlfile (str): path of the XML feed
+        stations (int): number of stations to keep, default to all of them
+
+    Returns:
+        bytes
+    """
+    with open(xmlfile, "rb") as feed:
+        if not stations:
+            return feed.read()
+        return next(split_feed(feed, stations), FEED_FOOTER)
+
+
+def bench_workers(xmlfile, workers=(0, 2, 4), sizes=(1000, 5000, None)):
+    """
+    Compare the ETL pipeline with serial and parallel parsing.
+
+    Each run loads the feed into a new SQLite database, the speedup is
+    relative to the run without worker processes on the same feed.
+
+    Args:
+        xmlfile (str): path of the XML feed
+        workers (list): numbers of parsing processes to compare
+        sizes (list): numbers of stations of the feeds, None for the whole
+            feed
+
+    Returns:
+        list of dict: one result per feed size and number of workers
+    """
+    results = []
+    for size in sizes:
+        payload = sample_feed(xmlfile, size)
+        baseline = None
+        for count in workers:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                engine = sa.create_engine(f"sqlite:///{tmpdir}/bench.sqlite3")
+                Base.metadata.create_all(engine)
+                start = time.perf_counter()
+                stats = run_pipeline(io.BytesIO(payload), engine, workers=count)
+                elapsed = time.perf_counter() - start
+                engine.dispose()
+            baseline = baseline or elapsed
+            result = {
+                "stations": stats["stages"]["parse"]["items"],
+                "workers": count,
+                "seconds": round(elapsed, 3),
+                "stations_per_second": round(
+                    stats["stages"]["parse"]["items"] / elapsed
+                ),
+                "speedup": round(baseline / elapsed, 2),
+            }
+            results.append(result)
+            print(json.dumps(result))
+    return results
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory):
+    """
+    Serve the files of a directory over HTTP, in a background thread.
+
+    Args:
+        directory (str): directory to serve
+
+    Returns:
+        http.server.ThreadingHTTPServer: call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0),
+        functools.partial(_QuietHandler, directory=str(directory)),
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def database_size(path):
+    """
+    Size of a SQLite database with its write-ahead log, in bytes.
+
+    Args:
+        path (str): path of the database
+
+    Returns:
+        int
+    """
+    return sum(
+        os.path.getsize(f"{path}{suffix}")
+        for suffix in ("", "-wal")
+        if os.path.exists(f"{path}{suffix}")
+    )
+
+
+def _run_etl(url, database, workers):
+    # same steps as main_etl: streamed download, then the ETL pipeline
+    engine = sa.create_engine(f"sqlite:///{database}")
+    Base.metadata.create_all(engine)
+    size_before = database_size(database)
+    start = time.perf_counter()
+    with open_feed(url) as response:
+        stats = run_pipeline(response.stream, engine, workers=workers)
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    read = {
+        table: sum(stats[table].values()) for table in ("stations", "prices")
+    }
+    written = {
+        table: stats[table]["inserted"] + stats[table]["updated"]
+        for table in ("stations", "prices")
+    }
+    return {
+        "seconds": round(elapsed, 3),
+        "rows_read": sum(read.values()),
+        "rows_written": sum(written.values()),
+        "rows_per_second": round(sum(read.values()) / elapsed),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "database_growth_mb": round(
+            (database_size(database) - size_before) / 1024 / 1024, 2
+        ),
+        "stages": stats["stages"],
+    }
+
+
+def bench_etl(sizes=(1000, 10000, 100000), changes=0.1, workers=0, output=None):
+    """
+    Measure the ETL on synthetic feeds, on a fresh and on a warm database.
+
+    For each size, the first feed is loaded into an empty database, then
+    the feed of the next run, where a share `changes` of the prices moved,
+    is loaded into the same database. Feeds are served over HTTP from a
+    local server, and each load runs in a fresh process so that its peak
+    RSS is its own.
+
+    Args:
+        sizes (list): numbers of stations of the feeds
+        changes (float): share of the prices changed between the two feeds
+        workers (int): number of parsing processes of the pipeline
+        output (str): path of the JSON report, default to a timestamped
+            file in the benchmarks directory
+
+    Returns:
+        dict: environment of the run and one result per size and database
+    """
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "changes": changes,
+        "workers": workers,
+        "results": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        server = serve_directory(tmpdir)
+        base_url = f"http://127.0.0.1:{server.server_address[1]}"
+        try:
+            for size in sizes:
+                feeds = write_runs(tmpdir, size, runs=2, changes=changes)
+                database = Path(tmpdir) / f"bench-{size}.sqlite3"
+                for scenario, feed in zip(("fresh", "warm"), feeds):
+                    with context.Pool(1, maxtasksperchild=1) as pool:
+                        result = pool.apply(
+                            _run_etl,
+                            (f"{base_url}/{feed.name}", database, workers),
+                        )
+                    result = {
+                        "stations": size,
+                        "database": scenario,
+                        "feed_mb": round(feed.stat().st_size / 1024 / 1024, 2),
+                        **result,
+                    }
+                    report["results"].append(result)
+                    print(
+                        json.dumps(
+                            {k: v for k, v in result.items() if k != "stages"}
+                        )
+                    )
+        finally:
+            server.shutdown()
+    if output is None:
+        Path(RESULTS_DIR).mkdir(exist_ok=True)
+        output = (
+            Path(RESULTS_DIR)
+            / f"etl-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        )
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output}")
+    return report
+
+
+# query of the stations page: the prices of the stations in a viewport
+VIEWPORT_QUERY = sa.text(
+    "SELECT stations.id, prices.gastype_id, prices.price "
+    "FROM stations JOIN prices ON prices.station_id = stations.id "
+    "WHERE stations.latitude BETWEEN :lat_min AND :lat_max "
+    "AND stations.longitude BETWEEN :lon_min AND :lon_max"
+)
+# "legacy" is the default engine used before the storage profiles
+LEGACY_PROFILE = "legacy"
+
+
+def _storage_engines(database, profile):
+    if profile == LEGACY_PROFILE:
+        engine = sa.create_engine(f"sqlite:///{database}")
+        return engine, engine
+    return (
+        create_writer_engine(database, profile),
+        create_reader_engine(database, profile),
+    )
+
+
+def _run_writer(feed, database, profile):
+    # full refresh of the database, every row is written again
+    writer, _ = _storage_engines(database, profile)
+    start = time.perf_counter()
+    try:
+        with open_archive(feed) as source:
+            stats = run_pipeline(source, writer, incremental=False)
+    except sa.exc.OperationalError as e:
+        # readers holding their shared locks starve the commits
+        return {
+            "seconds": round(time.perf_counter() - start, 3),
+            "lock_seconds": None,
+            "error": str(e.orig),
+        }
+    finally:
+        writer.dispose()
+    return {
+        "seconds": round(time.perf_counter() - start, 3),
+        "lock_seconds": round(stats["lock_seconds"], 3),
+        "error": None,
+    }
+
+
+def _read_viewports(engine, stop, seed, results):
+    rng = random.Random(seed)
+    span = (LATITUDES[1] - LATITUDES[0]) // 20
+    while not stop.is_set():
+        lat_min = rng.randrange(LATITUDES[0], LATITUDES[1] - span)
+        lon_min = rng.randrange(LONGITUDES[0], LONGITUDES[1] - span)
+        start = time.perf_counter()
+        try:
+            with engine.connect() as conn:
+                conn.execute(
+                    VIEWPORT_QUERY,
+                    {
+                        "lat_min": lat_min,
+                        "lat_max": lat_min + span,
+                        "lon_min": lon_min,
+                        "lon_max": lon_min + span,
+                    },
+                ).fetchall()
+        except sa.exc.OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            results["locked"] += 1
+        else:
+            results["latencies"].append(time.perf_counter() - start)
+
+
+def bench_concurrency(size=20000, readers=4, profiles=None, output=None):
+    """
+    Measure the page queries while the ETL rewrites the database.
+
+    For each storage profile, a database is loaded with a synthetic feed,
+    then the feed of the next run is written again in full by the ETL in
+    another process while reader threads query the prices of random
+    viewports. The "legacy" profile is the engine without pragmas used
+    before the storage profiles.
+
+    Args:
+        size (int): number of stations of the feeds
+        readers (int): number of reader threads
+        profiles (list): storage profiles to compare, see storage.PROFILES,
+            default to legacy, dev and prod
+        output (str): path of the JSON report, default to a timestamped
+            file in the benchmarks directory
+
+    Returns:
+        dict: environment of the run and one result per profile
+    """
+    # bulk-load has no shared journal, it is meant for a database nothing
+    # reads while it is loaded
+    profiles = profiles or [LEGACY_PROFILE, "dev", "prod"]
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "stations": size,
+        "readers": readers,
+        "results": [],
+    }
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        feeds = write_runs(tmpdir, size, runs=2)
+        for profile in profiles:
+            database = Path(tmpdir) / f"concurrency-{profile}.sqlite3"
+            writer, reader = _storage_engines(database, profile)
+            Base.metadata.create_all(writer)
+            with open_archive(feeds[0]) as source:
+                run_pipeline(source, writer)
+            stop = threading.Event()
+            results = {"locked": 0, "latencies": []}
+            threads = [
+                threading.Thread(
+                    target=_read_viewports, args=(reader, stop, seed, results)
+                )
+                for seed in range(readers)
+            ]
+            with context.Pool(1) as pool:
+                job = pool.apply_async(
+                    _run_writer, (feeds[1], database, profile)
+                )
+                for thread in threads:
+                    thread.start()
+                etl = job.get()
+                stop.set()
+                for thread in threads:
+                    thread.join()
+            writer.dispose()
+            reader.dispose()
+            latencies = sorted(results["latencies"])
+            result = {
+                "profile": profile,
+                "etl_seconds": etl["seconds"],
+                "etl_lock_seconds": etl["lock_seconds"],
+                "etl_error": etl["error"],
+                "queries": len(latencies),
+                "locked_errors": results["locked"],
+                "p50_ms": round(latencies[len(latencies) // 2] * 1000, 2)
+                if latencies
+                else None,
+                "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 2)
+                if latencies
+                else None,
+                "max_ms": round(latencies[-1] * 1000, 2) if latencies else None,
+            }
+            report["results"].append(result)
+            print(json.dumps(result))
+    if output is None:
+        Path(RESULTS_DIR).mkdir(exist_ok=True)
+        output = (
+            Path(RESULTS_DIR)
+            / f"concurrency-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        )
+    with open(output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results saved to {output}")
+    return report
+
+
+# width of the map of the pages, in pixels, and its height / width ratio
+MAP_WIDTH = 725
+MAP_RATIO = 0.5
+
+
+def viewport_span(zoom):
+    """
+    Size of the map viewport at a zoom level, in degrees * 100000.
+
+    Args:
+        zoom (int): zoom level of the map, as in Leaflet
+
+    Returns:
+        tuple: latitude and longitude spans
+    """
+    longitude = 360 * MAP_WIDTH / (256 * 2**zoom) * 100000
+    return longitude * MAP_RATIO, longitude
+
+
+def synthetic_database(database, size):
+    """
+    Fill a database with the synthetic stations, without their prices.
+
+    Args:
+        database (str): path of the database
+        size (int): number of stations
+
+    Returns:
+        sqlalchemy engine
+    """
+    engine = create_writer_engine(database, "bulk-load")
+    Base.metadata.create_all(engine)
+    state = feed_state(size)
+    rows = [
+        {
+            "id": int(station_id),
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+            "address": "ADDRESS",
+            "town": "TOWN",
+            "zip_code": "00000",
+        }
+        for station_id, latitude, longitude in zip(
+            state["id"], state["latitude"], state["longitude"]
+        )
+    ]
+    with engine.begin() as conn:
+        for start in range(0, size, 10000):
+            conn.execute(
+                sa.insert(Station.__table__), rows[start : start + 10000]
+            )
+    engine.dispose()
+    return create_reader_engine(database)
+
+
+def _band_viewport(conn, lat_min, lat_max, lon_min, lon_max):
+    # viewport query of the pages before the catalog, SQLite searches the
+    # latitude band in the (latitude, longitude) index and checks the
+    # longitude of every station of the band
+    stations = Station.__table__
+    return conn.execute(
+        sa.select(stations).where(
+            stations.c.latitude > lat_min,
+            stations.c.latitude < lat_max,
+            stations.c.longitude > lon_min,
+            stations.c.longitude < lon_max,
+        )
+    ).all()
+
+
+def bench_viewports(
+    sizes=(10000, 100000, 1000000), zooms=(10, 12, 14, 16), queries=50
+):
+    """
+    Compare the latency of the viewport queries: SQL on the latitude index,
+    and lookups in the in-memory catalog of the stations.
+
+    Args:
+        sizes (list): numbers of synthetic stations
+        zooms (list): zoom levels of the viewports, the pages show the
+            stations above zoom 12
+        queries (int): random viewports per size and zoom level
+
+    Returns:
+        list of dict: latencies of each size, zoom level and query
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            engine = synthetic_database(Path(tmpdir) / f"{size}.sqlite3", size)
+            start = time.perf_counter()
+            with engine.connect() as conn:
+                catalog = StationCatalog.from_database(conn)
+            print(
+                json.dumps(
+                    {
+                        "stations": size,
+                        "catalog_build_seconds": round(
+                            time.perf_counter() - start, 3
+                        ),
+                    }
+                )
+            )
+            methods = {
+                "latitude_index": _band_viewport,
+                "catalog": lambda conn, *viewport, catalog=catalog: (
+                    catalog.rows(catalog.in_viewport(*viewport))
+                ),
+            }
+            for zoom in zooms:
+                lat_span, lon_span = viewport_span(zoom)
+                rng = random.Random(zoom)
+                viewports = [
+                    (lat_min, lat_min + lat_span, lon_min, lon_min + lon_span)
+                    for lat_min, lon_min in (
+                        (
+                            rng.uniform(LATITUDES[0], LATITUDES[1] - lat_span),
+                            rng.uniform(
+                                LONGITUDES[0], LONGITUDES[1] - lon_span
+                            ),
+                        )
+                        for _ in range(queries)
+                    )
+                ]
+                for name, method in methods.items():
+                    latencies = []
+                    rows = 0
+                    with engine.connect() as conn:
+                        for viewport in viewports:
+                            start = time.perf_counter()
+                            rows += len(method(conn, *viewport))
+                            latencies.append(time.perf_counter() - start)
+                    latencies.sort()
+                    result = {
+                        "stations": size,
+                        "zoom": zoom,
+                        "query": name,
+                        "mean_rows": round(rows / queries, 1),
+                        "p50_ms": round(latencies[queries // 2] * 1000, 3),
+                        "p95_ms": round(
+                            latencies[int(queries * 0.95)] * 1000, 3
+                        ),
+                    }
+                    results.append(result)
+                    print(json.dumps(result))
+            engine.dispose()
+    return results
+
+
+def synthetic_features(size, seed=0):
+    """
+    GeoJSON features of synthetic stations of a city, as in the tile cache.
+
+    Args:
+        size (int): number of stations
+        seed (int): seed of the random coordinates and prices
+
+    Returns:
+        list of dict
+    """
+    rng = np.random.default_rng(seed)
+    catalog = StationCatalog(
+        np.arange(1000000, 1000000 + size),
+        np.round(rng.uniform(4600000, 4610000, size)),
+        np.round(rng.uniform(500000, 515000, size)),
+        ["12 AVENUE DU GENERAL DE GAULLE"] * size,
+        ["BOURG-EN-BRESSE"] * size,
+        ["01000"] * size,
+    )
+    prices = CatalogPrices(
+        catalog,
+        np.repeat(catalog.ids, 3),
+        np.tile([1, 2, 5], size),
+        np.round(rng.uniform(1.5, 2.0, 3 * size), 3),
+        np.full(3 * size, np.datetime64("2024-01-02T07:53:00", "s")),
+    )
+    return station_features(prices, np.arange(size))
+
+
+def bench_markers(sizes=(100, 300, 1000), rounds=5):
+    """
+    Compare the payload and the render time of the marker modes of the maps.
+
+    The payload is the size of the HTML of the map of the stations, less the
+    one of an empty map. The render time is the time to build the layer and
+    to render the HTML, in Python, before it is sent to the browser.
+
+    Args:
+        sizes (list): numbers of stations in the viewport
+        rounds (int): renders per size and mode, the fastest is kept
+
+    Returns:
+        list of dict: payload and render time of each size and mode
+    """
+    results = []
+    empty = len(folium.Map(prefer_canvas=True).get_root().render())
+    for size in sizes:
+        features = synthetic_features(size)
+        followed = [features[0]["properties"]["id"]]
+        for mode, layer in MARKER_MODES.items():
+            timings = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                m = folium.Map(prefer_canvas=True)
+                fg = folium.FeatureGroup(name="Stations markers")
+                fg.add_child(layer(features, followed))
+                fg.add_to(m)
+                html = m.get_root().render()
+                timings.append(time.perf_counter() - start)
+            result = {
+                "stations": size,
+                "mode": mode,
+                "payload_kb": round((len(html) - empty) / 1024, 1),
+                "bytes_per_station": round((len(html) - empty) / size),
+                "render_ms": round(min(timings) * 1000, 1),
+            }
+            results.append(result)
+            print(json.dumps(result))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--action")
+    parser.add_argument("--file", help="path of the XML feed")
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        help="parser backends to compare, default to all",
+    )
+    parser.add_argument(
+        "--workers",
+        nargs="+",
+        type=int,
+        help="numbers of parsing processes to compare, or number of parsing "
+        "processes of the etl benchmark",
+    )
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=int,
+        help="numbers of stations of the feeds, 0 for the whole file",
+    )
+    parser.add_argument(
+        "--changes",
+        type=float,
+        default=0.1,
+        help="share of the prices changed between two synthetic feeds",
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        help="storage profiles to compare, default to legacy, dev and prod",
+    )
+    parser.add_argument(
+        "--readers",
+        type=int,
+        default=4,
+        help="number of reader threads of the concurrency benchmark",
+    )
+    parser.add_argument("--output", help="path of the JSON report")
+    args = parser.parse_args()
+    if args.action == "parsers":
+        bench_parsers(args.file, args.backends)
+    elif args.action == "workers":
+        bench_workers(
+            args.file, args.workers or [0, 2, 4], args.sizes or [1000, 5000, 0]
+        )
+    elif args.action == "etl":
+        bench_etl(
+            args.sizes or [1000, 10000, 100000],
+            changes=args.changes,
+            workers=args.workers[0] if args.workers else 0,
+            output=args.output,
+        )
+    elif args.action == "viewports":
+        bench_viewports(args.sizes or [10000, 100000, 1000000])
+    elif args.action == "markers":
+        bench_markers(args.sizes or [100, 300, 1000])
+    elif args.action == "concurrency":
+        bench_concurrency(
+            args.sizes[0] if args.sizes else 20000,
+            readers=args.readers,
+            profiles=args.profiles,
+            output=args.output,
+        )
+    else:
+        print(
+            f"Error : Bad action specified, {args.action} unknown. Exiting..."
+        )
+        exit(1)
@@ -0,0 +1,178 @@
+"""Clusters of stations for the maps at low zoom levels.
+
+Below the zoom at which the maps show the stations, they show clusters: the
+stations grouped by the cells of a grid whose cells halve at each zoom level,
+about CLUSTER_PIXELS wide on the screen, with their count and the lowest
+price of each gas type. The levels of this pyramid are built once per
+generation of the catalog, by vectorized group-bys, so that a viewport at
+any zoom is served a bounded number of markers, whatever the number of
+stations it covers.
+
+Coordinates are stored as in the feed, in degrees * 100000.
+"""
+
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+# zoom levels of the pyramid, the maps show the stations above
+MIN_ZOOM = 5
+MAX_ZOOM = 12
+TILE_PIXELS = 256
+CLUSTER_PIXELS = 80
+
+
+class Cluster(NamedTuple):
+    """Stations of a cell of a level of the pyramid."""
+
+    latitude: float
+    longitude: float
+    count: int
+    min_prices: dict
+
+
+def cell_size(zoom):
+    """
+    Side of the cells of a level, in degrees * 100000.
+
+    Args:
+        zoom (int): zoom level of the map
+
+    Returns:
+        float
+    """
+    return 360 / (TILE_PIXELS * 2**zoom) * CLUSTER_PIXELS * 100000
+
+
+class ClusterLevel:
+    """
+    Stations grouped by the cells of a zoom level.
+
+    Args:
+        zoom (int): zoom level of the map
+        latitudes (array): latitudes of the stations, in degrees * 100000
+        longitudes (array): longitudes of the stations
+        prices (array): prices of the stations, one column per gas type,
+            NaN when missing
+    """
+
+    def __init__(self, zoom, latitudes, longitudes, prices):
+        self.zoom = zoom
+        self.size = cell_size(zoom)
+        rows = np.floor(latitudes / self.size).astype("int64")
+        columns = np.floor(longitudes / self.size).astype("int64")
+        if len(rows):
+            keys = (rows - rows.min()) * (columns.max() - columns.min() + 1) + (
+                columns - columns.min()
+            )
+        else:
+            keys = rows
+        order = np.argsort(keys, kind="stable")
+        _, starts, counts = np.unique(
+            keys[order], return_index=True, return_counts=True
+        )
+        self.rows = rows[order][starts]
+        self.columns = columns[order][starts]
+        self.counts = counts
+        # markers at the center of mass of the stations of the cell
+        self.latitudes = np.add.reduceat(latitudes[order], starts) / counts
+        self.longitudes = np.add.reduceat(longitudes[order], starts) / counts
+        self.min_prices = (
+            np.fmin.reduceat(prices[order], starts, axis=0)
+            if len(starts)
+            else prices[:0]
+        )
+
+    def __len__(self):
+        return len(self.counts)
+
+    def in_viewport(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Clusters of the cells crossed by a viewport.
+
+        Args:
+            lat_min (float): south bound, in degrees * 100000
+            lat_max (float): north bound
+            lon_min (float): west bound
+            lon_max (float): east bound
+
+        Returns:
+            numpy.ndarray: indexes of the clusters
+        """
+        return np.flatnonzero(
+            (self.rows >= np.floor(lat_min / self.size))
+            & (self.rows <= np.floor(lat_max / self.size))
+            & (self.columns >= np.floor(lon_min / self.size))
+            & (self.columns <= np.floor(lon_max / self.size))
+        )
+
+
+class ClusterPyramid:
+    """
+    Clusters of the stations at each zoom level.
+
+    Args:
+        prices (spatial.CatalogPrices): stations and their prices
+        zooms (iterable): zoom levels
+    """
+
+    def __init__(self, prices, zooms=range(MIN_ZOOM, MAX_ZOOM + 1)):
+        catalog = prices.catalog
+        self.gastypes = prices.gastypes
+        self.levels = {
+            zoom: ClusterLevel(
+                zoom, catalog.latitudes, catalog.longitudes, prices.prices
+            )
+            for zoom in zooms
+        }
+
+    def level(self, zoom):
+        """
+        Level of the pyramid of a zoom, the nearest one out of its range.
+
+        Args:
+            zoom (int): zoom level of the map
+
+        Returns:
+            ClusterLevel
+        """
+        zoom = min(max(int(zoom), min(self.levels)), max(self.levels))
+        return self.levels[zoom]
+
+    def clusters(self, zoom, lat_min, lat_max, lon_min, lon_max):
+        """
+        Clusters of a viewport.
+
+        Args:
+            zoom (int): zoom level of the map
+            lat_min (float): south bound, in degrees * 100000
+            lat_max (float): north bound
+            lon_min (float): west bound
+            lon_max (float): east bound
+
+        Returns:
+            list of Cluster: with the lowest price by gas type id, as in
+                the feed
+        """
+        level = self.level(zoom)
+        indexes = level.in_viewport(lat_min, lat_max, lon_min, lon_max)
+        gastypes = self.gastypes.tolist()
+        return [
+            Cluster(
+                latitude,
+                longitude,
+                count,
+                {
+                    gastype: price
+                    for gastype, price in zip(gastypes, prices)
+                    if not math.isnan(price)
+                },
+            )
+            for latitude, longitude, count, prices in zip(
+                (level.latitudes[indexes] / 100000).tolist(),
+                (level.longitudes[indexes] / 100000).tolist(),
+                level.counts[indexes].tolist(),
+                level.min_prices[indexes].tolist(),
+            )
+        ]
@@ -0,0 +1,199 @@
+"""Local corpus of recorded feed archives, to replay the ETL offline.
+
+Each archive downloaded by ``utils.py --action record`` is stored once under
+the SHA-256 of its content, ``<corpus>/<sha256>.zip``, and every download is
+listed in ``<corpus>/index.json`` with its date and HTTP validators. The
+archives are kept zipped, as published.
+
+``utils.py --action replay`` then loads a sequence of recorded archives into
+a database, one after another, and reports the timings and counters of each
+load, without network access.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import sqlalchemy as sa
+
+from fetch import CHUNK_SIZE, FEED_URL, ResumableDownload
+from history import open_archive
+from models import Base
+from parsers import DEFAULT_PARSER
+from pipeline import DEFAULT_WORKERS, run_pipeline
+
+CORPUS_DIR = "corpus"
+INDEX_NAME = "index.json"
+
+
+class Corpus:
+    """
+    Content-addressed store of feed archives.
+
+    Args:
+        root (str): directory of the corpus
+    """
+
+    def __init__(self, root=CORPUS_DIR):
+        self.root = Path(root)
+        self.index_path = self.root / INDEX_NAME
+
+    def entries(self):
+        """
+        Recorded downloads, oldest first.
+
+        Returns:
+            list of dict: sha256, url, recorded_at, size, etag and
+                last_modified of each download
+        """
+        if not self.index_path.exists():
+            return []
+        with open(self.index_path) as file:
+            return json.load(file)
+
+    def path(self, sha256):
+        """
+        Path of a recorded archive.
+
+        Args:
+            sha256 (str): hash of the archive, or a unique prefix of it
+
+        Returns:
+            pathlib.Path
+        """
+        matches = sorted(self.root.glob(f"{sha256}*.zip"))
+        if len(matches) != 1:
+            raise KeyError(
+                f"{len(matches)} archives of the corpus match {sha256}"
+            )
+        return matches[0]
+
+    def record(self, url=FEED_URL, **kwargs):
+        """
+        Download an archive into the corpus.
+
+        The archive is streamed to a temporary file while it is hashed, and
+        kept only if no archive with the same content was recorded before.
+
+        Args:
+            url (str): url of the archive
+            kwargs: options of fetch.ResumableDownload
+
+        Returns:
+            dict: entry of the download in the index
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with (
+            ResumableDownload(url, **kwargs) as download,
+            tempfile.NamedTemporaryFile(
+                dir=self.root, suffix=".part", delete=False
+            ) as tmp_file,
+        ):
+            try:
+                download.connect()
+                for chunk in iter(lambda: download.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+        sha256 = digest.hexdigest()
+        path = self.root / f"{sha256}.zip"
+        if path.exists():
+            os.unlink(tmp_file.name)
+        else:
+            os.replace(tmp_file.name, path)
+        entry = {
+            "sha256": sha256,
+            "url": url,
+            "recorded_at": datetime.now().isoformat(timespec="seconds"),
+            "size": size,
+            "etag": download.etag,
+            "last_modified": download.last_modified,
+        }
+        self._write_index([*self.entries(), entry])
+        return entry
+
+    def _write_index(self, entries):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as file:
+            json.dump(entries, file, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def sequence(self, archives=None):
+        """
+        Archives to replay, in order.
+
+        Args:
+            archives (list): hashes or unique prefixes, default to every
+                distinct archive in the order they were first recorded
+
+        Returns:
+            list of str: full hashes
+        """
+        if archives:
+            return [self.path(sha256).stem for sha256 in archives]
+        return list(dict.fromkeys(entry["sha256"] for entry in self.entries()))
+
+
+def replay(
+    corpus,
+    engine,
+    archives=None,
+    parser=DEFAULT_PARSER,
+    workers=DEFAULT_WORKERS,
+    incremental=True,
+):
+    """
+    Load recorded archives into a database, one after another.
+
+    Args:
+        corpus (Corpus): corpus of the archives
+        engine: sqlalchemy engine of the database
+        archives (list): hashes of the archives, see Corpus.sequence
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        workers (int): number of parsing processes of the pipeline
+        incremental (bool): write only new prices and changed stations
+
+    Returns:
+        list of dict: timings and counters of each load
+    """
+    Base.metadata.create_all(engine)
+    results = []
+    for sha256 in corpus.sequence(archives):
+        start = time.perf_counter()
+        with open_archive(corpus.path(sha256)) as source:
+            stats = run_pipeline(
+                source,
+                engine,
+                parser=parser,
+                workers=workers,
+                incremental=incremental,
+            )
+        elapsed = time.perf_counter() - start
+        results.append({"sha256": sha256, "seconds": elapsed, **stats})
+    return results
+
+
+def replay_database(path=None):
+    """
+    Engine of the database of a replay.
+
+    Args:
+        path (str): path of the database, default to a new temporary one so
+            that the first archive is loaded into an empty database
+
+    Returns:
+        sqlalchemy engine
+    """
+    if path is None:
+        path = Path(tempfile.mkdtemp()) / "replay.sqlite3"
+    return sa.create_engine(f"sqlite:///{path}")
@@ -0,0 +1,371 @@
+"""Streaming download and decompression of the fuel feed archive.
+
+The archive is read as a chunked HTTP stream, resumed with range requests
+when the connection drops, and its XML member is inflated on the fly, so
+that the parser consumes the feed without it ever touching the disk.
+
+Requests are conditional on the validators of the last successful fetch, so
+that an unchanged feed is neither downloaded nor parsed again.
+"""
+
+import io
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from typing import NamedTuple
+
+import requests
+from requests.exceptions import (
+    ChunkedEncodingError,
+    ConnectionError,
+    RequestException,
+    Timeout,
+)
+
+FEED_URL = "https://donnees.roulez-eco.fr/opendata/instantane_ruptures"
+CONNECT_TIMEOUT = 10  # seconds
+READ_TIMEOUT = 60  # seconds, between two chunks
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 2
+CHUNK_SIZE = 64 * 1024
+
+RETRYABLE_ERRORS = (ConnectionError, ChunkedEncodingError, Timeout)
+
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR = struct.Struct("<III")
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+FLAG_DATA_DESCRIPTOR = 0x08
+METHOD_STORED = 0
+METHOD_DEFLATED = 8
+
+
+class ResumableDownload(io.RawIOBase):
+    """
+    Read-only file object over a chunked HTTP download.
+
+    When the connection drops, the download is resumed where it stopped with
+    a range request. If the server ignores the range, the bytes already read
+    are skipped from the new response, provided the file did not change.
+
+    Args:
+        url (str): url to download
+        timeout (tuple): connect and read timeouts, in seconds
+        retries (int): number of attempts after a network error
+        headers (dict): extra headers of the first request, such as
+            conditional ones
+        verify (bool): check the TLS certificate of the server
+    """
+
+    def __init__(
+        self,
+        url,
+        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+        retries=MAX_RETRIES,
+        headers=None,
+        verify=False,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.headers = dict(headers or {})
+        self.verify = verify
+        self.received = 0
+        self.response = None
+        self.etag = None
+        self.last_modified = None
+        self._chunks = None
+        self._skip = 0
+        self._pending = b""
+
+    @property
+    def not_modified(self):
+        """The server answered the conditional request with a 304."""
+        return self.response is not None and self.response.status_code == 304
+
+    def open(self):
+        """
+        Send the request, from the first byte not received yet.
+
+        Returns:
+            requests.Response
+        """
+        if self.received:
+            headers = {"Range": f"bytes={self.received}-"}
+            if self.etag or self.last_modified:
+                headers["If-Range"] = self.etag or self.last_modified
+        else:
+            headers = self.headers
+        response = requests.get(
+            self.url,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+            verify=self.verify,
+        )
+        response.raise_for_status()
+        self.response = response
+        self._chunks = response.iter_content(CHUNK_SIZE)
+        validators = (
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+        )
+        if not self.received:
+            self.etag, self.last_modified = validators
+        elif response.status_code != 206:
+            if validators != (self.etag, self.last_modified):
+                raise RequestException("Feed changed during the download")
+            # range not supported, skip what was already read
+            self._skip = self.received
+        return response
+
+    def connect(self):
+        """
+        Send the first request, retrying on network errors.
+
+        Returns:
+            requests.Response
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.open()
+            except RETRYABLE_ERRORS as e:
+                self._retry(attempt, e)
+
+    def _retry(self, attempt, error):
+        self._release()
+        if attempt == self.retries:
+            raise error
+        print(
+            f"Download interrupted after {self.received} bytes "
+            f"({error}), retrying"
+        )
+        time.sleep(BACKOFF_SECONDS * 2**attempt)
+
+    def _next_chunk(self):
+        for attempt in range(self.retries + 1):
+            try:
+                if self._chunks is None:
+                    self.open()
+                for chunk in self._chunks:
+                    if self._skip >= len(chunk):
+                        self._skip -= len(chunk)
+                        continue
+                    chunk = chunk[self._skip :]
+                    self._skip = 0
+                    self.received += len(chunk)
+                    return chunk
+                return None
+            except RETRYABLE_ERRORS as e:
+                self._retry(attempt, e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = self._next_chunk()
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def _release(self):
+        if self.response is not None:
+            self.response.close()
+        self.response = None
+        self._chunks = None
+
+    def close(self):
+        self._release()
+        super().close()
+
+
+class ZipMemberReader(io.RawIOBase):
+    """
+    Read-only file object inflating the first member of a zip stream.
+
+    Only the local file header preceding the member is used, so the archive
+    can be read as it is downloaded, without seeking to its central
+    directory.
+
+    Args:
+        raw: binary file object positioned at the start of the archive
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        header = self._read_exactly(LOCAL_HEADER.size)
+        (
+            signature,
+            _,
+            self.flags,
+            self.method,
+            _,
+            _,
+            self.crc,
+            self.compressed_size,
+            self.file_size,
+            name_length,
+            extra_length,
+        ) = LOCAL_HEADER.unpack(header)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            raise ValueError("Not a zip archive")
+        if self.method not in (METHOD_STORED, METHOD_DEFLATED):
+            raise ValueError(f"Unsupported zip compression {self.method}")
+        if self.method == METHOD_STORED and self.has_data_descriptor:
+            raise ValueError("Stored member of unknown size")
+        self.name = self._read_exactly(name_length).decode("utf-8", "replace")
+        # with a data descriptor, the header does not hold the checksum
+        self.content_hash = (
+            None
+            if self.has_data_descriptor
+            else f"{self.crc:08x}-{self.compressed_size}-{self.file_size}"
+        )
+        self._read_exactly(extra_length)
+        self._decompressor = (
+            zlib.decompressobj(-zlib.MAX_WBITS)
+            if self.method == METHOD_DEFLATED
+            else None
+        )
+        self._remaining = self.compressed_size
+        self._pending = b""
+        self._crc = 0
+        self._eof = False
+
+    @property
+    def has_data_descriptor(self):
+        """Sizes and CRC are written after the data instead of the header."""
+        return bool(self.flags & FLAG_DATA_DESCRIPTOR)
+
+    def _read_exactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self.raw.read(size - len(data))
+            if not chunk:
+                raise EOFError("Truncated zip archive")
+            data += chunk
+        return data
+
+    def _read_compressed(self):
+        if self._decompressor is None:
+            data = self.raw.read(min(CHUNK_SIZE, self._remaining))
+            self._remaining -= len(data)
+            if not data and self._remaining:
+                raise EOFError("Truncated zip archive")
+            return data
+        if self._decompressor.eof:
+            return b""
+        data = self.raw.read(CHUNK_SIZE)
+        if not data:
+            raise EOFError("Truncated zip archive")
+        return self._decompressor.decompress(data)
+
+    def _finish(self):
+        crc = self.crc
+        if self.has_data_descriptor:
+            trailer = self._decompressor.unused_data
+            trailer += self.raw.read(
+                max(0, 4 + DATA_DESCRIPTOR.size - len(trailer))
+            )
+            if trailer.startswith(DATA_DESCRIPTOR_SIGNATURE):
+                trailer = trailer[4:]
+            crc, _, _ = DATA_DESCRIPTOR.unpack(trailer[: DATA_DESCRIPTOR.size])
+        if crc != self._crc:
+            raise zlib.error(f"Bad CRC-32 for zip member {self.name}")
+        self._eof = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._eof:
+            data = self._read_compressed()
+            if data:
+                self._crc = zlib.crc32(data, self._crc)
+                self._pending = memoryview(data)
+            elif self._decompressor is None or self._decompressor.eof:
+                self._finish()
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class FeedResponse(NamedTuple):
+    """Outcome of a feed request."""
+
+    # XML stream of the feed, None when it did not change since last fetch
+    stream: io.BufferedReader | None
+    # etag, last_modified and content_hash of the fetched archive
+    validators: dict
+
+
+def conditional_headers(validators):
+    """
+    Build the headers of a conditional request.
+
+    Args:
+        validators (dict): validators of the last successful fetch
+
+    Returns:
+        dict
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+@contextmanager
+def open_feed(url=FEED_URL, validators=None, **kwargs):
+    """
+    Open the XML member of the feed archive as a stream.
+
+    The request is conditional on the validators of the last successful
+    fetch. When the server answers 304, or when the checksum of the member
+    matches the previous one, the download stops and no stream is returned.
+
+    Args:
+        url (str): url of the zip archive
+        validators (dict): etag, last_modified and content_hash of the last
+            successful fetch
+        kwargs: options of ResumableDownload
+
+    Yields:
+        FeedResponse
+    """
+    validators = validators or {}
+    download = ResumableDownload(
+        url, headers=conditional_headers(validators), **kwargs
+    )
+    try:
+        download.connect()
+        if download.not_modified:
+            yield FeedResponse(None, validators)
+            return
+        member = ZipMemberReader(io.BufferedReader(download, CHUNK_SIZE))
+        fetched = {
+            "etag": download.etag,
+            "last_modified": download.last_modified,
+            "content_hash": member.content_hash,
+        }
+        if member.content_hash and member.content_hash == validators.get(
+            "content_hash"
+        ):
+            yield FeedResponse(None, fetched)
+            return
+        with io.BufferedReader(member, CHUNK_SIZE) as feed:
+            yield FeedResponse(feed, fetched)
+    finally:
+        download.close()
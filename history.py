@@ -0,0 +1,474 @@
+"""Backfill of the price history from the yearly and daily archives.
+
+Besides the live feed, the provider publishes every price change of a year
+(``annee/<year>``) or of a day (``jour/<yyyymmdd>``) as a zip archive laid out
+like the live feed, each ``<pdv>`` holding all the ``<prix>`` events of the
+period. Archives are streamed through the ETL pipeline and their price events
+are appended to a history store, kept apart from the database of the
+application. Each ETL run also appends the prices that changed.
+
+The default store writes Parquet files compressed with zstd, partitioned by
+day, so that the history does not bloat the database and a scan only reads
+the partitions of the requested time range.
+"""
+
+import functools
+import io
+import operator
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from fetch import CHUNK_SIZE, LOCAL_HEADER_SIGNATURE, ZipMemberReader, open_feed
+from parsers import DEFAULT_PARSER
+from pipeline import DEFAULT_WORKERS, QUEUE_SIZE, run_stages
+from staging import PRICE_FIELDS
+from storage import create_storage_engine
+
+YEAR_URL = "https://donnees.roulez-eco.fr/opendata/annee/{year}"
+DAY_URL = "https://donnees.roulez-eco.fr/opendata/jour/{day}"
+HISTORY_PATH = "history.sqlite3"
+HISTORY_DIR = "history"
+PARTITION_KEY = "day"
+# events buffered in memory before they are written to the partitions
+FLUSH_ROWS = 1_000_000
+EVENT_KEY = ["station_id", "gastype_id", "updated_at"]
+HISTORY_SCHEMA = pa.schema(
+    [
+        ("station_id", pa.int32()),
+        ("gastype_id", pa.int16()),
+        ("price", pa.float64()),
+        ("updated_at", pa.timestamp("s")),
+    ]
+)
+# a station of a yearly archive holds thousands of price events
+BACKFILL_BATCH_SIZE = 100
+
+metadata = sa.MetaData()
+
+price_history = sa.Table(
+    "price_history",
+    metadata,
+    sa.Column("station_id", sa.Integer, primary_key=True),
+    sa.Column("gastype_id", sa.Integer, primary_key=True),
+    sa.Column("updated_at", sa.DateTime, primary_key=True),
+    sa.Column("price", sa.Float, nullable=False),
+    # rows are stored in the primary key index
+    sqlite_with_rowid=False,
+)
+
+
+class HistoryStore:
+    """
+    Append-only store of price events.
+
+    Subclasses implement write and scan. Events already stored are ignored,
+    at the latest once the store is closed.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, prices):
+        """
+        Append price events.
+
+        Args:
+            prices (pandas.DataFrame): columns of staging.PRICE_FIELDS
+
+        Returns:
+            int: number of events stored
+        """
+        raise NotImplementedError
+
+    def scan(self, start=None, end=None, station_ids=None):
+        """
+        Read the price events of a time range.
+
+        Args:
+            start (datetime): first date included, default to the oldest
+            end (datetime): last date excluded, default to the newest
+            station_ids (list): stations to read, default to all of them
+
+        Returns:
+            pandas.DataFrame: columns of staging.PRICE_FIELDS, sorted by
+                station, fuel and date
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Write pending events and release the resources of the store."""
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    History store in a dedicated SQLite database.
+
+    Events are inserted with the DB-API executemany, bypassing the
+    conversion of rows by SQLAlchemy, on connections of the bulk-write
+    storage profile.
+
+    Args:
+        path (str): path of the database
+    """
+
+    def __init__(self, path=HISTORY_PATH):
+        self.engine = create_storage_engine(path, "bulk-write")
+        metadata.create_all(self.engine)
+        columns = [column.name for column in price_history.columns]
+        self.insert = (
+            f"INSERT OR IGNORE INTO {price_history.name} "
+            f"({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        )
+
+    def write(self, prices):
+        if prices.empty:
+            return 0
+        # same text format as sqlalchemy DateTime, converted in one go
+        updated_at = np.datetime_as_string(
+            prices["updated_at"].to_numpy().astype("datetime64[s]")
+        )
+        rows = zip(
+            prices["station_id"].tolist(),
+            prices["gastype_id"].tolist(),
+            np.char.replace(updated_at, "T", " ").tolist(),
+            prices["price"].tolist(),
+        )
+        with self.engine.begin() as conn:
+            return conn.exec_driver_sql(self.insert, list(rows)).rowcount
+
+    def scan(self, start=None, end=None, station_ids=None):
+        query = sa.select(*(price_history.c[field] for field in PRICE_FIELDS))
+        if start is not None:
+            query = query.where(price_history.c.updated_at >= start)
+        if end is not None:
+            query = query.where(price_history.c.updated_at < end)
+        if station_ids is not None:
+            query = query.where(price_history.c.station_id.in_(station_ids))
+        query = query.order_by(*(price_history.c[key] for key in EVENT_KEY))
+        with self.engine.connect() as conn:
+            return pd.DataFrame(conn.execute(query).all(), columns=PRICE_FIELDS)
+
+    def close(self):
+        self.engine.dispose()
+
+
+class ParquetHistoryStore(HistoryStore):
+    """
+    History store of Parquet files partitioned by day, compressed with zstd.
+
+    Files are laid out as ``<root>/day=YYYY-MM-DD/<part>.parquet``. Events
+    are buffered in memory and written when `flush_rows` of them are
+    pending or when the store is closed. The partitions written to are then
+    compacted into one file, sorted by station and without duplicates, so
+    that the statistics of the row groups let scans skip other stations.
+
+    Args:
+        root (str): directory of the partitions
+        flush_rows (int): number of buffered events triggering a write
+    """
+
+    def __init__(self, root=HISTORY_DIR, flush_rows=FLUSH_ROWS):
+        self.root = Path(root)
+        self.flush_rows = flush_rows
+        self._pending = []
+        self._pending_rows = 0
+        self._written_days = set()
+
+    def partition_path(self, day):
+        """
+        Directory of the partition of a day.
+
+        Args:
+            day (str): day formatted as YYYY-MM-DD
+
+        Returns:
+            pathlib.Path
+        """
+        return self.root / f"{PARTITION_KEY}={day}"
+
+    def partitions(self, start=None, end=None):
+        """
+        Days of the partitions overlapping a time range.
+
+        Args:
+            start (datetime): first date included
+            end (datetime): last date excluded
+
+        Returns:
+            list of str: days formatted as YYYY-MM-DD, sorted
+        """
+        if not self.root.exists():
+            return []
+        days = sorted(
+            path.name.split("=", 1)[1]
+            for path in self.root.glob(f"{PARTITION_KEY}=*")
+            if path.is_dir()
+        )
+        if start is not None:
+            days = [day for day in days if day >= start.date().isoformat()]
+        if end is not None:
+            # the partition of the end date is only read if the range ends
+            # after its midnight
+            last = (pd.Timestamp(end) - pd.Timedelta(seconds=1)).date()
+            days = [day for day in days if day <= last.isoformat()]
+        return days
+
+    def write(self, prices):
+        if prices.empty:
+            return 0
+        self._pending.append(prices[list(PRICE_FIELDS)])
+        self._pending_rows += len(prices)
+        if self._pending_rows >= self.flush_rows:
+            self.flush()
+        return len(prices)
+
+    def flush(self):
+        """Write the buffered events, one new file per partition."""
+        if not self._pending:
+            return
+        events = pd.concat(self._pending, ignore_index=True)
+        self._pending, self._pending_rows = [], 0
+        for day, partition in events.groupby(
+            events["updated_at"].dt.floor("D"), sort=False
+        ):
+            day = day.date().isoformat()
+            self._write_file(self.partition_path(day), partition)
+            self._written_days.add(day)
+
+    def _write_file(self, directory, events):
+        directory.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(
+            events, schema=HISTORY_SCHEMA, preserve_index=False
+        )
+        # names sort in the order of writing, the oldest copy of an event is
+        # kept by the compaction
+        path = (
+            directory / f"part-{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        )
+        # readers never see a partially written file
+        tmp_path = path.with_suffix(".tmp")
+        pq.write_table(table, tmp_path, compression="zstd")
+        os.replace(tmp_path, path)
+        return path
+
+    def compact(self, day):
+        """
+        Merge the files of a partition into one.
+
+        Args:
+            day (str): day of the partition, formatted as YYYY-MM-DD
+        """
+        directory = self.partition_path(day)
+        files = sorted(directory.glob("*.parquet"))
+        if len(files) < 2:
+            return
+        events = (
+            ds.dataset(files, schema=HISTORY_SCHEMA, format="parquet")
+            .to_table()
+            .to_pandas()
+            .drop_duplicates(EVENT_KEY)
+            .sort_values(EVENT_KEY)
+        )
+        self._write_file(directory, events)
+        for file in files:
+            file.unlink()
+
+    def scan(self, start=None, end=None, station_ids=None):
+        files = [
+            file
+            for day in self.partitions(start, end)
+            for file in sorted(self.partition_path(day).glob("*.parquet"))
+        ]
+        if not files:
+            return pd.DataFrame(
+                {
+                    field: pd.Series(dtype=dtype.to_pandas_dtype())
+                    for field, dtype in zip(
+                        HISTORY_SCHEMA.names, HISTORY_SCHEMA.types
+                    )
+                }
+            )
+        conditions = []
+        if start is not None:
+            conditions.append(ds.field("updated_at") >= pa.scalar(start))
+        if end is not None:
+            conditions.append(ds.field("updated_at") < pa.scalar(end))
+        if station_ids is not None:
+            conditions.append(ds.field("station_id").isin(list(station_ids)))
+        table = ds.dataset(files, schema=HISTORY_SCHEMA, format="parquet")
+        return (
+            table.to_table(
+                filter=functools.reduce(operator.and_, conditions)
+                if conditions
+                else None
+            )
+            .to_pandas()
+            .sort_values(EVENT_KEY, ignore_index=True)
+        )
+
+    def close(self):
+        self.flush()
+        for day in sorted(self._written_days):
+            self.compact(day)
+        self._written_days.clear()
+
+
+HISTORY_STORES = {
+    "parquet": ParquetHistoryStore,
+    "sqlite": SQLiteHistoryStore,
+}
+DEFAULT_HISTORY_STORE = "parquet"
+
+
+def open_history_store(kind=DEFAULT_HISTORY_STORE):
+    """
+    Create a history store with its default location.
+
+    Args:
+        kind (str): one of HISTORY_STORES keys
+
+    Returns:
+        HistoryStore
+    """
+    try:
+        store = HISTORY_STORES[kind]
+    except KeyError:
+        raise ValueError(
+            f"Unknown history store {kind}, "
+            f"choose among {', '.join(HISTORY_STORES)}"
+        )
+    return store()
+
+
+def archive_url(year=None, day=None):
+    """
+    Url of a yearly or daily archive.
+
+    Args:
+        year (int): year of the archive, such as 2023
+        day (str): day of the archive, formatted as YYYYMMDD
+
+    Returns:
+        str
+    """
+    if year is not None:
+        return YEAR_URL.format(year=year)
+    if day is not None:
+        return DAY_URL.format(day=day)
+    raise ValueError("A year or a day is required")
+
+
+@contextmanager
+def open_archive(path):
+    """
+    Open a local archive, zipped or not, as a stream of XML.
+
+    Args:
+        path (str): path of the zip archive or of the XML file
+
+    Yields:
+        binary file object of the XML
+    """
+    with open(path, "rb") as file:
+        if file.read(len(LOCAL_HEADER_SIGNATURE)) != LOCAL_HEADER_SIGNATURE:
+            file.seek(0)
+            yield file
+            return
+        file.seek(0)
+        with io.BufferedReader(ZipMemberReader(file), CHUNK_SIZE) as feed:
+            yield feed
+
+
+def backfill(
+    source,
+    store,
+    parser=DEFAULT_PARSER,
+    batch_size=BACKFILL_BATCH_SIZE,
+    queue_size=QUEUE_SIZE,
+    workers=DEFAULT_WORKERS,
+):
+    """
+    Append the price events of an archive to the history store.
+
+    Args:
+        source: binary file object of the XML of the archive
+        store (HistoryStore): store of the events
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations per batch
+        queue_size (int): number of items held by each queue of the pipeline
+        workers (int): number of parsing processes
+
+    Returns:
+        dict: counts of events read, stored, and of invalid events, with
+            the throughput of the pipeline stages
+    """
+    stats = {"events": 0, "stored": 0, "rejected": 0, "invalid_prices": 0}
+
+    def write_batch(batch):
+        stats["events"] += len(batch.prices) + batch.invalid_prices
+        stats["stored"] += store.write(batch.prices)
+        stats["rejected"] += batch.rejected
+        stats["invalid_prices"] += batch.invalid_prices
+
+    stats.update(
+        run_stages(
+            source,
+            write_batch,
+            parser=parser,
+            batch_size=batch_size,
+            queue_size=queue_size,
+            workers=workers,
+        )
+    )
+    return stats
+
+
+@contextmanager
+def open_backfill_source(year=None, day=None, file=None):
+    """
+    Open the XML of an archive, local or downloaded.
+
+    Args:
+        year (int): year of the archive to download
+        day (str): day of the archive to download, formatted as YYYYMMDD
+        file (str): path of a local archive, used instead of downloading
+
+    Yields:
+        binary file object of the XML
+    """
+    if file is not None:
+        with open_archive(file) as source:
+            yield source
+    else:
+        with open_feed(archive_url(year=year, day=day)) as response:
+            yield response.stream
+
+
+def format_backfill_stats(stats):
+    """
+    Summarize the counters of a backfill on one line.
+
+    Args:
+        stats (dict): counters returned by backfill
+
+    Returns:
+        str
+    """
+    return (
+        f"{stats['events']} price events, {stats['stored']} stored, "
+        f"{stats['invalid_prices']} invalid | "
+        f"{stats['rejected']} rejected stations"
+    )
@@ -198,6 +198,11 @@ def main():
             "pages/stations.py",
             label="Click here to go to your stations dashboard",
         )
+        st.title("Route dashboard 🛣️")
+        st.page_link(
+            "pages/route.py",
+            label="Click here to find the cheapest stations of a trip",
+        )
 
     elif st.session_state["authentication_status"] is False:
         with st.sidebar:
@@ -0,0 +1,455 @@
+"""Set-based loader of the stations and prices of the fuel feed.
+
+Stations and prices are written with batched ``INSERT ... ON CONFLICT DO
+UPDATE`` statements sent through SQLAlchemy Core ``executemany``, one
+transaction per batch of stations instead of one per station.
+
+In incremental mode, the current state of the tables is loaded once at the
+start of the run and only the rows that changed are written.
+
+Records are converted and validated by batch, see staging.py. The prices
+written can also be appended to a history store, see history.py.
+
+Each load that writes rows bumps the data version of the database, stored
+in its ``user_version`` header field: the pages key their caches of the
+stations and prices by it, whatever wrote them, the ETL job, the
+``dump_stations`` action or a replay of the corpus.
+"""
+
+import time
+
+import pandas as pd
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from models import Price, Station
+from staging import PRICE_FIELDS, stage_records
+
+DEFAULT_BATCH_SIZE = 1000  # stations written per transaction
+STATION_COLUMNS = ("latitude", "longitude", "address", "town", "zip_code")
+
+
+def data_version(conn):
+    """
+    Version of the stations and prices of a database, bumped by each load.
+
+    Args:
+        conn: sqlalchemy connection
+
+    Returns:
+        int
+    """
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def bump_data_version(engine):
+    """
+    Mark a new version of the stations and prices of a database.
+
+    Args:
+        engine: sqlalchemy engine of the database
+    """
+    with engine.connect() as conn:
+        # read and written under the write lock, as the loads
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = data_version(conn)
+        conn.exec_driver_sql(f"PRAGMA user_version = {version + 1}")
+        conn.commit()
+
+
+def upsert_stations_statement():
+    """
+    Build the upsert statement of the stations table.
+
+    Stations colliding with the coordinates of another station are ignored,
+    as the (latitude, longitude) index is unique, see
+    BulkLoader.rejected_stations.
+
+    Returns:
+        sqlalchemy Insert
+    """
+    stations = Station.__table__
+    other = stations.alias("other")
+    stmt = insert(stations).prefix_with("OR IGNORE")
+    # refer to the excluded row by name, an aliased table would be added
+    # to the FROM clause of the subquery
+    excluded = {
+        column: sa.literal_column(f"excluded.{column}")
+        for column in ("id", "latitude", "longitude")
+    }
+    return stmt.on_conflict_do_update(
+        index_elements=[stations.c.id],
+        set_={column: stmt.excluded[column] for column in STATION_COLUMNS},
+        where=~sa.exists().where(
+            other.c.latitude == excluded["latitude"],
+            other.c.longitude == excluded["longitude"],
+            other.c.id != excluded["id"],
+        ),
+    )
+
+
+def upsert_prices_statement():
+    """
+    Build the upsert statement of the prices table.
+
+    Returns:
+        sqlalchemy Insert
+    """
+    prices = Price.__table__
+    stmt = insert(prices)
+    return stmt.on_conflict_do_update(
+        index_elements=[prices.c.gastype_id, prices.c.station_id],
+        set_={
+            "updated_at": stmt.excluded.updated_at,
+            "price": stmt.excluded.price,
+        },
+    )
+
+
+def preload_state(conn):
+    """
+    Read the current stations and prices of the database.
+
+    Args:
+        conn: sqlalchemy connection
+
+    Returns:
+        tuple: map of station id to its STATION_COLUMNS values, and map of
+            (station_id, gastype_id) to the date of the price
+    """
+    stations = Station.__table__
+    prices = Price.__table__
+    known_stations = {
+        row[0]: tuple(row[1:])
+        for row in conn.execute(
+            sa.select(
+                stations.c.id,
+                *(stations.c[column] for column in STATION_COLUMNS),
+            )
+        )
+    }
+    known_prices = {
+        (station_id, gastype_id): updated_at
+        for station_id, gastype_id, updated_at in conn.execute(
+            sa.select(
+                prices.c.station_id, prices.c.gastype_id, prices.c.updated_at
+            )
+        )
+    }
+    return known_stations, known_prices
+
+
+def stored_stations(conn, ids):
+    """
+    Read the coordinates of stations.
+
+    Args:
+        conn: sqlalchemy connection
+        ids (list of int): ids of the stations
+
+    Returns:
+        dict: map of station id to its latitude and longitude
+    """
+    stations = Station.__table__
+    return {
+        row[0]: tuple(row[1:])
+        for row in conn.execute(
+            sa.select(
+                stations.c.id, stations.c.latitude, stations.c.longitude
+            ).where(stations.c.id.in_(ids))
+        )
+    }
+
+
+def new_stats():
+    """
+    Counters of a loading run.
+
+    Returns:
+        dict
+    """
+    return {
+        "stations": {"inserted": 0, "updated": 0, "skipped": 0},
+        "prices": {"inserted": 0, "updated": 0, "skipped": 0},
+        "rejected": 0,
+        "invalid_prices": 0,
+        "batches": 0,
+        # seconds waiting for the write lock of the database, executing the
+        # upserts and committing them
+        "lock_seconds": 0.0,
+        "write_seconds": 0.0,
+        "commit_seconds": 0.0,
+    }
+
+
+class BulkLoader:
+    """
+    Accumulate the records of the feed and write them by batches.
+
+    Args:
+        engine: sqlalchemy engine of the database
+        batch_size (int): number of stations written per transaction
+        incremental (bool): skip the prices that are not newer than the
+            stored ones and the stations that did not change. Otherwise
+            every row is written again.
+        history: history.HistoryStore receiving the written prices
+    """
+
+    def __init__(
+        self,
+        engine,
+        batch_size=DEFAULT_BATCH_SIZE,
+        incremental=True,
+        history=None,
+    ):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.history = history
+        self.upsert_stations = upsert_stations_statement()
+        self.upsert_prices = upsert_prices_statement()
+        self.records = []
+        self.stats = new_stats()
+        # batches committed since the data version was bumped
+        self.unversioned = 0
+        with engine.connect() as conn:
+            self.known_stations, self.known_prices = preload_state(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            # the batches committed before a failure are part of the data
+            self.close()
+
+    def close(self):
+        """Bump the data version of the database if batches were written."""
+        if self.unversioned:
+            bump_data_version(self.engine)
+            self.unversioned = 0
+
+    def add(self, record):
+        """
+        Queue a station record, writing the batch once it is full.
+
+        Args:
+            record: parsers.StationRecord
+        """
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the queued records."""
+        if self.records:
+            self.write_batch(stage_records(self.records))
+        self.records = []
+
+    def write_batch(self, batch):
+        """
+        Write a staged batch of records.
+
+        Args:
+            batch: staging.StagedBatch
+        """
+        self.stats["rejected"] += batch.rejected
+        self.stats["invalid_prices"] += batch.invalid_prices
+        self.write(batch.station_rows(), batch.price_rows())
+
+    def changed_stations(self, stations):
+        """
+        Keep the stations that are new or whose address or location changed.
+
+        Args:
+            stations (list of dict): rows of the stations table
+
+        Returns:
+            list of dict
+        """
+        changed = []
+        for row in stations:
+            values = tuple(row[column] for column in STATION_COLUMNS)
+            if (
+                self.incremental
+                and self.known_stations.get(row["id"]) == values
+            ):
+                self.stats["stations"]["skipped"] += 1
+            else:
+                changed.append(row)
+        return changed
+
+    def changed_prices(self, prices):
+        """
+        Keep the prices that are new or more recent than the stored ones.
+
+        Args:
+            prices (list of dict): rows of the prices table
+
+        Returns:
+            list of dict
+        """
+        changed = []
+        for row in prices:
+            known = self.known_prices.get(
+                (row["station_id"], row["gastype_id"])
+            )
+            if (
+                known is None
+                or row["updated_at"] > known
+                or not self.incremental
+            ):
+                changed.append(row)
+            else:
+                self.stats["prices"]["skipped"] += 1
+        return changed
+
+    def rejected_stations(self, conn, stations):
+        """
+        Ids of the stations the upsert ignored, in the current transaction.
+
+        A station taking the coordinates of another one is not written: it
+        is missing, or kept at its previous location. Its whole ``<pdv>`` is
+        rejected, prices included.
+
+        Args:
+            conn: sqlalchemy connection, after the upsert of the stations
+            stations (list of dict): rows of the stations table upserted
+
+        Returns:
+            set of int
+        """
+        stored = stored_stations(conn, [row["id"] for row in stations])
+        return {
+            row["id"]
+            for row in stations
+            if stored.get(row["id"]) != (row["latitude"], row["longitude"])
+        }
+
+    def remember(self, stations, prices):
+        """
+        Count the rows written by a committed batch, and keep their state.
+
+        The state is kept only once the batch is committed, so that the rows
+        of a batch rolled back are written again by the next ones.
+
+        Args:
+            stations (list of dict): rows of the stations table written
+            prices (list of dict): rows of the prices table written
+        """
+        for row in stations:
+            status = (
+                "updated" if row["id"] in self.known_stations else "inserted"
+            )
+            self.stats["stations"][status] += 1
+            self.known_stations[row["id"]] = tuple(
+                row[column] for column in STATION_COLUMNS
+            )
+        for row in prices:
+            key = (row["station_id"], row["gastype_id"])
+            status = "updated" if key in self.known_prices else "inserted"
+            self.stats["prices"][status] += 1
+            self.known_prices[key] = row["updated_at"]
+
+    def write(self, stations, prices):
+        """
+        Upsert rows of the stations and prices tables in one transaction.
+
+        The write lock is taken when the transaction begins, so that the time
+        spent waiting for other writers is measured apart. The stations
+        ignored by the upsert are counted as rejected and their prices are not
+        written.
+
+        Args:
+            stations (list of dict): rows of the stations table
+            prices (list of dict): rows of the prices table
+        """
+        stations = self.changed_stations(stations)
+        prices = self.changed_prices(prices)
+        if not stations and not prices:
+            return
+        rejected = set()
+        start = time.perf_counter()
+        with self.engine.connect() as conn:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            locked = time.perf_counter()
+            if stations:
+                conn.execute(self.upsert_stations, stations)
+                rejected = self.rejected_stations(conn, stations)
+                if rejected:
+                    stations = [
+                        row for row in stations if row["id"] not in rejected
+                    ]
+                    prices = [
+                        row
+                        for row in prices
+                        if row["station_id"] not in rejected
+                    ]
+            if prices:
+                conn.execute(self.upsert_prices, prices)
+            written = time.perf_counter()
+            conn.commit()
+        self.stats["rejected"] += len(rejected)
+        self.remember(stations, prices)
+        self.stats["lock_seconds"] += locked - start
+        self.stats["write_seconds"] += written - locked
+        self.stats["commit_seconds"] += time.perf_counter() - written
+        self.stats["batches"] += 1
+        self.unversioned += 1
+        if prices and self.history is not None:
+            self.history.write(
+                pd.DataFrame.from_records(prices, columns=PRICE_FIELDS)
+            )
+
+
+def load_records(
+    records,
+    engine,
+    batch_size=DEFAULT_BATCH_SIZE,
+    incremental=True,
+    history=None,
+):
+    """
+    Load station records into the database by batches.
+
+    Args:
+        records: iterable of parsers.StationRecord
+        engine: sqlalchemy engine of the database
+        batch_size (int): number of stations written per transaction
+        incremental (bool): write only the rows that changed
+        history: history.HistoryStore receiving the written prices
+
+    Returns:
+        dict: counts of inserted, updated and skipped stations and prices,
+            of rejected stations, of invalid prices and of written batches
+    """
+    with BulkLoader(
+        engine, batch_size=batch_size, incremental=incremental, history=history
+    ) as loader:
+        for record in records:
+            loader.add(record)
+    return loader.stats
+
+
+def format_stats(stats):
+    """
+    Summarize the counters of a loading run on one line.
+
+    Args:
+        stats (dict): counters returned by load_records
+
+    Returns:
+        str
+    """
+    parts = [
+        f"{table}: "
+        + ", ".join(f"{count} {key}" for key, count in stats[table].items())
+        for table in ("stations", "prices")
+    ]
+    parts.append(f"{stats['rejected']} rejected stations")
+    parts.append(f"{stats['invalid_prices']} invalid prices")
+    parts.append(f"{stats['batches']} batches")
+    return " | ".join(parts)
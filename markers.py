@@ -0,0 +1,174 @@
+"""Rendering modes of the stations layer of the maps.
+
+The stations of a viewport, as GeoJSON features of the tile cache (see
+tiles.py), are drawn by one of MARKER_MODES:
+
+- ``markers``: one folium.Marker per station, with its icon, tooltip and
+  popup, each one a separate element of the page;
+- ``geojson``: a single GeoJSON layer of icon markers, carrying the
+  properties of the stations for their tooltips;
+- ``compact``: the ids and coordinates of the stations only, in one GeoJSON
+  layer per color, drawn as circles on the canvas of maps created with
+  ``prefer_canvas``. The popup, built on click, holds the id of the
+  station, whose details are then shown by the page.
+
+Followed stations are drawn in red, the others in blue.
+"""
+
+import os
+
+import folium
+
+DEFAULT_MARKER_MODE = os.getenv("MARKER_MODE", "compact")
+
+
+def marker_layer(features, followed=()):
+    """
+    One marker per station.
+
+    Args:
+        features (list): GeoJSON features of the stations
+        followed (iterable): ids of the followed stations
+
+    Returns:
+        folium.FeatureGroup
+    """
+    followed = set(followed)
+    layer = folium.FeatureGroup(name="Stations")
+    for feature in features:
+        properties = feature["properties"]
+        longitude, latitude = feature["geometry"]["coordinates"]
+        color = "red" if properties["id"] in followed else "blue"
+        layer.add_child(
+            folium.Marker(
+                [latitude, longitude],
+                popup=properties["id"],
+                tooltip=properties["address"].upper(),
+                icon=folium.Icon(color=color),
+            )
+        )
+    return layer
+
+
+def geojson_layer(features, followed=()):
+    """
+    A GeoJSON layer of icon markers, the followed stations apart.
+
+    Args:
+        features (list): GeoJSON features of the stations
+        followed (iterable): ids of the followed stations
+
+    Returns:
+        folium.FeatureGroup
+    """
+    followed = set(followed)
+    layer = marker_layer(
+        [f for f in features if f["properties"]["id"] in followed], followed
+    )
+    # ids as strings, the popup would format numbers with the locale
+    others = [
+        {
+            **f,
+            "properties": {
+                **f["properties"],
+                "station": str(f["properties"]["id"]),
+            },
+        }
+        for f in features
+        if f["properties"]["id"] not in followed
+    ]
+    if others:
+        layer.add_child(
+            folium.GeoJson(
+                {"type": "FeatureCollection", "features": others},
+                marker=folium.Marker(icon=folium.Icon(color="blue")),
+                tooltip=folium.GeoJsonTooltip(
+                    fields=["address"],
+                    labels=False,
+                    style="text-transform: uppercase;",
+                ),
+                popup=folium.GeoJsonPopup(fields=["station"], labels=False),
+            )
+        )
+    return layer
+
+
+def _station_points(features, color):
+    # ids as strings, the popup would format numbers with the locale
+    return folium.GeoJson(
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [
+                            round(coordinate, 5)
+                            for coordinate in feature["geometry"]["coordinates"]
+                        ],
+                    },
+                    "properties": {"id": str(feature["properties"]["id"])},
+                }
+                for feature in features
+            ],
+        },
+        marker=folium.CircleMarker(
+            radius=8, weight=2, color=color, fill=True, fill_opacity=0.7
+        ),
+        popup=folium.GeoJsonPopup(fields=["id"], labels=False),
+    )
+
+
+def compact_layer(features, followed=()):
+    """
+    GeoJSON layers of the ids and coordinates of the stations.
+
+    One layer per color, so that no style is computed by station.
+
+    Args:
+        features (list): GeoJSON features of the stations
+        followed (iterable): ids of the followed stations
+
+    Returns:
+        folium.FeatureGroup
+    """
+    followed = set(followed)
+    layer = folium.FeatureGroup(name="Stations")
+    for color, members in (
+        (
+            "#3388ff",
+            [f for f in features if f["properties"]["id"] not in followed],
+        ),
+        ("red", [f for f in features if f["properties"]["id"] in followed]),
+    ):
+        if members:
+            layer.add_child(_station_points(members, color))
+    return layer
+
+
+MARKER_MODES = {
+    "markers": marker_layer,
+    "geojson": geojson_layer,
+    "compact": compact_layer,
+}
+
+
+def stations_layer(features, followed=(), mode=DEFAULT_MARKER_MODE):
+    """
+    Layer of the stations of a viewport.
+
+    Args:
+        features (list): GeoJSON features of the stations
+        followed (iterable): ids of the followed stations
+        mode (str): one of MARKER_MODES keys
+
+    Returns:
+        folium layer
+    """
+    if mode not in MARKER_MODES:
+        raise ValueError(
+            f"Unknown marker mode {mode}, expected one of "
+            f"{', '.join(MARKER_MODES)}"
+        )
+    return MARKER_MODES[mode](features, followed)
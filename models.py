@@ -123,6 +123,25 @@ class Price(Base):
     price = sa.Column(sa.Float, nullable=False)
 
 
+class FeedState(Base):
+    __tablename__ = "feed_states"
+    url = sa.Column(sa.String, primary_key=True)
+    etag = sa.Column(sa.String, nullable=True)
+    last_modified = sa.Column(sa.String, nullable=True)
+    content_hash = sa.Column(sa.String, nullable=True)
+    fetched_at = sa.Column(sa.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<FeedState {self.url}>"
+
+    def validators(self):
+        return {
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "content_hash": self.content_hash,
+        }
+
+
 class Transfer(Base):
     __tablename__ = "transfers"
     id = sa.Column(sa.Integer, primary_key=True)
@@ -133,3 +152,32 @@ class Transfer(Base):
     hash_gas_types_followed = sa.Column(sa.String, nullable=False)
     custom_stations_inserted = sa.Column(sa.Integer, nullable=False)
     hash_custom_stations = sa.Column(sa.String, nullable=False)
+
+
+class EtlRun(Base):
+    __tablename__ = "etl_runs"
+    id = sa.Column(sa.Integer, primary_key=True)
+    started_at = sa.Column(sa.DateTime, nullable=False)
+    # last progress update, a running job without heartbeat has died
+    updated_at = sa.Column(sa.DateTime, nullable=False)
+    finished_at = sa.Column(sa.DateTime, nullable=True)
+    # running, success, skipped or failed
+    status = sa.Column(sa.String, nullable=False)
+    error = sa.Column(sa.String, nullable=True)
+    feed_bytes = sa.Column(sa.Integer, nullable=False, default=0)
+    stations_processed = sa.Column(sa.Integer, nullable=False, default=0)
+    download_seconds = sa.Column(sa.Float, nullable=True)
+    parse_seconds = sa.Column(sa.Float, nullable=True)
+    write_seconds = sa.Column(sa.Float, nullable=True)
+    commit_seconds = sa.Column(sa.Float, nullable=True)
+    lock_wait_seconds = sa.Column(sa.Float, nullable=True)
+    stations_inserted = sa.Column(sa.Integer, nullable=True)
+    stations_updated = sa.Column(sa.Integer, nullable=True)
+    stations_skipped = sa.Column(sa.Integer, nullable=True)
+    prices_inserted = sa.Column(sa.Integer, nullable=True)
+    prices_updated = sa.Column(sa.Integer, nullable=True)
+    prices_skipped = sa.Column(sa.Integer, nullable=True)
+    peak_rss_mb = sa.Column(sa.Float, nullable=True)
+
+    def __repr__(self):
+        return f"<EtlRun {self.id} {self.status}>"
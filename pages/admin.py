@@ -1,9 +1,11 @@
 import logging
 import os
 import subprocess
+import tempfile
 from datetime import datetime, timedelta
 from pathlib import Path
 
+import pandas as pd
 import psutil
 import requests
 import streamlit as st
@@ -11,8 +13,10 @@ from dotenv import load_dotenv
 from sqlalchemy.sql import text
 
 from models import CustomStation, User, VerificationCode
-from session import db_session
+from session import db_session, engine, reader_engine
 from sidebar import make_sidebar
+from storage import snapshot_database
+from telemetry import HEARTBEAT_SECONDS, STAGE_COLUMNS, load_runs
 from utils import (
     VERSION,
     init_authenticator,
@@ -30,6 +34,92 @@ st.set_page_config(
 load_dotenv()
 authenticator, config = init_authenticator()
 
+
+def is_running(runs):
+    """Whether the last ETL run recorded is in progress."""
+    return not runs.empty and runs.iloc[0]["status"] == "running"
+
+
+def show_etl_runs():
+    """Render the ETL runs, refreshed only while a run is in progress."""
+    running = is_running(load_runs(reader_engine))
+    fragment = st.fragment(
+        render_etl_runs, run_every=HEARTBEAT_SECONDS if running else None
+    )
+    fragment(running)
+
+
+def render_etl_runs(polled):
+    """
+    Render the progress of the running ETL job and the past runs.
+
+    Args:
+        polled (bool): whether the fragment is refreshed every heartbeat
+    """
+    runs = load_runs(reader_engine)
+    if is_running(runs) != polled:
+        # start or stop the refresh with the run
+        st.rerun()
+    if not polled:
+        st.button("Refresh", key="refresh_etl_runs")
+    if runs.empty:
+        st.write("No ETL run recorded")
+        return
+    current = runs.iloc[0]
+    if current["status"] == "running":
+        st.info(f"ETL running for {current['seconds']:.0f}s")
+        # the previous run gives the expected number of stations
+        previous = runs[runs["status"] == "success"]
+        processed = int(current["stations_processed"])
+        downloaded = current["feed_bytes"] / 1024 / 1024
+        if previous.empty:
+            st.write(f"{processed} stations, {downloaded:.1f} MB downloaded")
+        else:
+            expected = max(int(previous.iloc[0]["stations_processed"]), 1)
+            st.progress(
+                min(processed / expected, 1.0),
+                text=f"{processed} / ~{expected} stations, "
+                f"{downloaded:.1f} MB downloaded",
+            )
+        st.metric("Peak memory (MB)", f"{current['peak_rss_mb']:.0f}")
+    else:
+        st.caption(
+            f"Last run {current['status']} at {current['updated_at']:%c}"
+        )
+        if current["status"] in ("failed", "stalled"):
+            st.error(current["error"] or "The ETL job stopped responding")
+    completed = runs[runs["status"] == "success"]
+    if not completed.empty:
+        st.caption("Time spent in each stage (s)")
+        st.bar_chart(completed, x="started_at", y=list(STAGE_COLUMNS))
+        st.caption("Prices written")
+        st.bar_chart(
+            completed,
+            x="started_at",
+            y=["prices_inserted", "prices_updated", "prices_skipped"],
+        )
+    st.dataframe(
+        runs[
+            [
+                "started_at",
+                "status",
+                "seconds",
+                "feed_bytes",
+                "stations_processed",
+                *STAGE_COLUMNS,
+                "stations_inserted",
+                "stations_updated",
+                "prices_inserted",
+                "prices_updated",
+                "prices_skipped",
+                "peak_rss_mb",
+                "error",
+            ]
+        ],
+        hide_index=True,
+    )
+
+
 if st.session_state["authentication_status"]:
     if st.session_state["username"] == "admin":
         st.write(f'Welcome *{st.session_state["name"]}*')
@@ -83,11 +173,14 @@ if st.session_state["authentication_status"]:
             st.metric("Total users", count_users)
         with c2:
             # make a pure sql query on this one
-            conn = st.connection("gas_db", type="sql")
-            df_result = conn.query(
-                "SELECT COUNT(DISTINCT(user_id)) as total FROM custom_stations",
-                ttl=60,
-            )
+            with reader_engine.connect() as conn:
+                df_result = pd.read_sql(
+                    text(
+                        "SELECT COUNT(DISTINCT(user_id)) as total "
+                        "FROM custom_stations"
+                    ),
+                    conn,
+                )
 
             count_users_custom_stations = df_result.iloc[0]["total"]
             st.metric("Users with custom stations", count_users_custom_stations)
@@ -161,8 +254,9 @@ if st.session_state["authentication_status"]:
                     submitted = st.form_submit_button("Submit")
                     if submitted:
                         logger.info("User queried the database")
-                        conn = st.connection("gas_db", type="sql")
-                        result = conn.query(query, ttl=60)
+                        # read only, changes go through the form below
+                        with reader_engine.connect() as conn:
+                            result = pd.read_sql(text(query), conn)
                         st.dataframe(result)
             except Exception as e:
                 st.error(e)
@@ -174,10 +268,8 @@ if st.session_state["authentication_status"]:
                     submitted = st.form_submit_button("Submit")
                     if submitted:
                         logger.info("User modified the database")
-                        conn = st.connection("gas_db", type="sql")
-                        with conn.session as s:
-                            result = s.execute(text(query))
-                            s.commit()
+                        with engine.begin() as conn:
+                            result = conn.execute(text(query))
             except Exception as e:
                 st.error(e)
         # flush expired verification codes
@@ -198,13 +290,18 @@ if st.session_state["authentication_status"]:
                             st.error(e)
         # download database file db.sqlite3
         with st.expander("Download Database file"):
-            with open("db.sqlite3", "rb") as file:
-                btn = st.download_button(
-                    label="Download file",
-                    data=file,
-                    file_name="db.sqlite3",
-                    mime="application/sqlite3",
-                )
+            # a copy of the last commit, the database file can miss those
+            # still in the write-ahead log
+            if st.button("Prepare file"):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    snapshot = Path(tmpdir) / "db.sqlite3"
+                    snapshot_database(reader_engine, snapshot)
+                    btn = st.download_button(
+                        label="Download file",
+                        data=snapshot.read_bytes(),
+                        file_name="db.sqlite3",
+                        mime="application/sqlite3",
+                    )
         st.divider()
         st.subheader("Admin actions on ETL")
         # check if alive
@@ -219,27 +316,9 @@ if st.session_state["authentication_status"]:
                 st.error("ETL is not running")
         else:
             st.error("No pid file found")
-        # restart ETL
-        with st.expander("Show status files for ETL Job"):
-            files = list(Path("outputs/").glob("*.txt"))
-            # add a form to remove output logs files
-            with st.form(key="form_remove_logs"):
-                submitted = st.form_submit_button("Remove logs")
-                if submitted:
-                    logger.info("User triggered log files removal")
-                    for file in files:
-                        file.unlink()
-                    st.success("Files removed")
-            files += ["pid.txt", "lastjob.txt"]
-            for file in files:
-                st.caption(file)
-                if os.path.exists(file):
-                    with open(file, "r") as file:
-                        # read line by line
-                        for line in file.readlines():
-                            st.write(line)
-                else:
-                    st.write(f"No file {file} found")
+        # timeline of the ETL runs, refreshed while a run is in progress
+        with st.expander("ETL runs", expanded=True):
+            show_etl_runs()
         with st.expander("ETL thread"):
             with st.form(key="form_etl_command"):
                 submitted = st.form_submit_button("Kill ETL")
@@ -260,6 +339,14 @@ if st.session_state["authentication_status"]:
                             Path("pid.txt").unlink(missing_ok=True)
                     else:
                         st.error("No pid file found")
+            # add a form to remove output logs files
+            with st.form(key="form_remove_logs"):
+                submitted = st.form_submit_button("Remove logs")
+                if submitted:
+                    logger.info("User triggered log files removal")
+                    for file in Path("outputs/").glob("*.txt"):
+                        file.unlink()
+                    st.success("Files removed")
             # form to remove last job txt file
             with st.form(key="form_remove_lastjob"):
                 submitted = st.form_submit_button("Remove last job file")
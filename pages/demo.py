@@ -7,10 +7,19 @@ from sqlalchemy import func
 from streamlit_folium import st_folium
 from streamlit_geolocation import streamlit_geolocation
 
+from markers import stations_layer
 from models import GasType, Station
 from session import db_session
 from sidebar import make_sidebar
-from utils import VERSION, bounding_stations, get_prices_demo
+from utils import (
+    VERSION,
+    bounding_clusters,
+    cluster_marker,
+    get_prices_demo,
+    show_cheapest_nearby,
+    update_viewport,
+)
+from viewport import ViewportState
 
 logger = logging.getLogger("gas_station_app")
 st.set_page_config(
@@ -122,44 +131,46 @@ if not st.session_state["geolocated_demo"]:
             st.toast("You have been geolocated", icon="🌍")
             st.session_state["map_zoom_demo"] = ZOOM_START
             st.session_state["center_demo"] = CENTER_START
+            st.session_state["position_demo"] = CENTER_START
 # load center map
 if "center_demo" not in st.session_state:
     st.session_state["center_demo"] = CENTER_START
 # load session state map zoom
 if "map_zoom_demo" not in st.session_state:
     st.session_state["map_zoom_demo"] = ZOOM_START
-# load followed stations
-if "stations_demo" not in st.session_state:
-    st.session_state["stations_demo"] = {}
+# load stations of the viewport
+if "viewport_demo" not in st.session_state:
+    st.session_state["viewport_demo"] = ViewportState()
+viewport = st.session_state["viewport_demo"]
+viewport.follow(
+    int(s.get("id")) for s in st.session_state["stations_followed_demo"]
+)
 if "toast_display_demo" not in st.session_state:
     st.session_state["toast_display_demo"] = False
+# load clusters of stations, shown at low zoom
+if "clusters_demo" not in st.session_state:
+    st.session_state["clusters_demo"] = []
 
 
 # list of stations
 # map of stations
 map_center = st.session_state["center_demo"]
 map_zoom = st.session_state["map_zoom_demo"]
-st.info("Zoom in to see the markers and click to add a new station👇", icon="ℹ️")
+st.info(
+    "Zoom in to see the stations and click to add a new station👇", icon="ℹ️"
+)
 
-m = folium.Map(location=CENTER_START, zoom_start=map_zoom)
+m = folium.Map(location=CENTER_START, zoom_start=map_zoom, prefer_canvas=True)
 fg = folium.FeatureGroup(name="Stations markers")
-for key, station in st.session_state["stations_demo"].items():
-    # color is red if the station is in the user's stations followed
-    if str(station.id) in [
-        s.get("id") for s in st.session_state["stations_followed_demo"]
-    ]:
-        color = "red"
-    else:
-        color = "blue"
-    tooltip = f"{station.address.upper()}"
-    fg.add_child(
-        folium.Marker(
-            [station.latitude / 100000, station.longitude / 100000],
-            popup=station.id,
-            tooltip=tooltip,
-            icon=folium.Icon(color=color),
-        )
+# stations of the viewport in a single layer, the followed ones in red
+fg.add_child(
+    stations_layer(
+        viewport.features(),
+        followed=viewport.followed,
     )
+)
+for cluster in st.session_state["clusters_demo"]:
+    fg.add_child(cluster_marker(cluster))
 # call to render Folium map in Streamlit
 st_data = st_folium(
     m,
@@ -188,31 +199,29 @@ if st_data is not None:
         if not st.session_state["toast_display_demo"]:
             st.toast("Stations display activated ✅")
             st.session_state["toast_display_demo"] = True
-        stations = bounding_stations(st_data["bounds"])
-        # udpate stations by sync dict in session state and stations
-        # remove stations not in the bounds
-        items = list(st.session_state["stations_demo"].items())
-        for key, station in items:
-            if station not in stations:
-                st.session_state["stations_demo"].pop(key)
-        # add stations in the bounds
-        for station in stations:
-            if station.id not in st.session_state["stations_demo"].keys():
-                st.session_state["stations_demo"][station.id] = station
-    elif (
-        st_data.get("bounds", {}).get("_southWest", {}).get("lat") is not None
-        and st_data.get("zoom", 16) < 12
-    ):
+        # stations of the tiles entering the bounds, from the tile cache
+        update_viewport(viewport, st_data["bounds"])
+        st.session_state["clusters_demo"] = []
+    elif st_data.get("bounds", {}).get("_southWest", {}).get("lat") is not None:
         if st.session_state["toast_display_demo"]:
-            st.toast("Stations display deactivated ❌")
+            st.toast("Stations grouped by area, zoom in to see them 🔍")
             st.session_state["toast_display_demo"] = False
+        # clusters of stations with their lowest prices
+        st.session_state["clusters_demo"] = bounding_clusters(
+            st_data["bounds"],
+            st_data.get("zoom", 16),
+            st.session_state["gastypes_followed_demo"],
+        )
+        viewport.clear()
 
-    if st_data.get("last_object_clicked_tooltip") is not None:
+    # clusters have no popup, only stations can be selected, the details
+    # of the station are loaded once clicked
+    if st_data.get("last_object_clicked_popup") is not None:
         st.session_state["last_object_clicked_popup"] = st_data[
             "last_object_clicked_popup"
         ]
-        # get the station from the tooltip
-        station_id = st_data["last_object_clicked_popup"]
+        # get the station from the popup
+        station_id = st_data["last_object_clicked_popup"].strip()
         col1, col2, col3 = st.columns(3)
         with col2:
             st.button(
@@ -222,9 +231,7 @@ if st_data is not None:
                 type="primary",
             )
         # if station is not in the user's stations
-        if station_id not in [
-            s.get("id") for s in st.session_state["stations_followed_demo"]
-        ]:
+        if not viewport.is_followed(int(station_id)):
             with st.form(key="add_station"):
                 # write information about the station
                 st.write("Add this station to demo stations 👇")
@@ -247,8 +254,6 @@ if st_data is not None:
                         custom_station
                     )
                     st.toast(f"Station {custom_name} added", icon="🎉")
-                    # flush the session state for stations
-                    st.session_state["stations_demo"] = {}
         else:
             with st.form(key="remove_station"):
                 # write information about the station
@@ -262,22 +267,27 @@ if st_data is not None:
                 for custom_station in st.session_state[
                     "stations_followed_demo"
                 ]:
-                    if custom_station.get("id") == station_id:
+                    # ids of the random stations are not strings
+                    if str(custom_station.get("id")) == station_id:
                         custom_name = custom_station.get("custom_name")
                         break
                 st.write(f"Custom name: {custom_name}")
                 submitted = st.form_submit_button("Remove station")
                 if submitted:
-                    custom_station = {
-                        "id": station_id,
-                        "custom_name": custom_name,
-                    }
                     st.session_state["stations_followed_demo"].remove(
                         custom_station
                     )
                     st.toast(f"Station {custom_name} removed", icon="🗑️")
-                    # flush the session state for stations
-                    st.session_state["stations_demo"] = {}
 
+# cheapest stations around the user, or around the map center
+show_cheapest_nearby(
+    st.session_state.get("position_demo", st.session_state.get("map_center")),
+    st.session_state["gastypes_followed_demo"],
+    key="_demo",
+)
+
+st.sidebar.page_link(
+    "pages/route.py", label="Cheapest stations of a trip", icon="🛣️"
+)
 st.sidebar.page_link("home.py", label="🏠 Back to main page")
 make_sidebar(VERSION)
@@ -10,6 +10,7 @@ from utils import (
     VERSION,
     dump_config,
     init_authenticator,
+    invalidate_prices_user,
     send_discord_notification,
 )
 
@@ -79,6 +80,8 @@ if st.session_state["authentication_status"]:
                 print(e)
                 db_session.rollback()
                 st.error("Error adding preferred gas types")
+            else:
+                invalidate_prices_user(username)
 
     with st.expander("Modify details for name/email"):
         try:
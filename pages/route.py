@@ -0,0 +1,114 @@
+import logging
+
+import folium
+import streamlit as st
+from streamlit_folium import st_folium
+
+from models import GasType, User
+from routes import ROUTE_READERS, read_route
+from session import db_session
+from sidebar import make_sidebar
+from utils import VERSION, cheapest_along_route
+
+logger = logging.getLogger("gas_station_app")
+st.set_page_config(
+    page_title="Carburoam",
+    page_icon="⛽",
+)
+
+logger.info("Route page loaded")
+st.title("Route dashboard 🛣️")
+st.caption("Find the cheapest stations along your trip.")
+
+# default to the followed gas types
+if st.session_state.get("authentication_status"):
+    user = (
+        db_session.query(User)
+        .filter_by(username=st.session_state["username"])
+        .first()
+    )
+    followed = [gastype.name for gastype in user.gastypes]
+else:
+    followed = st.session_state.get(
+        "gastypes_followed_demo", ["SP95", "Gazole"]
+    )
+gas_types = [gas.name for gas in db_session.query(GasType).all()]
+gastype_names = st.multiselect(
+    label="Which gas types do you need?",
+    options=gas_types,
+    default=[name for name in followed if name in gas_types],
+)
+uploaded = st.file_uploader(
+    "Upload your route (GPX track or GeoJSON line)",
+    type=[suffix.lstrip(".") for suffix in ROUTE_READERS],
+)
+col1, col2 = st.columns(2)
+with col1:
+    width_km = st.slider("Maximum detour (km)", 1, 20, 5)
+with col2:
+    k = st.slider("Stations per gas type", 1, 20, 5)
+
+if uploaded is not None:
+    try:
+        route = read_route(uploaded.getvalue(), uploaded.name)
+    except ValueError as e:
+        logger.warning(f"Invalid route uploaded: {e}")
+        st.error(f"This route cannot be read: {e}")
+        st.stop()
+    st.caption(f"Route of {route.length_km:.0f} km")
+    df = cheapest_along_route(route, gastype_names, width_km=width_km, k=k)
+    if df.empty:
+        st.warning(f"No station within {width_km} km of the route")
+    else:
+        column_config = {
+            col: st.column_config.Column(disabled=True)
+            for col in ["Type", "Address", "Town"]
+        }
+        column_config["Price"] = st.column_config.NumberColumn(
+            disabled=True, format="%.3f €"
+        )
+        column_config["Kilometer"] = st.column_config.NumberColumn(
+            disabled=True, format="%.0f km"
+        )
+        column_config["Detour"] = st.column_config.NumberColumn(
+            disabled=True, format="%.1f km"
+        )
+        column_config["Updated_at"] = st.column_config.DateColumn(
+            disabled=True,
+            format="DD-MM-YYYY",
+        )
+        st.dataframe(
+            data=df,
+            hide_index=True,
+            use_container_width=True,
+            column_config=column_config,
+            column_order=[
+                "Type",
+                "Price",
+                "Kilometer",
+                "Detour",
+                "Address",
+                "Town",
+                "Updated_at",
+            ],
+        )
+    # map of the route and of the stations
+    path = list(zip(route.latitudes.tolist(), route.longitudes.tolist()))
+    m = folium.Map()
+    folium.PolyLine(path, color="blue", weight=4).add_to(m)
+    for row in df.itertuples():
+        folium.Marker(
+            [row.Latitude, row.Longitude],
+            tooltip=f"{row.Type} {row.Price:.3f} € - {row.Address.upper()}",
+            icon=folium.Icon(color="red"),
+        ).add_to(m)
+    m.fit_bounds(
+        [
+            [route.latitudes.min(), route.longitudes.min()],
+            [route.latitudes.max(), route.longitudes.max()],
+        ]
+    )
+    st_folium(m, width=725, returned_objects=[])
+
+st.sidebar.page_link("home.py", label="🏠 Back to main page")
+make_sidebar(VERSION)
@@ -3,13 +3,19 @@ import streamlit as st
 from streamlit_folium import st_folium
 from streamlit_geolocation import streamlit_geolocation
 
+from markers import stations_layer
 from models import CustomStation, Station, User
 from session import db_session
 from utils import (
-    bounding_stations,
+    bounding_clusters,
+    cluster_marker,
     init_authenticator,
+    invalidate_prices_user,
     send_discord_notification,
+    show_cheapest_nearby,
+    update_viewport,
 )
+from viewport import ViewportState
 
 st.set_page_config(
     page_title="Carburoam",
@@ -25,9 +31,8 @@ def on_click_delete_custom_station(custom_station_id):
     )
     db_session.delete(custom_station)
     db_session.commit()
+    invalidate_prices_user(st.session_state["username"])
     st.toast("Station deleted", icon="🗑️")
-    # flush the session state for stations
-    st.session_state["stations"] = {}
 
 
 def render_stations(user_id):
@@ -136,9 +141,8 @@ if st.session_state["authentication_status"]:
                         custom_station.custom_name = custom_name
                         db_session.add(custom_station)
                         db_session.commit()
+                        invalidate_prices_user(username)
                         st.toast(f"Station {custom_name} edited", icon="🎉")
-                        # flush the session state for stations
-                        st.session_state["stations"] = {}
                     else:
                         st.warning("Custom Name is the same")
     st.subheader("Add a new station")
@@ -162,6 +166,7 @@ if st.session_state["authentication_status"]:
                 st.toast("You have been geolocated", icon="🌍")
                 st.session_state["map_zoom"] = ZOOM_START
                 st.session_state["center"] = CENTER_START
+                st.session_state["position"] = CENTER_START
                 st.session_state["geolocated"] = True
     # load center map
     if "center" not in st.session_state:
@@ -169,38 +174,36 @@ if st.session_state["authentication_status"]:
     # load session state map zoom
     if "map_zoom" not in st.session_state:
         st.session_state["map_zoom"] = ZOOM_START
-    # load stations
-    if "stations" not in st.session_state:
-        st.session_state["stations"] = {}
+    # load stations of the viewport
+    if "viewport" not in st.session_state:
+        st.session_state["viewport"] = ViewportState()
+    viewport = st.session_state["viewport"]
+    viewport.follow(s.id for s in user.stations)
+    # load clusters of stations, shown at low zoom
+    if "clusters" not in st.session_state:
+        st.session_state["clusters"] = []
 
     # list of stations
     # map of stations
     map_center = st.session_state["center"]
     map_zoom = st.session_state["map_zoom"]
     st.info(
-        "Zoom in to see the markers and click to add a new station👇", icon="ℹ️"
+        "Zoom in to see the stations and click to add a new station👇",
+        icon="ℹ️",
+    )
+    m = folium.Map(
+        location=CENTER_START, zoom_start=map_zoom, prefer_canvas=True
     )
-    m = folium.Map(location=CENTER_START, zoom_start=map_zoom)
     fg = folium.FeatureGroup(name="Stations markers")
-    for key, station in st.session_state["stations"].items():
-        # color is red if the station is in the user's stations
-        if station.id in [s.id for s in user.stations]:
-            color = "red"
-            # retrieve the custom name of the station
-            for station_user in user.stations:
-                if station_user.id == station.id:
-                    tooltip = f"{station_user.custom_name.upper()}"
-        else:
-            color = "blue"
-            tooltip = f"{station.address.upper()}"
-        fg.add_child(
-            folium.Marker(
-                [station.latitude / 100000, station.longitude / 100000],
-                popup=station.id,
-                tooltip=tooltip,
-                icon=folium.Icon(color=color),
-            )
+    # stations of the viewport in a single layer, the followed ones in red
+    fg.add_child(
+        stations_layer(
+            viewport.features(),
+            followed=viewport.followed,
         )
+    )
+    for cluster in st.session_state["clusters"]:
+        fg.add_child(cluster_marker(cluster))
     # call to render Folium map in Streamlit
     st_data = st_folium(
         m,
@@ -227,24 +230,29 @@ if st.session_state["authentication_status"]:
             is not None
             and st_data.get("zoom", 16) > 12
         ):
-            stations = bounding_stations(st_data["bounds"])
-            # udpate stations by sync dict in session state and stations
-            # remove stations not in the bounds
-            items = list(st.session_state["stations"].items())
-            for key, station in items:
-                if station not in stations:
-                    st.session_state["stations"].pop(key)
-            # add stations in the bounds
-            for station in stations:
-                if station.id not in st.session_state["stations"].keys():
-                    st.session_state["stations"][station.id] = station
+            # stations of the tiles entering the bounds, from the tile cache
+            update_viewport(viewport, st_data["bounds"])
+            st.session_state["clusters"] = []
+        elif (
+            st_data.get("bounds", {}).get("_southWest", {}).get("lat")
+            is not None
+        ):
+            # clusters of stations with their lowest prices
+            st.session_state["clusters"] = bounding_clusters(
+                st_data["bounds"],
+                st_data.get("zoom", 16),
+                [gastype.name for gastype in user.gastypes],
+            )
+            viewport.clear()
 
-        if st_data.get("last_object_clicked_tooltip") is not None:
+        # clusters have no popup, only stations can be selected, the details
+        # of the station are loaded once clicked
+        if st_data.get("last_object_clicked_popup") is not None:
             st.session_state["last_object_clicked_popup"] = st_data[
                 "last_object_clicked_popup"
             ]
-            # get the station from the tooltip
-            station_id = st_data["last_object_clicked_popup"]
+            # get the station from the popup
+            station_id = st_data["last_object_clicked_popup"].strip()
             col1, col2, col3 = st.columns(3)
             with col2:
                 st.button(
@@ -254,7 +262,7 @@ if st.session_state["authentication_status"]:
                     type="primary",
                 )
             # if station is not in the user's stations
-            if station_id not in [str(s.id) for s in user.stations]:
+            if not viewport.is_followed(int(station_id)):
                 with st.form(key="add_station"):
                     # write information about the station
                     st.write("Add this station to your stations 👇")
@@ -277,13 +285,26 @@ if st.session_state["authentication_status"]:
                         custom_station.custom_name = custom_name
                         db_session.add(custom_station)
                         db_session.commit()
+                        invalidate_prices_user(username)
                         st.toast(f"Station {custom_name} added", icon="🎉")
                         send_discord_notification(
                             topic="new_station",
                             message=f"User {username} added a new station: {custom_name}",
                         )
-                        # flush the session state for stations
-                        st.session_state["stations"] = {}
+            else:
+                # name of the followed station, not sent with the map
+                for station_user in user.stations:
+                    if str(station_user.id) == station_id:
+                        st.write(
+                            "Followed station: "
+                            f"{station_user.custom_name.upper()}"
+                        )
+    # cheapest stations around the user, or around the map center
+    show_cheapest_nearby(
+        st.session_state.get("position", st.session_state.get("map_center")),
+        [gastype.name for gastype in user.gastypes],
+        key="",
+    )
 else:
     st.error("You must be logged in to access this page")
 st.sidebar.page_link("home.py", label="🏠 Back to main page")
@@ -0,0 +1,199 @@
+"""Streaming parsers for the PrixCarburants XML feed.
+
+Each backend reads the feed incrementally and yields one ``StationRecord`` per
+``<pdv>`` element, releasing the element once it has been processed so that
+memory stays flat whatever the size of the feed.
+"""
+
+import xml.etree.ElementTree as ET
+from collections.abc import Iterator
+from contextlib import ExitStack
+from typing import NamedTuple
+from xml.parsers import expat
+
+CHUNK_SIZE = 64 * 1024
+
+
+class StationRecord(NamedTuple):
+    """Raw content of a ``<pdv>`` element, attributes kept as strings."""
+
+    id: str
+    latitude: str
+    longitude: str
+    address: str | None
+    town: str | None
+    zip_code: str
+    # list of (id, valeur, maj) of each <prix> child
+    prices: list[tuple[str, str, str]]
+
+
+def _record_from_element(pdv):
+    """
+    Build a StationRecord from an ElementTree (or lxml) ``<pdv>`` element.
+
+    Args:
+        pdv: xml element of the station
+
+    Returns:
+        StationRecord
+    """
+    address = pdv.find("adresse")
+    town = pdv.find("ville")
+    return StationRecord(
+        id=pdv.get("id"),
+        latitude=pdv.get("latitude"),
+        longitude=pdv.get("longitude"),
+        address=address.text if address is not None else None,
+        town=town.text if town is not None else None,
+        zip_code=pdv.get("cp"),
+        prices=[
+            (prix.get("id"), prix.get("valeur"), prix.get("maj"))
+            for prix in pdv.iterfind("prix")
+        ],
+    )
+
+
+def iter_stations_stdlib(source) -> Iterator[StationRecord]:
+    """
+    Stream the stations with ``xml.etree.ElementTree.iterparse``.
+
+    Args:
+        source: path or binary file object of the XML feed
+
+    Yields:
+        StationRecord
+    """
+    context = ET.iterparse(source, events=("start", "end"))
+    # the first event is the start of the root element (pdv_liste)
+    _, root = next(context)
+    for event, elem in context:
+        if event == "end" and elem.tag == "pdv":
+            yield _record_from_element(elem)
+            # drop the processed station from the tree
+            root.clear()
+
+
+def iter_stations_lxml(source) -> Iterator[StationRecord]:
+    """
+    Stream the stations with ``lxml.etree.iterparse`` (optional dependency).
+
+    Args:
+        source: path or binary file object of the XML feed
+
+    Yields:
+        StationRecord
+    """
+    try:
+        from lxml import etree
+    except ImportError as e:
+        raise ImportError(
+            "lxml parser backend requires lxml, install it with "
+            "`uv sync --extra lxml`"
+        ) from e
+    for _, elem in etree.iterparse(source, events=("end",), tag="pdv"):
+        yield _record_from_element(elem)
+        # free the element and the already processed siblings
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def iter_stations_expat(source) -> Iterator[StationRecord]:
+    """
+    Stream the stations with a pull loop on top of the expat push parser.
+
+    No tree is ever built, records are assembled straight from the parser
+    callbacks and handed over after each chunk of input.
+
+    Args:
+        source: path or binary file object of the XML feed
+
+    Yields:
+        StationRecord
+    """
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    ready = []
+    state = {"pdv": None, "text": None, "prices": None}
+
+    def start_element(name, attrs):
+        if name == "pdv":
+            state["pdv"] = attrs
+            state["prices"] = []
+            state["adresse"] = None
+            state["ville"] = None
+        elif name == "prix" and state["pdv"] is not None:
+            state["prices"].append(
+                (attrs.get("id"), attrs.get("valeur"), attrs.get("maj"))
+            )
+        elif name in ("adresse", "ville") and state["pdv"] is not None:
+            state["text"] = []
+
+    def char_data(data):
+        if state["text"] is not None:
+            state["text"].append(data)
+
+    def end_element(name):
+        if name in ("adresse", "ville") and state["text"] is not None:
+            state[name] = "".join(state["text"]) or None
+            state["text"] = None
+        elif name == "pdv":
+            attrs = state["pdv"]
+            ready.append(
+                StationRecord(
+                    id=attrs.get("id"),
+                    latitude=attrs.get("latitude"),
+                    longitude=attrs.get("longitude"),
+                    address=state["adresse"],
+                    town=state["ville"],
+                    zip_code=attrs.get("cp"),
+                    prices=state["prices"],
+                )
+            )
+            state["pdv"] = None
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = char_data
+
+    with ExitStack() as stack:
+        if isinstance(source, (str, bytes)) or hasattr(source, "__fspath__"):
+            file = stack.enter_context(open(source, "rb"))
+        else:
+            file = source
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            parser.Parse(chunk, False)
+            yield from ready
+            ready.clear()
+        parser.Parse(b"", True)
+        yield from ready
+        ready.clear()
+
+
+PARSER_BACKENDS = {
+    "stdlib": iter_stations_stdlib,
+    "lxml": iter_stations_lxml,
+    "expat": iter_stations_expat,
+}
+DEFAULT_PARSER = "stdlib"
+
+
+def iter_stations(source, backend=DEFAULT_PARSER) -> Iterator[StationRecord]:
+    """
+    Stream the stations of the feed with the chosen parser backend.
+
+    Args:
+        source: path or binary file object of the XML feed
+        backend (str): one of PARSER_BACKENDS keys
+
+    Yields:
+        StationRecord
+    """
+    try:
+        parse = PARSER_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(
+            f"Unknown parser backend {backend}, "
+            f"choose among {', '.join(PARSER_BACKENDS)}"
+        )
+    return parse(source)
@@ -0,0 +1,423 @@
+"""Pipelined ETL of the fuel feed.
+
+The download and decompression of the archive, the parsing of the XML and the
+database writes run as concurrent stages linked by bounded queues:
+
+    fetch --(chunks of XML)--> parse --(batches of rows)--> write
+
+Network reads, zlib and SQLite release the GIL, so the parsing overlaps with
+the I/O of the two other stages. As the queues are bounded, a slow stage
+blocks the ones feeding it, which keeps memory flat whatever the size of the
+feed.
+
+The parse stage hands batches of ``batch_size`` stations, staged as columns
+(see staging.py), to the writer. With workers, it splits the feed into
+standalone XML documents parsed and staged in a pool of processes, so that
+parsing uses several cores. Batches are written in the order of the feed.
+"""
+
+import collections
+import io
+import multiprocessing
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from loader import DEFAULT_BATCH_SIZE, BulkLoader
+from parsers import DEFAULT_PARSER, iter_stations
+from staging import stage_records
+
+CHUNK_SIZE = 64 * 1024
+QUEUE_SIZE = 4  # items held by each queue before blocking the producer
+POLL_SECONDS = 0.1  # how often a blocked stage checks for a failure
+END = None  # marks the end of a queue
+DEFAULT_WORKERS = 0  # parse in the pipeline thread
+TASKS_PER_WORKER = 2  # chunks submitted ahead to each worker
+
+# the opening tag of the root element pdv_liste also starts with <pdv
+PDV_START = re.compile(rb"<pdv[\s>]")
+PDV_END = b"</pdv>"
+FEED_FOOTER = b"</pdv_liste>"
+
+
+class PipelineAborted(Exception):
+    """Raised in a stage when another stage of the pipeline failed."""
+
+
+class StageQueue(queue.Queue):
+    """
+    Bounded queue recording its depth each time an item is put.
+
+    Args:
+        name (str): name of the queue in the report
+        maxsize (int): number of items held before blocking the producer
+    """
+
+    def __init__(self, name, maxsize=QUEUE_SIZE):
+        super().__init__(maxsize)
+        self.name = name
+        self.puts = 0
+        self.max_depth = 0
+        self.total_depth = 0
+
+    def _put(self, item):
+        super()._put(item)
+        depth = self._qsize()
+        self.puts += 1
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    def stats(self):
+        """
+        Depth of the queue over the run.
+
+        Returns:
+            dict
+        """
+        return {
+            "maxsize": self.maxsize,
+            "max_depth": self.max_depth,
+            "mean_depth": round(self.total_depth / self.puts, 2)
+            if self.puts
+            else 0,
+        }
+
+
+class Stage(threading.Thread):
+    """
+    Thread running one step of the pipeline.
+
+    A failure is recorded and stops the other stages, which give up as soon
+    as they wait on a queue.
+
+    Args:
+        name (str): name of the stage in the report
+        target: function of the stage, called with the stage
+        stop (threading.Event): set when a stage of the pipeline failed
+    """
+
+    def __init__(self, name, target, stop):
+        super().__init__(name=f"etl-{name}", daemon=True)
+        self.stage_name = name
+        self.target = target
+        self.stop = stop
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.waiting = 0.0
+        self.error = None
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.target(self)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+        finally:
+            self.seconds = time.perf_counter() - start
+
+    def put(self, target_queue, item):
+        """Put an item, blocking while the queue is full."""
+        start = time.perf_counter()
+        while True:
+            if self.stop.is_set():
+                raise PipelineAborted
+            try:
+                target_queue.put(item, timeout=POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        self.waiting += time.perf_counter() - start
+
+    def get(self, source_queue):
+        """Get an item, blocking while the queue is empty."""
+        start = time.perf_counter()
+        while True:
+            if self.stop.is_set():
+                raise PipelineAborted
+            try:
+                item = source_queue.get(timeout=POLL_SECONDS)
+                break
+            except queue.Empty:
+                continue
+        self.waiting += time.perf_counter() - start
+        return item
+
+    def stats(self):
+        """
+        Throughput of the stage over the run.
+
+        Returns:
+            dict
+        """
+        busy = max(self.seconds - self.waiting, 1e-9)
+        return {
+            "items": self.items,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 3),
+            "waiting": round(self.waiting, 3),
+            "items_per_second": round(self.items / busy),
+            "mb_per_second": round(self.bytes / 1024 / 1024 / busy, 2),
+        }
+
+
+class QueueReader(io.RawIOBase):
+    """
+    Binary file object reading the chunks of a queue, for the parsers.
+
+    Args:
+        stage (Stage): stage reading the queue
+        source_queue (StageQueue): chunks of bytes, ended by END
+    """
+
+    def __init__(self, stage, source_queue):
+        self.stage = stage
+        self.source_queue = source_queue
+        self._pending = b""
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending and not self._eof:
+            chunk = self.stage.get(self.source_queue)
+            if chunk is END:
+                self._eof = True
+            else:
+                self.stage.bytes += len(chunk)
+                self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+
+def split_feed(feed, stations_per_chunk):
+    """
+    Split the feed into standalone XML documents.
+
+    Each document holds the prolog of the feed, so that its encoding is
+    kept, and up to `stations_per_chunk` consecutive ``<pdv>`` elements.
+
+    Args:
+        feed: binary file object of the XML feed
+        stations_per_chunk (int): number of stations per document
+
+    Yields:
+        bytes
+    """
+    header = None
+    buffer = b""
+    scan = 0  # offset of the buffer left to search for the end of a station
+    count = 0  # stations in buffer[:scan]
+    for data in iter(lambda: feed.read(CHUNK_SIZE), b""):
+        buffer += data
+        if header is None:
+            match = PDV_START.search(buffer)
+            if match is None:
+                continue
+            header, buffer = buffer[: match.start()], buffer[match.start() :]
+        while (end := buffer.find(PDV_END, scan)) != -1:
+            scan = end + len(PDV_END)
+            count += 1
+            if count == stations_per_chunk:
+                yield header + buffer[:scan] + FEED_FOOTER
+                buffer, scan, count = buffer[scan:], 0, 0
+    if count:
+        yield header + buffer[:scan] + FEED_FOOTER
+
+
+def parse_chunk(chunk, parser=DEFAULT_PARSER):
+    """
+    Parse and stage a document of split_feed, in a worker process.
+
+    Args:
+        chunk (bytes): standalone XML document
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+
+    Returns:
+        staging.StagedBatch
+    """
+    return stage_records(list(iter_stations(io.BytesIO(chunk), backend=parser)))
+
+
+def run_stages(
+    feed,
+    write_batch,
+    parser=DEFAULT_PARSER,
+    batch_size=DEFAULT_BATCH_SIZE,
+    queue_size=QUEUE_SIZE,
+    workers=DEFAULT_WORKERS,
+    on_start=None,
+):
+    """
+    Run the fetch, parse and write stages over the feed.
+
+    Args:
+        feed: binary file object of the XML feed
+        write_batch: function writing a staging.StagedBatch, called by the
+            write stage
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations per batch
+        queue_size (int): number of items held by each queue
+        workers (int): number of parsing processes, 0 to parse in the
+            pipeline thread
+        on_start: function called with the list of started stages, to follow
+            their counters while they run
+
+    Returns:
+        dict: throughput of each stage under "stages" and depth of each
+            queue under "queues"
+    """
+    stop = threading.Event()
+    chunks = StageQueue("chunks", queue_size)
+    batches = StageQueue("batches", queue_size)
+
+    def fetch(stage):
+        for chunk in iter(lambda: feed.read(CHUNK_SIZE), b""):
+            stage.items += 1
+            stage.bytes += len(chunk)
+            stage.put(chunks, chunk)
+        stage.put(chunks, END)
+
+    def parse(stage):
+        if workers:
+            parse_parallel(stage)
+            return
+        records = []
+        for record in iter_stations(QueueReader(stage, chunks), backend=parser):
+            records.append(record)
+            if len(records) >= batch_size:
+                emit(stage, stage_records(records))
+                records = []
+        if records:
+            emit(stage, stage_records(records))
+        stage.put(batches, END)
+
+    def emit(stage, batch):
+        stage.items += len(batch.stations) + batch.rejected
+        stage.put(batches, batch)
+
+    def parse_parallel(stage):
+        # spawn, forking a process running threads is not safe
+        context = multiprocessing.get_context("spawn")
+        pending = collections.deque()
+        with ProcessPoolExecutor(workers, mp_context=context) as pool:
+            for chunk in split_feed(QueueReader(stage, chunks), batch_size):
+                pending.append(pool.submit(parse_chunk, chunk, parser))
+                # bound the number of chunks in memory
+                if len(pending) >= workers * TASKS_PER_WORKER:
+                    emit(stage, pending.popleft().result())
+            while pending:
+                emit(stage, pending.popleft().result())
+        stage.put(batches, END)
+
+    def write(stage):
+        while (batch := stage.get(batches)) is not END:
+            write_batch(batch)
+            stage.items += len(batch.stations)
+
+    stages = [
+        Stage("fetch", fetch, stop),
+        Stage("parse", parse, stop),
+        Stage("write", write, stop),
+    ]
+    for stage in stages:
+        stage.start()
+    if on_start is not None:
+        on_start(stages)
+    for stage in stages:
+        stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+    return {
+        "stages": {stage.stage_name: stage.stats() for stage in stages},
+        "queues": {q.name: q.stats() for q in (chunks, batches)},
+    }
+
+
+def run_pipeline(
+    feed,
+    engine,
+    parser=DEFAULT_PARSER,
+    batch_size=DEFAULT_BATCH_SIZE,
+    incremental=True,
+    queue_size=QUEUE_SIZE,
+    workers=DEFAULT_WORKERS,
+    history=None,
+    on_start=None,
+):
+    """
+    Load the feed into the database with concurrent stages.
+
+    Args:
+        feed: binary file object of the XML feed
+        engine: sqlalchemy engine of the database
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations written per transaction
+        incremental (bool): write only new prices and changed stations
+        queue_size (int): number of items held by each queue
+        workers (int): number of parsing processes, 0 to parse in the
+            pipeline thread
+        history: history.HistoryStore receiving the written prices
+        on_start: function called with the list of started stages, see
+            run_stages
+
+    Returns:
+        dict: counters of loader.load_records, with the throughput of each
+            stage under "stages" and the depth of each queue under "queues"
+    """
+    # the current state of the database is read before anything is fetched
+    with BulkLoader(
+        engine, batch_size=batch_size, incremental=incremental, history=history
+    ) as loader:
+        stats = run_stages(
+            feed,
+            loader.write_batch,
+            parser=parser,
+            batch_size=batch_size,
+            queue_size=queue_size,
+            workers=workers,
+            on_start=on_start,
+        )
+    stats.update(loader.stats)
+    return stats
+
+
+def format_pipeline_stats(stats):
+    """
+    Summarize the throughput of the stages and the depth of the queues.
+
+    Args:
+        stats (dict): counters returned by run_pipeline or run_stages
+
+    Returns:
+        str
+    """
+    fetch = stats["stages"]["fetch"]
+    parse = stats["stages"]["parse"]
+    write = stats["stages"]["write"]
+    parts = [
+        f"fetch: {fetch['mb_per_second']} MB/s, {fetch['waiting']}s blocked",
+        (
+            f"parse: {parse['items_per_second']} pdv/s, "
+            f"{parse['waiting']}s blocked"
+        ),
+        (
+            f"write: {write['items_per_second']} pdv/s, "
+            f"{write['waiting']}s blocked"
+        ),
+    ]
+    parts.extend(
+        f"{name} queue: max {q['max_depth']}/{q['maxsize']}, "
+        f"mean {q['mean_depth']}"
+        for name, q in stats["queues"].items()
+    )
+    return " | ".join(parts)
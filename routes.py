@@ -0,0 +1,297 @@
+"""Cheapest stations along a route.
+
+A route is read from an uploaded GPX track or GeoJSON line. The stations of
+the cells of the catalog grid around the route are the candidates (see
+spatial.StationCatalog.near_points), then the distance of each candidate to
+each segment of the route is computed at once with NumPy, by chunks of
+stations, on a local flat projection of the segment. The nearest segment
+gives the detour to reach the station and its offset along the route.
+"""
+
+import json
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from spatial import KM_PER_DEGREE, StationRow
+
+# vertices closer than this to the previous one are dropped, in km
+MIN_STEP_KM = 0.2
+# the cells are searched around points of the route spaced by this, in km
+SAMPLE_STEP_KM = 1.0
+# station and segment pairs computed at once
+CHUNK_PAIRS = 2_000_000
+
+
+class RoutePrice(NamedTuple):
+    """Price of a station near a route."""
+
+    station: StationRow
+    gastype_id: int
+    price: float
+    updated_at: datetime
+    offset_km: float
+    distance_km: float
+
+
+class Route:
+    """
+    Polyline of a trip.
+
+    Args:
+        latitudes (array): latitudes of the vertices, in degrees
+        longitudes (array): longitudes of the vertices, in degrees
+        min_step_km (float): vertices closer than this to the previous one
+            are dropped
+    """
+
+    def __init__(self, latitudes, longitudes, min_step_km=MIN_STEP_KM):
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        if len(latitudes) < 2:
+            raise ValueError("A route needs at least two points")
+        lengths = self._lengths(latitudes, longitudes)
+        walked = np.concatenate([[0.0], np.cumsum(lengths)])
+        # keep a vertex each time the route walked another step
+        steps = np.floor(walked / min_step_km)
+        keep = np.concatenate([[True], steps[1:] > steps[:-1]])
+        keep[-1] = True
+        self.latitudes = latitudes[keep]
+        self.longitudes = longitudes[keep]
+        self.lengths = self._lengths(self.latitudes, self.longitudes)
+        # distance from the start of the route to each vertex
+        self.offsets = np.concatenate([[0.0], np.cumsum(self.lengths)])
+
+    def __len__(self):
+        return len(self.latitudes)
+
+    @property
+    def length_km(self):
+        return float(self.offsets[-1])
+
+    @staticmethod
+    def _lengths(latitudes, longitudes):
+        # segments are short enough to be flat at their mean latitude
+        scale = np.cos(np.radians((latitudes[1:] + latitudes[:-1]) / 2))
+        return KM_PER_DEGREE * np.hypot(
+            np.diff(latitudes), np.diff(longitudes) * scale
+        )
+
+    def samples(self, step_km=SAMPLE_STEP_KM):
+        """
+        Points along the route, spaced by at most a distance.
+
+        Args:
+            step_km (float): distance between two points, in km
+
+        Returns:
+            tuple: latitudes and longitudes of the points, in degrees
+        """
+        offsets = np.linspace(
+            0.0,
+            self.length_km,
+            max(int(np.ceil(self.length_km / step_km)), 1) + 1,
+        )
+        return (
+            np.interp(offsets, self.offsets, self.latitudes),
+            np.interp(offsets, self.offsets, self.longitudes),
+        )
+
+    def locate(self, latitudes, longitudes, chunk_pairs=CHUNK_PAIRS):
+        """
+        Distance of points to the route, and their offset along it.
+
+        Args:
+            latitudes (array): latitudes of the points, in degrees
+            longitudes (array): longitudes of the points, in degrees
+            chunk_pairs (int): point and segment pairs computed at once
+
+        Returns:
+            tuple: distances to the nearest segment and offsets of the
+                nearest position of the route from its start, in km
+        """
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        start_lat = self.latitudes[:-1]
+        start_lon = self.longitudes[:-1]
+        scale = np.cos(np.radians((self.latitudes[1:] + start_lat) / 2))
+        # segments in km, on the flat projection of each segment
+        seg_x = np.diff(self.longitudes) * scale * KM_PER_DEGREE
+        seg_y = np.diff(self.latitudes) * KM_PER_DEGREE
+        seg_square = np.maximum(seg_x**2 + seg_y**2, 1e-12)
+        distances = np.empty(len(latitudes))
+        offsets = np.empty(len(latitudes))
+        chunk = max(chunk_pairs // len(seg_x), 1)
+        for begin in range(0, len(latitudes), chunk):
+            lat = latitudes[begin : begin + chunk, None]
+            lon = longitudes[begin : begin + chunk, None]
+            x = (lon - start_lon) * scale * KM_PER_DEGREE
+            y = (lat - start_lat) * KM_PER_DEGREE
+            along = np.clip((x * seg_x + y * seg_y) / seg_square, 0.0, 1.0)
+            gaps = np.hypot(x - along * seg_x, y - along * seg_y)
+            nearest = np.argmin(gaps, axis=1)
+            rows = np.arange(len(nearest))
+            distances[begin : begin + chunk] = gaps[rows, nearest]
+            offsets[begin : begin + chunk] = (
+                self.offsets[nearest]
+                + along[rows, nearest] * self.lengths[nearest]
+            )
+        return distances, offsets
+
+
+def read_gpx(data):
+    """
+    Read the track or route points of a GPX file.
+
+    Args:
+        data (bytes): content of the file
+
+    Returns:
+        Route
+    """
+    root = ET.fromstring(data)
+    points = [
+        (float(element.get("lat")), float(element.get("lon")))
+        for element in root.iter()
+        # ignore the namespace of the GPX version
+        if element.tag.rsplit("}", 1)[-1] in ("trkpt", "rtept")
+    ]
+    return Route(*zip(*points)) if points else Route([], [])
+
+
+def _geojson_lines(geometry):
+    kind = geometry.get("type")
+    if kind == "FeatureCollection":
+        for feature in geometry["features"]:
+            yield from _geojson_lines(feature)
+    elif kind == "Feature":
+        yield from _geojson_lines(geometry.get("geometry") or {})
+    elif kind == "GeometryCollection":
+        for member in geometry["geometries"]:
+            yield from _geojson_lines(member)
+    elif kind == "LineString":
+        yield geometry["coordinates"]
+    elif kind == "MultiLineString":
+        yield from geometry["coordinates"]
+
+
+def read_geojson(data):
+    """
+    Read the lines of a GeoJSON file, joined in their order.
+
+    Args:
+        data (bytes): content of the file
+
+    Returns:
+        Route
+    """
+    points = [
+        (position[1], position[0])
+        for line in _geojson_lines(json.loads(data))
+        for position in line
+    ]
+    return Route(*zip(*points)) if points else Route([], [])
+
+
+ROUTE_READERS = {
+    ".gpx": read_gpx,
+    ".geojson": read_geojson,
+    ".json": read_geojson,
+}
+
+
+def read_route(data, name):
+    """
+    Read a route file, by the extension of its name.
+
+    Args:
+        data (bytes): content of the file
+        name (str): name of the file, one of ROUTE_READERS extensions
+
+    Returns:
+        Route
+    """
+    suffix = Path(name).suffix.lower()
+    if suffix not in ROUTE_READERS:
+        raise ValueError(
+            f"Unknown route format {suffix}, expected one of "
+            f"{', '.join(ROUTE_READERS)}"
+        )
+    try:
+        return ROUTE_READERS[suffix](data)
+    except (ET.ParseError, json.JSONDecodeError, KeyError, TypeError) as e:
+        raise ValueError(f"Invalid route file {name}: {e}") from e
+
+
+def stations_along(catalog, route, width_km):
+    """
+    Stations within a distance of a route.
+
+    Args:
+        catalog (spatial.StationCatalog): stations
+        route (Route): route
+        width_km (float): distance to the route, in km
+
+    Returns:
+        tuple: positions of the stations in the catalog, their distances to
+            the route and their offsets along it, in km, in route order
+    """
+    # a point of the route is at most half a step from a sample
+    candidates = catalog.near_points(
+        *route.samples(), width_km + SAMPLE_STEP_KM / 2
+    )
+    distances, offsets = route.locate(
+        catalog.latitudes[candidates] / 100000,
+        catalog.longitudes[candidates] / 100000,
+    )
+    inside = distances <= width_km
+    order = np.argsort(offsets[inside], kind="stable")
+    return (
+        candidates[inside][order],
+        distances[inside][order],
+        offsets[inside][order],
+    )
+
+
+def cheapest_along(prices, route, gastype_ids, width_km=5, k=10):
+    """
+    Cheapest stations within a distance of a route, for each gas type.
+
+    Args:
+        prices (spatial.CatalogPrices): prices of the stations
+        route (Route): route
+        gastype_ids (list): gas types, as in the feed
+        width_km (float): distance to the route, in km
+        k (int): number of stations per gas type
+
+    Returns:
+        list of RoutePrice: by gas type, then cheapest first, the first
+            along the route first at equal price
+    """
+    positions, distances, offsets = stations_along(
+        prices.catalog, route, width_km
+    )
+    along = []
+    for gastype_id in gastype_ids:
+        best, costs, updated_ats = prices.cheapest(positions, gastype_id, k)
+        for station, price, updated_at, offset, distance in zip(
+            prices.catalog.rows(positions[best]),
+            costs,
+            updated_ats,
+            offsets[best].tolist(),
+            distances[best].tolist(),
+        ):
+            along.append(
+                RoutePrice(
+                    station,
+                    int(gastype_id),
+                    price,
+                    updated_at,
+                    offset,
+                    distance,
+                )
+            )
+    return along
@@ -5,21 +5,43 @@ from functools import lru_cache
 from typing import Generator
 
 import sqlalchemy
-from sqlalchemy import create_engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy_utils import create_database, database_exists
 
 from models import Base, GasType
+from shadow import DATABASE_PATH, GenerationSwapped, follow_swaps
+from storage import create_reader_engine, create_writer_engine
 
 logger = logging.getLogger("gas_station_app")
-engine = create_engine("sqlite:///db.sqlite3", pool_pre_ping=True)
+# writes of the ETL and of the users go through the writer engine, the
+# queries of the pages through the query_only reader engine
+engine = create_writer_engine(DATABASE_PATH)
+reader_engine = create_reader_engine(DATABASE_PATH)
+# reconnect to the new database after a shadow ingest
+follow_swaps(engine)
+follow_swaps(reader_engine)
+
+
+class SwapSession(Session):
+    """Session rolled back when its transaction outlived a database swap."""
+
+    def commit(self):
+        try:
+            super().commit()
+        except GenerationSwapped:
+            # the changes were made on the previous generation, the next
+            # transaction of the session starts on the current one
+            self.rollback()
+            raise
 
 
 @lru_cache
-def create_session() -> scoped_session:
+def create_session(bind=engine) -> scoped_session:
     """Create a session given the url in settings."""
     Session = scoped_session(
-        sessionmaker(autocommit=False, autoflush=False, bind=engine)
+        sessionmaker(
+            class_=SwapSession, autocommit=False, autoflush=False, bind=bind
+        )
     )
     return Session
 
@@ -35,6 +57,8 @@ def get_session() -> Generator[scoped_session, None, None]:
 
 database_creation = False
 db_session = create_session()
+# session of the page queries, which cannot change the database
+reader_session = create_session(reader_engine)
 logger.info("session created")
 created_engine = db_session.bind
 if not database_exists(created_engine.url):
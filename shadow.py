@@ -0,0 +1,308 @@
+"""Shadow database ingest, swapped in atomically once loaded.
+
+``db.sqlite3`` is a symbolic link to the current generation of the
+database, ``db-<timestamp>.sqlite3``. A shadow ingest copies the current
+generation into a new file with the SQLite backup API, loads the feed into
+it while the pages keep reading the current one, then copies the tables
+written by the app meanwhile (users, custom stations, ...) and replaces the
+link. Readers never wait for the ETL writer and never see half-loaded
+tables.
+
+Connections opened before the swap keep reading the previous generation
+until they are returned to the pool, ``follow_swaps`` makes the engines of
+the app reconnect to the new one at their next checkout. A transaction
+still open on the previous generation cannot commit: its changes would be
+lost with the file, it fails with GenerationSwapped instead. The previous
+generations are removed once no process has them open.
+"""
+
+import os
+import sqlite3
+import time
+import uuid
+import weakref
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+import sqlalchemy as sa
+
+from models import Base
+from storage import DEFAULT_PROFILE, PROFILES, create_storage_engine
+
+DATABASE_PATH = "db.sqlite3"
+# tables loaded by the ETL, the other ones are copied from the live database
+# when the shadow is swapped in
+ETL_TABLES = ("stations", "prices")
+# generations kept on disk, the current one included
+KEEP_GENERATIONS = 2
+# seconds waiting for the writers of the live database at swap time
+LOCK_TIMEOUT = 30
+# files of a database, the journals of SQLite are named after it
+DATABASE_SUFFIXES = ("", "-journal", "-wal", "-shm")
+# engines following the swaps of this process, see follow_swaps
+followers = weakref.WeakSet()
+
+
+class GenerationSwapped(sa.exc.SQLAlchemyError):
+    """A transaction began on a generation of the database swapped since."""
+
+
+def follow_swaps(engine):
+    """
+    Reconnect the pooled connections of an engine after a swap.
+
+    Each connection remembers the file it opened, a connection to a
+    previous generation is discarded at checkout and replaced by a new one.
+    A transaction on a previous generation fails to commit, with
+    GenerationSwapped, and is to be rolled back.
+
+    Args:
+        engine: sqlalchemy engine of the database link
+    """
+    path = engine.url.database
+
+    @sa.event.listens_for(engine, "connect")
+    def record_generation(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # sqlite resolves the link, the path is the one of the generation
+        for _, name, file in cursor.execute("PRAGMA database_list"):
+            if name == "main":
+                connection_record.info["generation"] = file
+        cursor.close()
+
+    @sa.event.listens_for(engine, "checkout")
+    def check_generation(dbapi_connection, connection_record, proxy):
+        if connection_record.info.get("generation") != os.path.realpath(path):
+            # the pool invalidates the connection and opens a new one
+            raise sa.exc.DisconnectionError("database swapped")
+
+    @sa.event.listens_for(engine, "checkin")
+    def close_generation(dbapi_connection, connection_record):
+        # the pool may have been disposed meanwhile, see release_generation,
+        # close the previous generation without waiting for its collection
+        if connection_record is not None and connection_record.info.get(
+            "generation"
+        ) != os.path.realpath(path):
+            connection_record.invalidate()
+
+    @sa.event.listens_for(engine, "commit")
+    def check_commit(conn):
+        # a write waiting for the lock taken by swap_in lands in the previous
+        # generation once it is released, the link has changed by then
+        if conn.info.get("generation") != os.path.realpath(path):
+            raise GenerationSwapped(
+                "The database was updated during the transaction, retry"
+            )
+
+    followers.add(engine)
+
+
+def generations(path=DATABASE_PATH):
+    """
+    Generation files of a database, oldest first.
+
+    Args:
+        path (str): path of the database link
+
+    Returns:
+        list of pathlib.Path
+    """
+    path = Path(path)
+    stamps = {
+        file: file.stem.rsplit("-", 1)[1]
+        for file in path.parent.glob(f"{path.stem}-*{path.suffix}")
+    }
+    return sorted(
+        (file for file, stamp in stamps.items() if stamp.isdigit()),
+        key=lambda file: int(stamps[file]),
+    )
+
+
+def create_shadow(path=DATABASE_PATH):
+    """
+    Copy the current generation of the database into a new file.
+
+    The backup API copies a consistent snapshot without blocking the
+    writers of the live database for the whole copy.
+
+    Args:
+        path (str): path of the database link
+
+    Returns:
+        pathlib.Path: path of the shadow database
+    """
+    path = Path(path)
+    shadow = path.with_name(f"{path.stem}-{time.time_ns()}{path.suffix}")
+    with (
+        closing(sqlite3.connect(path)) as source,
+        closing(sqlite3.connect(shadow)) as target,
+    ):
+        source.backup(target)
+    return shadow
+
+
+def _remove(database):
+    for suffix in DATABASE_SUFFIXES:
+        Path(f"{database}{suffix}").unlink(missing_ok=True)
+
+
+def open_files():
+    """
+    Files opened by the processes of the machine.
+
+    Returns:
+        set of str: real paths of the files, None when the open files cannot
+            be listed
+    """
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
+    opened = set()
+    for descriptors in proc.glob("[0-9]*/fd"):
+        try:
+            entries = list(descriptors.iterdir())
+        # processes ending meanwhile, or of other users
+        except OSError:
+            continue
+        for descriptor in entries:
+            try:
+                opened.add(os.readlink(descriptor))
+            # files closed meanwhile, as the one listing the directory
+            except OSError:
+                continue
+    return opened
+
+
+def release_generation():
+    """Close the idle connections of the engines following the swaps."""
+    for engine in list(followers):
+        engine.dispose()
+
+
+def swap_in(
+    shadow,
+    path=DATABASE_PATH,
+    etl_tables=ETL_TABLES,
+    journal_mode=PROFILES[DEFAULT_PROFILE]["journal_mode"],
+):
+    """
+    Make a shadow database the current generation.
+
+    The live database is locked for writes while its other tables are
+    copied into the shadow and the link is replaced, readers are not
+    blocked. A write waiting for the lock at that time lands in the previous
+    generation, the copy of the small user tables keeps this window short.
+
+    Args:
+        shadow (str): path of the shadow database
+        path (str): path of the database link
+        etl_tables (tuple): tables of the shadow kept as loaded
+        journal_mode (str): journal mode of the new generation, which was
+            loaded without durable journal
+    """
+    path = Path(path)
+    shadow = Path(shadow)
+    with closing(
+        sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    ) as live:
+        live.execute("BEGIN IMMEDIATE")
+        try:
+            with closing(sqlite3.connect(shadow, isolation_level=None)) as conn:
+                conn.execute(f"PRAGMA journal_mode={journal_mode}")
+                conn.execute(
+                    "ATTACH DATABASE ? AS live", (os.path.realpath(path),)
+                )
+                query = (
+                    "SELECT name FROM {}.sqlite_master WHERE type = 'table' "
+                    "AND name NOT LIKE 'sqlite_%'"
+                )
+                shadow_tables = {
+                    name for (name,) in conn.execute(query.format("main"))
+                }
+                conn.execute("BEGIN")
+                for (table,) in conn.execute(query.format("live")).fetchall():
+                    if table in etl_tables or table not in shadow_tables:
+                        continue
+                    conn.execute(f'DELETE FROM main."{table}"')
+                    conn.execute(
+                        f'INSERT INTO main."{table}" '
+                        f'SELECT * FROM live."{table}"'
+                    )
+                conn.execute("COMMIT")
+                conn.execute("DETACH DATABASE live")
+            with open(shadow, "rb") as file:
+                os.fsync(file.fileno())
+            # a link is replaced atomically, a first plain database file too
+            link = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+            os.symlink(shadow.name, link)
+            os.replace(link, path)
+        finally:
+            live.execute("ROLLBACK")
+
+
+def prune_generations(path=DATABASE_PATH, keep=KEEP_GENERATIONS):
+    """
+    Remove the oldest generations of a database, once closed.
+
+    A generation still opened by a process is kept, it is removed by a later
+    call. So are the journals left by the plain database file replaced by
+    the first swap. Without the list of the open files, nothing is removed.
+
+    Args:
+        path (str): path of the database link
+        keep (int): number of generations kept, the current one included
+
+    Returns:
+        list of pathlib.Path: generations and journals removed
+    """
+    opened = open_files()
+    if opened is None:
+        return []
+    path = Path(path)
+    current = Path(os.path.realpath(path))
+    removed = []
+    for old in generations(path)[:-keep]:
+        files = [
+            os.path.realpath(f"{old}{suffix}") for suffix in DATABASE_SUFFIXES
+        ]
+        if old.resolve() != current and opened.isdisjoint(files):
+            _remove(old)
+            removed.append(old)
+    if path.is_symlink():
+        for suffix in DATABASE_SUFFIXES[1:]:
+            journal = Path(os.path.realpath(f"{path}{suffix}"))
+            if journal.exists() and str(journal) not in opened:
+                journal.unlink(missing_ok=True)
+                removed.append(journal)
+    return removed
+
+
+@contextmanager
+def shadow_database(path=DATABASE_PATH, profile=DEFAULT_PROFILE):
+    """
+    Load data into a shadow of the database, swapped in on success.
+
+    Nothing reads the shadow until it is swapped in, and a failed load
+    discards it: it is loaded with the bulk-load storage profile, without
+    durable journal, and gets the journal mode of `profile` at swap time.
+
+    Args:
+        path (str): path of the database link
+        profile (str): storage profile of the app, see storage.PROFILES
+
+    Yields:
+        sqlalchemy engine of the shadow database, a copy of the current one
+    """
+    shadow = create_shadow(path)
+    engine = create_storage_engine(shadow, "bulk-load")
+    try:
+        Base.metadata.create_all(engine)
+        yield engine
+        engine.dispose()
+        swap_in(shadow, path, journal_mode=PROFILES[profile]["journal_mode"])
+    except BaseException:
+        engine.dispose()
+        _remove(shadow)
+        raise
+    release_generation()
+    prune_generations(path)
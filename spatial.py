@@ -0,0 +1,455 @@
+"""Spatial queries of the stations, for the maps.
+
+The pages query a ``StationCatalog``: an immutable copy of the stations
+held in NumPy arrays, sorted by the cell of a uniform grid, built once per
+generation of the data and shared by all the sessions. Viewport and radius
+lookups are then answered from memory, without SQL round trip.
+``CatalogPrices`` adds the prices of the stations of a catalog, to find the
+cheapest stations around a point.
+
+Coordinates are stored as in the feed, in degrees * 100000.
+"""
+
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy as np
+import sqlalchemy as sa
+
+from loader import data_version
+from models import Price, Station
+
+# side of the cells of the grid, in degrees * 100000 (about 11 km)
+CELL_SIZE = 10000
+EARTH_RADIUS_KM = 6371.0088
+# km per degree of latitude
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+class StationRow(NamedTuple):
+    """Station of a viewport, without the ORM bookkeeping."""
+
+    id: int
+    latitude: float
+    longitude: float
+    address: str
+    town: str
+    zip_code: str
+
+
+class NearbyPrice(NamedTuple):
+    """Price of a station around a point."""
+
+    station: StationRow
+    gastype_id: int
+    price: float
+    updated_at: datetime
+    distance_km: float
+
+
+def catalog_generation(conn):
+    """
+    Key of the current version of the stations.
+
+    It changes when a shadow database is swapped in, see shadow.py, or when
+    a load writes the feed in place, see loader.data_version.
+
+    Args:
+        conn: sqlalchemy connection
+
+    Returns:
+        tuple: path of the database file and its data version
+    """
+    database = conn.exec_driver_sql("PRAGMA database_list").first()[2]
+    return database, data_version(conn)
+
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """
+    Great circle distances from a point, vectorized.
+
+    Args:
+        latitude (float): latitude of the point, in degrees
+        longitude (float): longitude of the point, in degrees
+        latitudes (numpy.ndarray): latitudes of the other points, in degrees
+        longitudes (numpy.ndarray): longitudes of the other points
+
+    Returns:
+        numpy.ndarray: distances in km
+    """
+    lat1 = np.radians(latitude)
+    lat2 = np.radians(latitudes)
+    half_dlat = (lat2 - lat1) / 2
+    half_dlon = np.radians(longitudes - longitude) / 2
+    a = (
+        np.sin(half_dlat) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin(half_dlon) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class StationCatalog:
+    """
+    Immutable in-memory copy of the stations, indexed by a uniform grid.
+
+    The stations are sorted by cell, row after row, so that the stations of
+    the cells of a grid row crossed by a viewport are one slice of the
+    arrays, found by binary search.
+
+    Args:
+        ids (array): ids of the stations
+        latitudes (array): latitudes, in degrees * 100000
+        longitudes (array): longitudes, in degrees * 100000
+        addresses (list): addresses of the stations
+        towns (list): towns of the stations
+        zip_codes (list): zip codes of the stations
+        generation: key of the version of the stations, see
+            catalog_generation
+        cell_size (int): side of the cells, in degrees * 100000
+    """
+
+    def __init__(
+        self,
+        ids,
+        latitudes,
+        longitudes,
+        addresses,
+        towns,
+        zip_codes,
+        generation=None,
+        cell_size=CELL_SIZE,
+    ):
+        self.generation = generation
+        self.cell_size = cell_size
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        self.origin = (
+            (latitudes.min(), longitudes.min()) if len(ids) else (0.0, 0.0)
+        )
+        rows, columns = self._cells(latitudes, longitudes)
+        self.columns = int(columns.max()) + 1 if len(ids) else 1
+        keys = rows * self.columns + columns
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.ids = np.asarray(ids, dtype="int64")[order]
+        self.latitudes = latitudes[order]
+        self.longitudes = longitudes[order]
+        self.addresses = np.asarray(addresses, dtype=object)[order]
+        self.towns = np.asarray(towns, dtype=object)[order]
+        self.zip_codes = np.asarray(zip_codes, dtype=object)[order]
+        for array in (
+            self.keys,
+            self.ids,
+            self.latitudes,
+            self.longitudes,
+            self.addresses,
+            self.towns,
+            self.zip_codes,
+        ):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_database(cls, conn, generation=None):
+        """
+        Load the stations of a database.
+
+        Args:
+            conn: sqlalchemy connection
+            generation: key of the version of the stations
+
+        Returns:
+            StationCatalog
+        """
+        stations = Station.__table__
+        rows = conn.execute(
+            sa.select(*(stations.c[name] for name in StationRow._fields))
+        ).all()
+        columns = list(zip(*rows)) if rows else [[] for _ in StationRow._fields]
+        return cls(*columns, generation=generation)
+
+    def _cells(self, latitudes, longitudes):
+        rows = np.floor_divide(latitudes - self.origin[0], self.cell_size)
+        columns = np.floor_divide(longitudes - self.origin[1], self.cell_size)
+        return rows.astype("int64"), columns.astype("int64")
+
+    def _candidates(self, lat_min, lat_max, lon_min, lon_max):
+        # stations of the cells crossed by the box, one slice per grid row
+        (row_min, row_max), (col_min, col_max) = self._cells(
+            np.array([lat_min, lat_max]), np.array([lon_min, lon_max])
+        )
+        col_min = max(col_min, 0)
+        col_max = min(col_max, self.columns - 1)
+        if col_min > col_max or len(self) == 0:
+            return np.empty(0, dtype="int64")
+        row_min = max(row_min, 0)
+        rows = np.arange(row_min, max(row_max + 1, row_min))
+        starts = np.searchsorted(self.keys, rows * self.columns + col_min)
+        stops = np.searchsorted(
+            self.keys, rows * self.columns + col_max, side="right"
+        )
+        slices = [np.arange(a, b) for a, b in zip(starts, stops) if b > a]
+        if not slices:
+            return np.empty(0, dtype="int64")
+        return np.concatenate(slices)
+
+    def near_points(self, latitudes, longitudes, radius_km):
+        """
+        Candidate stations within a distance of some points.
+
+        The stations of the cells of the grid within the distance of a point
+        are returned, a superset of the stations within the distance.
+
+        Args:
+            latitudes (array): latitudes of the points, in degrees
+            longitudes (array): longitudes of the points, in degrees
+            radius_km (float): distance, in km
+
+        Returns:
+            numpy.ndarray: positions of the stations in the catalog
+        """
+        latitudes = np.asarray(latitudes, dtype="float64")
+        longitudes = np.asarray(longitudes, dtype="float64")
+        if len(self) == 0 or len(latitudes) == 0:
+            return np.empty(0, dtype="int64")
+        lat_span = radius_km / KM_PER_DEGREE
+        widest = min(np.abs(latitudes).max() + lat_span, 89.9)
+        lon_span = lat_span / np.cos(np.radians(widest))
+        row_span = int(np.ceil(lat_span * 100000 / self.cell_size))
+        col_span = int(np.ceil(lon_span * 100000 / self.cell_size))
+        rows, columns = self._cells(latitudes * 100000, longitudes * 100000)
+        # every cell around every point
+        row_steps, col_steps = np.meshgrid(
+            np.arange(-row_span, row_span + 1),
+            np.arange(-col_span, col_span + 1),
+            indexing="ij",
+        )
+        rows = (rows[:, None] + row_steps.ravel()).ravel()
+        columns = (columns[:, None] + col_steps.ravel()).ravel()
+        inside = (rows >= 0) & (columns >= 0) & (columns < self.columns)
+        keys = np.unique(rows[inside] * self.columns + columns[inside])
+        starts = np.searchsorted(self.keys, keys)
+        counts = np.searchsorted(self.keys, keys, side="right") - starts
+        # concatenate the slices of the cells
+        ends = np.cumsum(counts)
+        total = int(ends[-1]) if len(ends) else 0
+        return np.repeat(starts - ends + counts, counts) + np.arange(total)
+
+    def in_viewport(self, lat_min, lat_max, lon_min, lon_max):
+        """
+        Stations strictly inside a viewport.
+
+        Args:
+            lat_min (float): south bound, in degrees * 100000
+            lat_max (float): north bound
+            lon_min (float): west bound
+            lon_max (float): east bound
+
+        Returns:
+            numpy.ndarray: positions of the stations in the catalog
+        """
+        candidates = self._candidates(lat_min, lat_max, lon_min, lon_max)
+        latitudes = self.latitudes[candidates]
+        longitudes = self.longitudes[candidates]
+        inside = (
+            (latitudes > lat_min)
+            & (latitudes < lat_max)
+            & (longitudes > lon_min)
+            & (longitudes < lon_max)
+        )
+        return candidates[inside]
+
+    def within_radius(self, latitude, longitude, radius_km):
+        """
+        Stations within a distance of a point, nearest first.
+
+        Args:
+            latitude (float): latitude of the point, in degrees
+            longitude (float): longitude of the point, in degrees
+            radius_km (float): distance, in km
+
+        Returns:
+            tuple: positions of the stations in the catalog and their
+                distances in km, as numpy arrays
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        # the longitude span grows with the latitude, take the widest
+        widest = min(abs(latitude) + lat_span, 89.9)
+        lon_span = lat_span / np.cos(np.radians(widest))
+        candidates = self._candidates(
+            (latitude - lat_span) * 100000,
+            (latitude + lat_span) * 100000,
+            (longitude - lon_span) * 100000,
+            (longitude + lon_span) * 100000,
+        )
+        distances = haversine_km(
+            latitude,
+            longitude,
+            self.latitudes[candidates] / 100000,
+            self.longitudes[candidates] / 100000,
+        )
+        inside = distances <= radius_km
+        order = np.argsort(distances[inside], kind="stable")
+        return candidates[inside][order], distances[inside][order]
+
+    def rows(self, positions):
+        """
+        Stations at positions of the catalog.
+
+        Args:
+            positions (array): positions returned by a lookup
+
+        Returns:
+            list of StationRow
+        """
+        return [
+            StationRow(*values)
+            for values in zip(
+                self.ids[positions].tolist(),
+                self.latitudes[positions].tolist(),
+                self.longitudes[positions].tolist(),
+                self.addresses[positions].tolist(),
+                self.towns[positions].tolist(),
+                self.zip_codes[positions].tolist(),
+            )
+        ]
+
+
+class CatalogPrices:
+    """
+    Prices of the stations of a catalog, one column per gas type.
+
+    The prices are aligned with the positions of the catalog, the prices of
+    the stations found by a radius lookup are then read without join.
+    Missing prices are NaN.
+
+    Args:
+        catalog (StationCatalog): stations of the prices
+        station_ids (array): station of each price
+        gastype_ids (array): gas type of each price, as in the feed
+        prices (array): prices
+        updated_ats (array): update date of each price
+    """
+
+    def __init__(self, catalog, station_ids, gastype_ids, prices, updated_ats):
+        self.catalog = catalog
+        station_ids = np.asarray(station_ids, dtype="int64")
+        gastype_ids = np.asarray(gastype_ids, dtype="int64")
+        self.gastypes = np.unique(gastype_ids)
+        # positions in the catalog of the stations of the prices
+        by_id = np.argsort(catalog.ids)
+        found = np.searchsorted(catalog.ids, station_ids, sorter=by_id)
+        found = np.minimum(found, max(len(catalog) - 1, 0))
+        known = (
+            catalog.ids[by_id[found]] == station_ids
+            if len(catalog)
+            else np.zeros(len(station_ids), dtype=bool)
+        )
+        rows = by_id[found[known]]
+        columns = np.searchsorted(self.gastypes, gastype_ids[known])
+        shape = (len(catalog), len(self.gastypes))
+        self.prices = np.full(shape, np.nan)
+        self.prices[rows, columns] = np.asarray(prices, dtype="float64")[known]
+        self.updated_ats = np.full(shape, np.datetime64("NaT", "s"))
+        self.updated_ats[rows, columns] = np.asarray(
+            updated_ats, dtype="datetime64[s]"
+        )[known]
+        self.prices.flags.writeable = False
+        self.updated_ats.flags.writeable = False
+
+    @classmethod
+    def from_database(cls, conn, catalog):
+        """
+        Load the prices of the stations of a catalog.
+
+        Args:
+            conn: sqlalchemy connection
+            catalog (StationCatalog): catalog of the same database
+
+        Returns:
+            CatalogPrices
+        """
+        prices = Price.__table__
+        rows = conn.execute(
+            sa.select(
+                prices.c.station_id,
+                prices.c.gastype_id,
+                prices.c.price,
+                prices.c.updated_at,
+            )
+        ).all()
+        columns = list(zip(*rows)) if rows else [[], [], [], []]
+        return cls(catalog, *columns)
+
+    def cheapest_nearby(
+        self, latitude, longitude, gastype_ids, radius_km=10, k=5
+    ):
+        """
+        Cheapest stations within a distance of a point, for each gas type.
+
+        Args:
+            latitude (float): latitude of the point, in degrees
+            longitude (float): longitude of the point, in degrees
+            gastype_ids (list): gas types, as in the feed
+            radius_km (float): distance, in km
+            k (int): number of stations per gas type
+
+        Returns:
+            list of NearbyPrice: by gas type, then cheapest first, the
+                nearest first at equal price
+        """
+        positions, distances = self.catalog.within_radius(
+            latitude, longitude, radius_km
+        )
+        nearby = []
+        for gastype_id in gastype_ids:
+            # the stations are sorted by distance, the nearest come first at
+            # equal price
+            best, prices, updated_ats = self.cheapest(positions, gastype_id, k)
+            for station, price, updated_at, distance in zip(
+                self.catalog.rows(positions[best]),
+                prices,
+                updated_ats,
+                distances[best].tolist(),
+            ):
+                nearby.append(
+                    NearbyPrice(
+                        station, int(gastype_id), price, updated_at, distance
+                    )
+                )
+        return nearby
+
+    def cheapest(self, positions, gastype_id, k=5, ties=None):
+        """
+        Cheapest of some stations for a gas type.
+
+        Args:
+            positions (array): positions of the stations in the catalog
+            gastype_id (int): gas type, as in the feed
+            k (int): number of stations
+            ties (array): order of the stations of equal price, aligned with
+                positions, default to the order of positions
+
+        Returns:
+            tuple: indexes in positions of the cheapest stations, cheapest
+                first, with their prices and update dates as lists
+        """
+        column = np.searchsorted(self.gastypes, int(gastype_id))
+        if column == len(self.gastypes) or self.gastypes[column] != int(
+            gastype_id
+        ):
+            return np.empty(0, dtype="int64"), [], []
+        prices = self.prices[positions, column]
+        sold = np.flatnonzero(~np.isnan(prices))
+        if ties is None:
+            order = np.argsort(prices[sold], kind="stable")
+        else:
+            order = np.lexsort((np.asarray(ties)[sold], prices[sold]))
+        best = sold[order[:k]]
+        return (
+            best,
+            prices[best].tolist(),
+            self.updated_ats[positions[best], column].tolist(),
+        )
@@ -0,0 +1,131 @@
+"""Columnar staging of the station records before they are written.
+
+The records of a batch are gathered into pandas columns, converted and
+validated with vectorized operations and masks, instead of converting each
+attribute of each price in a Python loop.
+"""
+
+from typing import NamedTuple
+
+import pandas as pd
+
+# dates are "2024-01-02 07:53:00" in the live feed and "2024-01-02T07:53:00"
+# in the yearly and daily archives
+MAJ_FORMAT = "ISO8601"
+# older archives give prices in thousandths of euro, such as "1869"
+MILLIEME_THRESHOLD = 100
+# prices out of this range (in € per liter) are errors of the stations, such
+# as the 0 € or 10 € prices of a fuel out of stock
+MIN_PRICE = 0.1
+MAX_PRICE = 5.0
+
+STATION_FIELDS = ("id", "latitude", "longitude", "address", "town", "zip_code")
+PRICE_FIELDS = ("station_id", "gastype_id", "price", "updated_at")
+
+
+class StagedBatch(NamedTuple):
+    """Converted and validated rows of a batch of station records."""
+
+    # valid stations, columns of STATION_FIELDS
+    stations: pd.DataFrame
+    # valid prices of the valid stations, columns of PRICE_FIELDS
+    prices: pd.DataFrame
+    # stations missing a mandatory field
+    rejected: int
+    # prices of the valid stations with a missing or out of range value
+    invalid_prices: int
+
+    def station_rows(self):
+        """
+        Rows of the stations table.
+
+        Returns:
+            list of dict
+        """
+        return _rows(self.stations)
+
+    def price_rows(self):
+        """
+        Rows of the prices table.
+
+        Returns:
+            list of dict
+        """
+        return _rows(self.prices)
+
+
+def _rows(frame):
+    # faster than DataFrame.to_dict, values are converted column by column
+    columns = [
+        frame[name].dt.to_pydatetime().tolist()
+        if pd.api.types.is_datetime64_dtype(frame[name])
+        else frame[name].tolist()
+        for name in frame.columns
+    ]
+    names = list(frame.columns)
+    return [dict(zip(names, values)) for values in zip(*columns)]
+
+
+def _to_float(column):
+    # astype is an order of magnitude faster than to_numeric, which is only
+    # needed to turn malformed values into NaN
+    try:
+        return column.astype("float64")
+    except (TypeError, ValueError):
+        return pd.to_numeric(column, errors="coerce")
+
+
+def stage_records(records, min_price=MIN_PRICE, max_price=MAX_PRICE):
+    """
+    Convert and validate a batch of station records as columns.
+
+    Args:
+        records (list): parsers.StationRecord of the batch
+        min_price (float): lowest valid price, in € per liter
+        max_price (float): highest valid price, in € per liter
+
+    Returns:
+        StagedBatch
+    """
+    stations = pd.DataFrame.from_records(
+        [record[:6] for record in records], columns=STATION_FIELDS
+    )
+    for column in ("id", "latitude", "longitude"):
+        stations[column] = _to_float(stations[column])
+    valid = (
+        stations[["id", "latitude", "longitude", "address", "town"]]
+        .notna()
+        .all(axis=1)
+    )
+    stations = stations[valid].astype({"id": "int64"})
+
+    prices = pd.DataFrame.from_records(
+        [
+            (record.id, gastype_id, valeur, maj)
+            for record in records
+            for gastype_id, valeur, maj in record.prices
+        ],
+        columns=PRICE_FIELDS,
+    )
+    prices["station_id"] = _to_float(prices["station_id"])
+    # prices of the rejected stations are not counted as invalid
+    prices = prices[prices["station_id"].isin(stations["id"])].copy()
+    prices["gastype_id"] = _to_float(prices["gastype_id"])
+    prices["price"] = _to_float(prices["price"])
+    prices.loc[prices["price"] > MILLIEME_THRESHOLD, "price"] /= 1000
+    prices["updated_at"] = pd.to_datetime(
+        prices["updated_at"], format=MAJ_FORMAT, errors="coerce"
+    )
+    valid_prices = (
+        prices.notna().all(axis=1)
+        & (prices["price"] > min_price)
+        & (prices["price"] < max_price)
+    )
+    return StagedBatch(
+        stations=stations,
+        prices=prices[valid_prices].astype(
+            {"station_id": "int64", "gastype_id": "int64"}
+        ),
+        rejected=int((~valid).sum()),
+        invalid_prices=int((~valid_prices).sum()),
+    )
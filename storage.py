@@ -0,0 +1,164 @@
+"""SQLite storage profiles and the engines of the app.
+
+The pragmas of the database connections are set in one place, by named
+profiles:
+
+- ``dev``: write-ahead log, so that readers and the writer do not block
+  each other, with a small cache;
+- ``prod``: same, with a larger page cache, memory mapped reads and
+  temporary tables in memory;
+- ``bulk-load``: no durable journal, for a database nothing reads while it
+  is loaded, such as the shadow database of an ingest (see shadow.py);
+- ``bulk-write``: write-ahead log with a large cache, for the databases
+  receiving large batches of rows while they are read, such as the price
+  history (see history.py).
+
+The app uses two engines on the same file: a pooled reader engine whose
+connections are ``query_only``, for the queries of the pages, and a writer
+engine for the ETL and the changes made by the users. With the write-ahead
+log, page queries read the last committed snapshot while the writer works,
+instead of failing with "database is locked". The database file alone can
+then miss the last commits, still in the log: ``snapshot_database`` copies
+it as of its last commit.
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+
+import sqlalchemy as sa
+
+PROFILES = {
+    "dev": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -16000,  # in KiB when negative
+        "mmap_size": 0,
+        "temp_store": "DEFAULT",
+    },
+    "prod": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 15000,
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+    "bulk-write": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 60000,
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+    "bulk-load": {
+        "journal_mode": "MEMORY",
+        "synchronous": "OFF",
+        "busy_timeout": 60000,
+        "cache_size": -256000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    },
+}
+DEFAULT_PROFILE = os.getenv("STORAGE_PROFILE", "dev")
+
+
+def apply_profile(dbapi_connection, profile=DEFAULT_PROFILE, read_only=False):
+    """
+    Set the pragmas of a profile on a sqlite3 connection.
+
+    Args:
+        dbapi_connection: sqlite3 connection
+        profile (str): one of PROFILES keys
+        read_only (bool): refuse any change of the database, the journal
+            mode, stored in the database file, is left to the writer
+    """
+    pragmas = dict(PROFILES[profile])
+    if read_only:
+        del pragmas["journal_mode"]
+        pragmas["query_only"] = "ON"
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def create_storage_engine(
+    path, profile=DEFAULT_PROFILE, read_only=False, **kwargs
+):
+    """
+    Create an engine whose connections use a storage profile.
+
+    Args:
+        path (str): path of the SQLite database
+        profile (str): one of PROFILES keys
+        read_only (bool): open query_only connections
+        kwargs: options of sqlalchemy.create_engine
+
+    Returns:
+        sqlalchemy engine
+    """
+    if profile not in PROFILES:
+        raise ValueError(
+            f"Unknown storage profile {profile}, expected one of "
+            f"{', '.join(PROFILES)}"
+        )
+    engine = sa.create_engine(f"sqlite:///{path}", **kwargs)
+
+    @sa.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        apply_profile(dbapi_connection, profile, read_only=read_only)
+
+    return engine
+
+
+def create_writer_engine(path, profile=DEFAULT_PROFILE):
+    """
+    Engine of the ETL and of the changes made by the users.
+
+    Args:
+        path (str): path of the SQLite database
+        profile (str): one of PROFILES keys
+
+    Returns:
+        sqlalchemy engine
+    """
+    return create_storage_engine(path, profile, pool_pre_ping=True)
+
+
+def create_reader_engine(path, profile=DEFAULT_PROFILE):
+    """
+    Engine of the queries of the pages, which cannot change the database.
+
+    Args:
+        path (str): path of the SQLite database
+        profile (str): one of PROFILES keys
+
+    Returns:
+        sqlalchemy engine
+    """
+    return create_storage_engine(
+        path, profile, read_only=True, pool_pre_ping=True
+    )
+
+
+def snapshot_database(engine, target):
+    """
+    Copy a database to a single file, as of its last commit.
+
+    The copy goes through the backup API of SQLite, on a connection of the
+    engine: it holds the commits still in the write-ahead log, and the
+    current generation of the database when its path is a link.
+
+    Args:
+        engine: sqlalchemy engine of the database
+        target (str): path of the copy
+    """
+    connection = engine.raw_connection()
+    try:
+        with closing(sqlite3.connect(target)) as copy:
+            connection.driver_connection.backup(copy)
+    finally:
+        connection.close()
@@ -0,0 +1,236 @@
+"""Synthetic PrixCarburants feeds, to measure the ETL without the live feed.
+
+A feed is fully determined by its number of stations, its seed and its run.
+Run 0 is the initial state, each following run changes the price of a share
+of the (station, fuel) pairs, as the live feed does between two ETL jobs.
+
+Usage:
+    python synthetic.py --stations 10000 --runs 2 --changes 0.1 --output feeds
+"""
+
+import argparse
+import zipfile
+from contextlib import ExitStack
+from pathlib import Path
+
+import numpy as np
+
+MEMBER_NAME = "PrixCarburants_instantane_ruptures.xml"
+FIRST_ID = 1000001
+START = np.datetime64("2024-01-01T00:00:00")
+RUN_INTERVAL = 6 * 3600  # seconds between two runs, as the ETL job
+# coordinates of the stations, in degrees * 100000 as in the live feed
+LATITUDES = (4230000, 5110000)
+LONGITUDES = (-480000, 820000)
+# (id, name, mean price, share of the stations selling it)
+FUELS = [
+    (1, "Gazole", 1.72, 0.97),
+    (2, "SP95", 1.86, 0.55),
+    (3, "E85", 0.86, 0.30),
+    (4, "GPLc", 0.99, 0.15),
+    (5, "E10", 1.81, 0.85),
+    (6, "SP98", 1.93, 0.80),
+]
+TOWNS = [
+    ("01000", "BOURG-EN-BRESSE"),
+    ("13001", "MARSEILLE"),
+    ("30000", "NÎMES"),
+    ("42000", "SAINT-ÉTIENNE"),
+    ("44000", "NANTES"),
+    ("49000", "ANGERS"),
+    ("69001", "LYON"),
+    ("75015", "PARIS"),
+    ("97400", "SAINT-DENIS"),
+]
+STREETS = [
+    "AVENUE DE LA RÉPUBLIQUE",
+    "ROUTE NATIONALE 7",
+    "RUE DU GÉNÉRAL DE GAULLE",
+    "BOULEVARD JEAN JAURÈS",
+    "ZONE COMMERCIALE DES PRÉS",
+]
+SERVICES = (
+    "<services><service>Boutique alimentaire</service>"
+    "<service>Station de gonflage</service>"
+    "<service>Automate CB 24/24</service></services>"
+)
+HOURS = (
+    '<horaires automate-24-24="1">'
+    + "".join(
+        f'<jour id="{day}" nom="{name}" ferme="">'
+        '<horaire ouverture="07.00" fermeture="20.00"/></jour>'
+        for day, name in enumerate(
+            ["Lundi", "Mardi", "Mercredi", "Jeudi", "Vendredi", "Samedi"], 1
+        )
+    )
+    + "</horaires>"
+)
+WRITE_BATCH = 1000  # stations formatted and written at once
+
+
+def feed_state(stations, run=0, changes=0.1, seed=0):
+    """
+    Prices and dates of the stations at a run.
+
+    Args:
+        stations (int): number of stations
+        run (int): index of the run, 0 for the initial state
+        changes (float): share of the prices changed at each run
+        seed (int): seed of the random generator
+
+    Returns:
+        dict: arrays of the stations (id, latitude, longitude, town, street)
+            and of their prices (sold, price, updated_at), the latter of
+            shape (stations, fuels)
+    """
+    rng = np.random.default_rng(seed)
+    shape = (stations, len(FUELS))
+    # draw the coordinates until they are unique, as in the database
+    cells = np.unique(
+        rng.integers(
+            0,
+            (LATITUDES[1] - LATITUDES[0]) * (LONGITUDES[1] - LONGITUDES[0]),
+            stations * 2,
+        )
+    )
+    cells = rng.permutation(cells)[:stations]
+    latitude, longitude = np.divmod(cells, LONGITUDES[1] - LONGITUDES[0])
+    means = np.array([fuel[2] for fuel in FUELS])
+    shares = np.array([fuel[3] for fuel in FUELS])
+    state = {
+        "id": FIRST_ID + np.arange(stations),
+        "latitude": latitude + LATITUDES[0],
+        "longitude": longitude + LONGITUDES[0],
+        "town": rng.integers(0, len(TOWNS), stations),
+        "street": rng.integers(0, len(STREETS), stations),
+        "sold": rng.random(shape) < shares,
+        "price": means + rng.normal(0, 0.05, shape),
+        "updated_at": START
+        + rng.integers(0, RUN_INTERVAL, shape).astype("timedelta64[s]"),
+    }
+    for index in range(1, run + 1):
+        run_rng = np.random.default_rng([seed, index])
+        changed = run_rng.random(shape) < changes
+        state["price"] = np.where(
+            changed, means + run_rng.normal(0, 0.05, shape), state["price"]
+        )
+        state["updated_at"] = np.where(
+            changed,
+            START
+            + np.timedelta64(index * RUN_INTERVAL, "s")
+            + run_rng.integers(0, RUN_INTERVAL, shape).astype("timedelta64[s]"),
+            state["updated_at"],
+        )
+    return state
+
+
+def _format_stations(state, start, stop):
+    updated_at = np.char.replace(
+        np.datetime_as_string(state["updated_at"][start:stop], unit="s"),
+        "T",
+        " ",
+    )
+    parts = []
+    for row in range(start, stop):
+        zip_code, town = TOWNS[state["town"][row]]
+        prices = "".join(
+            f'<prix nom="{name}" id="{fuel_id}" '
+            f'maj="{updated_at[row - start, column]}" '
+            f'valeur="{state["price"][row, column]:.3f}"/>'
+            if state["sold"][row, column]
+            else f'<rupture id="{fuel_id}" nom="{name}" '
+            'debut="2023-12-01 10:00:00" fin="" type="definitive"/>'
+            for column, (fuel_id, name, _, _) in enumerate(FUELS)
+        )
+        parts.append(
+            f'<pdv id="{state["id"][row]}" '
+            f'latitude="{state["latitude"][row]}" '
+            f'longitude="{state["longitude"][row]}" '
+            f'cp="{zip_code}" pop="R">'
+            f"<adresse>{row} {STREETS[state['street'][row]]}</adresse>"
+            f"<ville>{town}</ville>{HOURS}{SERVICES}{prices}</pdv>\n"
+        )
+    return "".join(parts).encode("iso-8859-1")
+
+
+def write_feed(path, stations, run=0, changes=0.1, seed=0):
+    """
+    Write a synthetic feed, zipped like the live one if the path ends with
+    ``.zip``.
+
+    Args:
+        path (str): path of the feed
+        stations (int): number of stations
+        run (int): index of the run, 0 for the initial state
+        changes (float): share of the prices changed at each run
+        seed (int): seed of the random generator
+
+    Returns:
+        pathlib.Path
+    """
+    path = Path(path)
+    state = feed_state(stations, run=run, changes=changes, seed=seed)
+    header = b'<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>\n'
+    with ExitStack() as stack:
+        if path.suffix == ".zip":
+            archive = stack.enter_context(
+                zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+            )
+            output = stack.enter_context(
+                archive.open(MEMBER_NAME, "w", force_zip64=True)
+            )
+        else:
+            output = stack.enter_context(open(path, "wb"))
+        output.write(header + b"<pdv_liste>\n")
+        for start in range(0, stations, WRITE_BATCH):
+            stop = min(start + WRITE_BATCH, stations)
+            output.write(_format_stations(state, start, stop))
+        output.write(b"</pdv_liste>\n")
+    return path
+
+
+def write_runs(directory, stations, runs=2, changes=0.1, seed=0):
+    """
+    Write the zipped feeds of consecutive runs.
+
+    Args:
+        directory (str): directory of the feeds
+        stations (int): number of stations
+        runs (int): number of feeds
+        changes (float): share of the prices changed at each run
+        seed (int): seed of the random generator
+
+    Returns:
+        list of pathlib.Path
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    return [
+        write_feed(
+            directory / f"feed-{stations}-{run}.zip",
+            stations,
+            run=run,
+            changes=changes,
+            seed=seed,
+        )
+        for run in range(runs)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=2)
+    parser.add_argument(
+        "--changes",
+        type=float,
+        default=0.1,
+        help="share of the prices changed at each run",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="feeds")
+    args = parser.parse_args()
+    for path in write_runs(
+        args.output, args.stations, args.runs, args.changes, args.seed
+    ):
+        print(f"Feed written to {path}")
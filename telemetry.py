@@ -0,0 +1,226 @@
+"""Structured telemetry of the ETL runs.
+
+Each run of the ETL job is recorded as a row of the ``etl_runs`` table: it is
+inserted when the run starts, its progress and memory are updated every few
+seconds while the pipeline runs, and the time spent in each stage and the
+rows written are filled in when it ends. The admin page renders these rows
+as a timeline, see ``load_runs``.
+"""
+
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+import pandas as pd
+import psutil
+import sqlalchemy as sa
+
+from models import EtlRun
+
+HEARTBEAT_SECONDS = 2.0
+# a running job without update for longer than this has died
+STALE_AFTER = timedelta(minutes=2)
+STAGE_COLUMNS = (
+    "download_seconds",
+    "parse_seconds",
+    "lock_wait_seconds",
+    "write_seconds",
+    "commit_seconds",
+)
+
+
+def process_rss_mb(process=None):
+    """
+    Resident set size of a process and of its children, in MB.
+
+    The parsing workers of the pipeline are child processes, their memory is
+    part of the footprint of the run.
+
+    Args:
+        process (psutil.Process): default to the current process
+
+    Returns:
+        float
+    """
+    process = process or psutil.Process()
+    rss = process.memory_info().rss
+    for child in process.children(recursive=True):
+        try:
+            rss += child.memory_info().rss
+        except psutil.Error:
+            # the child exited in the meantime
+            continue
+    return rss / 1024 / 1024
+
+
+def run_metrics(stats):
+    """
+    Columns of the etl_runs table from the counters of a pipeline run.
+
+    Args:
+        stats (dict): counters returned by pipeline.run_pipeline
+
+    Returns:
+        dict
+    """
+    fetch = stats["stages"]["fetch"]
+    parse = stats["stages"]["parse"]
+    metrics = {
+        "feed_bytes": fetch["bytes"],
+        "stations_processed": parse["items"],
+        # time the stages spent working, not blocked on their queues
+        "download_seconds": max(fetch["seconds"] - fetch["waiting"], 0.0),
+        "parse_seconds": max(parse["seconds"] - parse["waiting"], 0.0),
+        "write_seconds": stats["write_seconds"],
+        "commit_seconds": stats["commit_seconds"],
+        "lock_wait_seconds": stats["lock_seconds"],
+    }
+    for table in ("stations", "prices"):
+        for key, count in stats[table].items():
+            metrics[f"{table}_{key}"] = count
+    return metrics
+
+
+class EtlRunRecorder:
+    """
+    Record a run of the ETL job in the etl_runs table.
+
+    Used as a context manager around the run. ``watch`` is given to
+    pipeline.run_pipeline as ``on_start`` to follow the progress of the
+    stages, ``finish`` or ``skip`` close the run. A run leaving the context
+    with an exception is recorded as failed, and the exception is raised.
+
+    Args:
+        engine: sqlalchemy engine of the database
+        interval (float): seconds between two progress updates
+    """
+
+    def __init__(self, engine, interval=HEARTBEAT_SECONDS):
+        self.engine = engine
+        self.interval = interval
+        self.table = EtlRun.__table__
+        self.run_id = None
+        self.stages = []
+        self.status = None
+        self.metrics = {}
+        self.peak_rss_mb = 0.0
+        self.done = threading.Event()
+        self.sampler = threading.Thread(
+            target=self._sample_loop, name="etl-telemetry", daemon=True
+        )
+
+    def __enter__(self):
+        self.table.create(self.engine, checkfirst=True)
+        now = datetime.now()
+        self.peak_rss_mb = process_rss_mb()
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                self.table.insert().values(
+                    started_at=now,
+                    updated_at=now,
+                    status="running",
+                    feed_bytes=0,
+                    stations_processed=0,
+                    peak_rss_mb=self.peak_rss_mb,
+                )
+            )
+            self.run_id = result.inserted_primary_key[0]
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.done.set()
+        self.sampler.join()
+        values = {**self._progress(), **self.metrics}
+        if exc_type is not None:
+            values["status"] = "failed"
+            values["error"] = "".join(
+                traceback.format_exception_only(exc_type, exc_value)
+            ).strip()
+        else:
+            values["status"] = self.status or "success"
+        values["finished_at"] = values["updated_at"]
+        self._update(values)
+        return False
+
+    def watch(self, stages):
+        """
+        Follow the counters of the running stages.
+
+        Args:
+            stages (list): pipeline.Stage of the run
+        """
+        self.stages = stages
+
+    def finish(self, stats):
+        """
+        Record the metrics of a completed run.
+
+        Args:
+            stats (dict): counters returned by pipeline.run_pipeline
+        """
+        self.status = "success"
+        self.metrics = run_metrics(stats)
+
+    def skip(self):
+        """Record a run skipped as the feed did not change."""
+        self.status = "skipped"
+
+    def _progress(self):
+        self.peak_rss_mb = max(self.peak_rss_mb, process_rss_mb())
+        values = {"updated_at": datetime.now(), "peak_rss_mb": self.peak_rss_mb}
+        for stage in self.stages:
+            if stage.stage_name == "fetch":
+                values["feed_bytes"] = stage.bytes
+            elif stage.stage_name == "parse":
+                values["stations_processed"] = stage.items
+        return values
+
+    def _sample_loop(self):
+        while not self.done.wait(self.interval):
+            try:
+                self._update(self._progress())
+            except sa.exc.OperationalError:
+                # the database is locked by the loader, the next sample
+                # catches up
+                continue
+
+    def _update(self, values):
+        with self.engine.begin() as conn:
+            conn.execute(
+                self.table.update()
+                .where(self.table.c.id == self.run_id)
+                .values(**values)
+            )
+
+
+def load_runs(engine, limit=50):
+    """
+    Most recent runs of the ETL job.
+
+    Running jobs without update for longer than STALE_AFTER are reported
+    with the "stalled" status.
+
+    Args:
+        engine: sqlalchemy engine of the database
+        limit (int): number of runs
+
+    Returns:
+        pandas.DataFrame: one row per run, most recent first, with the
+            duration of the run in "seconds"
+    """
+    table = EtlRun.__table__
+    with engine.connect() as conn:
+        runs = pd.read_sql(
+            sa.select(table).order_by(table.c.id.desc()).limit(limit), conn
+        )
+    for column in ("started_at", "updated_at", "finished_at"):
+        runs[column] = pd.to_datetime(runs[column])
+    stalled = (runs["status"] == "running") & (
+        runs["updated_at"] < datetime.now() - STALE_AFTER
+    )
+    runs.loc[stalled, "status"] = "stalled"
+    runs["seconds"] = (
+        runs["finished_at"].fillna(runs["updated_at"]) - runs["started_at"]
+    ).dt.total_seconds()
+    return runs
@@ -1,10 +1,159 @@
+import io
+import json
+import sqlite3
+import threading
+import zipfile
+from contextlib import closing
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from importlib.metadata import version
 from pathlib import Path
 
+import folium
+import numpy as np
+import pandas as pd
 import pytest
 import requests
+import sqlalchemy as sa
 from streamlit.testing.v1 import AppTest
 
+import fetch
+from clusters import MAX_ZOOM, MIN_ZOOM, ClusterPyramid, cell_size
+from corpus import Corpus, replay
+from fetch import ZipMemberReader, open_feed
+from history import (
+    ParquetHistoryStore,
+    SQLiteHistoryStore,
+    backfill,
+    open_archive,
+    price_history,
+)
+from loader import BulkLoader, load_records
+from markers import MARKER_MODES, stations_layer
+from models import (
+    Base,
+    CustomStation,
+    GasType,
+    Price,
+    Station,
+    User,
+)
+from parsers import PARSER_BACKENDS, StationRecord, iter_stations
+from pipeline import run_pipeline, split_feed
+from routes import cheapest_along, read_route
+from shadow import (
+    GenerationSwapped,
+    follow_swaps,
+    generations,
+    prune_generations,
+    shadow_database,
+)
+from spatial import (
+    CatalogPrices,
+    StationCatalog,
+    StationRow,
+    catalog_generation,
+    haversine_km,
+)
+from staging import stage_records
+from storage import (
+    create_reader_engine,
+    create_writer_engine,
+    snapshot_database,
+)
+from synthetic import write_runs
+from telemetry import EtlRunRecorder, load_runs
+from tiles import TileStore, station_features, tiles_in_bounds
+from viewport import ViewportState
+
+SAMPLE_FEED = """<?xml version="1.0" encoding="ISO-8859-1" standalone="yes"?>
+<pdv_liste>
+  <pdv id="1000001" latitude="4620100" longitude="519800" cp="01000" pop="R">
+    <adresse>596 AVENUE DE TREVOUX</adresse>
+    <ville>SAINT-DENIS-LÈS-BOURG</ville>
+    <horaires automate-24-24="1"><jour id="1" nom="Lundi" ferme=""/></horaires>
+    <services><service>Station de gonflage</service></services>
+    <prix nom="Gazole" id="1" maj="2024-01-02 07:53:00" valeur="1.869"/>
+    <prix nom="SP95" id="2" maj="2024-01-02 07:53:00" valeur="1.899"/>
+    <rupture id="3" nom="E85" debut="2023-12-01 10:00:00" fin=""/>
+  </pdv>
+  <pdv id="1000002" latitude="4621842.23" longitude="522767.38" cp="01000">
+    <adresse>16 Avenue de Marboz</adresse>
+    <ville>BOURG-EN-BRESSE</ville>
+    <prix nom="E10" id="5" maj="2024-01-03 09:00:00" valeur="1.759"/>
+  </pdv>
+</pdv_liste>
+""".encode("iso-8859-1")
+
+
+class _Unseekable(io.RawIOBase):
+    # zipfile writes a data descriptor after the member on such streams
+    def __init__(self):
+        self.data = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+def make_archive(payload, seekable=True):
+    buffer = io.BytesIO() if seekable else _Unseekable()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("PrixCarburants_instantane_ruptures.xml", payload)
+    return bytes(buffer.getvalue() if seekable else buffer.data)
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if server.etag and self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = server.payload
+        start = 0
+        if self.headers.get("Range") and server.ranges:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}"
+            )
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        if server.etag:
+            self.send_header("ETag", server.etag)
+        self.end_headers()
+        data = body[start:]
+        if server.cut_after:
+            # drop the connection in the middle of the body
+            data, server.cut_after = data[: server.cut_after], None
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def feed_server():
+    """Local stand-in of the fuel feed server."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    server.payload = make_archive(SAMPLE_FEED)
+    server.requests = []
+    server.ranges = True
+    server.cut_after = None
+    server.etag = None
+    server.url = f"http://127.0.0.1:{server.server_port}/instantane_ruptures"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
 
 @pytest.fixture
 def mock_load_mode(monkeypatch):
@@ -34,6 +183,14 @@ preauthorized:
     monkeypatch.setattr("utils.CONFIG_PATH", Path(mock_config))
 
 
+@pytest.fixture
+def db_engine(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'db.sqlite3'}")
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
 @pytest.fixture
 def mock_config_path_dynamically(monkeypatch, tmpdir):
     mock_config = tmpdir.join("config.yaml")
@@ -52,6 +209,864 @@ def test_dummy():
     assert True
 
 
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_parser_backends(tmp_path, backend):
+    if backend == "lxml":
+        pytest.importorskip("lxml")
+    xmlfile = tmp_path / "feed.xml"
+    xmlfile.write_bytes(SAMPLE_FEED)
+    records = list(iter_stations(str(xmlfile), backend=backend))
+    assert records == [
+        StationRecord(
+            id="1000001",
+            latitude="4620100",
+            longitude="519800",
+            address="596 AVENUE DE TREVOUX",
+            town="SAINT-DENIS-L\xc8S-BOURG",
+            zip_code="01000",
+            prices=[
+                ("1", "1.869", "2024-01-02 07:53:00"),
+                ("2", "1.899", "2024-01-02 07:53:00"),
+            ],
+        ),
+        StationRecord(
+            id="1000002",
+            latitude="4621842.23",
+            longitude="522767.38",
+            address="16 Avenue de Marboz",
+            town="BOURG-EN-BRESSE",
+            zip_code="01000",
+            prices=[("5", "1.759", "2024-01-03 09:00:00")],
+        ),
+    ]
+    # file objects are streamed the same way
+    with open(xmlfile, "rb") as file:
+        assert list(iter_stations(file, backend=backend)) == records
+
+
+@pytest.mark.parametrize("seekable", [True, False])
+def test_zip_member_reader(seekable):
+    archive = make_archive(SAMPLE_FEED, seekable=seekable)
+    member = ZipMemberReader(io.BytesIO(archive))
+    assert member.has_data_descriptor is not seekable
+    assert member.name == "PrixCarburants_instantane_ruptures.xml"
+    assert io.BufferedReader(member).read() == SAMPLE_FEED
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_open_feed_resumes_download(monkeypatch, feed_server, ranges):
+    monkeypatch.setattr(fetch, "BACKOFF_SECONDS", 0)
+    # small chunks, so that some of them are received before the cut
+    monkeypatch.setattr(fetch, "CHUNK_SIZE", 16)
+    feed_server.ranges = ranges
+    feed_server.cut_after = 100
+    with open_feed(feed_server.url) as response:
+        records = list(iter_stations(response.stream))
+    assert [record.id for record in records] == ["1000001", "1000002"]
+    assert len(feed_server.requests) == 2
+    # resumed from the last complete chunk
+    assert feed_server.requests[1]["Range"] == "bytes=96-"
+
+
+def test_open_feed_not_modified(feed_server):
+    feed_server.etag = '"v1"'
+    with open_feed(feed_server.url) as response:
+        assert len(list(iter_stations(response.stream))) == 2
+    assert response.validators["etag"] == '"v1"'
+    with open_feed(feed_server.url, validators=response.validators) as again:
+        assert again.stream is None
+    assert feed_server.requests[-1]["If-None-Match"] == '"v1"'
+
+
+def test_open_feed_same_content(feed_server):
+    # without validators from the server, the zip checksum is compared
+    with open_feed(feed_server.url) as response:
+        assert len(list(iter_stations(response.stream))) == 2
+    assert response.validators["content_hash"]
+    with open_feed(feed_server.url, validators=response.validators) as again:
+        assert again.stream is None
+    feed_server.payload = make_archive(
+        SAMPLE_FEED.replace(b'valeur="1.869"', b'valeur="1.759"')
+    )
+    with open_feed(feed_server.url, validators=response.validators) as again:
+        assert again.stream is not None
+
+
+def test_record_and_replay(tmp_path, feed_server, db_engine):
+    corpus = Corpus(tmp_path / "corpus")
+    first = corpus.record(feed_server.url)
+    # the same archive is stored once, each download is indexed
+    assert corpus.record(feed_server.url)["sha256"] == first["sha256"]
+    feed_server.payload = make_archive(
+        SAMPLE_FEED.replace(
+            b'maj="2024-01-02 07:53:00" valeur="1.869"',
+            b'maj="2024-01-04 07:53:00" valeur="1.759"',
+        )
+    )
+    second = corpus.record(feed_server.url)
+    assert len(corpus.entries()) == 3
+    assert len(list(corpus.root.glob("*.zip"))) == 2
+    assert corpus.sequence() == [first["sha256"], second["sha256"]]
+
+    results = replay(corpus, db_engine)
+    assert results[0]["prices"]["inserted"] == 3
+    assert results[1]["prices"] == {"inserted": 0, "updated": 1, "skipped": 2}
+    # a chosen sequence, by hash prefixes
+    results = replay(corpus, db_engine, archives=[first["sha256"][:8]])
+    assert results[0]["prices"]["skipped"] == 3
+
+
+def test_load_records(tmp_path, db_engine):
+    xmlfile = tmp_path / "feed.xml"
+    xmlfile.write_bytes(SAMPLE_FEED)
+    commits = []
+    sa.event.listen(db_engine, "commit", lambda conn: commits.append(conn))
+    stats = load_records(iter_stations(str(xmlfile)), db_engine, batch_size=1)
+    assert stats["stations"]["inserted"] == 2
+    assert stats["prices"]["inserted"] == 3
+    # one transaction per batch, not per row, and one for the data version
+    assert stats["batches"] == 2
+    assert len(commits) == stats["batches"] + 1
+
+    # unchanged rows are not written again
+    commits.clear()
+    stats = load_records(iter_stations(str(xmlfile)), db_engine)
+    assert stats["stations"] == {"inserted": 0, "updated": 0, "skipped": 2}
+    assert stats["prices"] == {"inserted": 0, "updated": 0, "skipped": 3}
+    assert commits == []
+
+    # only prices with a newer date are updated
+    updated = SAMPLE_FEED.replace(
+        b'maj="2024-01-02 07:53:00" valeur="1.869"',
+        b'maj="2024-01-04 07:53:00" valeur="1.759"',
+    ).replace(b'valeur="1.899"', b'valeur="1.999"')
+    xmlfile.write_bytes(updated)
+    stats = load_records(iter_stations(str(xmlfile)), db_engine)
+    assert stats["prices"] == {"inserted": 0, "updated": 1, "skipped": 2}
+    with db_engine.connect() as conn:
+        assert conn.execute(sa.select(sa.func.count(Station.id))).scalar() == 2
+        prices = conn.execute(
+            sa.select(Price.price)
+            .where(Price.station_id == 1000001)
+            .order_by(Price.gastype_id)
+        ).scalars()
+        assert list(prices) == [1.759, 1.899]
+
+
+def test_load_records_collision(db_engine):
+    # a third station at the coordinates of the first one
+    feed = SAMPLE_FEED.replace(
+        b"</pdv_liste>",
+        b"""<pdv id="1000003" latitude="4620100" longitude="519800" cp="01000">
+    <adresse>1 rue</adresse><ville>BOURG</ville>
+    <prix nom="Gazole" id="1" maj="2024-01-02 08:00:00" valeur="1.5"/>
+  </pdv>
+</pdv_liste>""",
+    )
+    stats = load_records(iter_stations(io.BytesIO(feed)), db_engine)
+    assert stats["stations"]["inserted"] == 2
+    assert stats["prices"]["inserted"] == 3
+    assert stats["rejected"] == 1
+    with db_engine.connect() as conn:
+        # no price without its station
+        assert (
+            conn.execute(
+                sa.select(sa.func.count()).where(Price.station_id == 1000003)
+            ).scalar()
+            == 0
+        )
+
+
+def test_bulk_loader_rollback(db_engine):
+    batch = stage_records(list(iter_stations(io.BytesIO(SAMPLE_FEED))))
+    loader = BulkLoader(db_engine)
+    failures = ["disk full"]
+
+    def fail(conn, cursor, statement, *args):
+        if "INTO prices" in statement and failures:
+            raise RuntimeError(failures.pop())
+
+    sa.event.listen(db_engine, "before_cursor_execute", fail)
+    with pytest.raises(RuntimeError, match="disk full"):
+        loader.write_batch(batch)
+    assert loader.known_stations == loader.known_prices == {}
+    assert loader.stats["stations"]["inserted"] == 0
+    # the rows of the rolled back batch are written by the next one
+    loader.write_batch(batch)
+    assert loader.stats["stations"] == {
+        "inserted": 2,
+        "updated": 0,
+        "skipped": 0,
+    }
+    assert loader.stats["prices"]["inserted"] == 3
+    with db_engine.connect() as conn:
+        assert (
+            conn.execute(sa.select(sa.func.count(Price.station_id))).scalar()
+            == 3
+        )
+
+
+@pytest.mark.parametrize("backend", PARSER_BACKENDS)
+def test_run_pipeline(monkeypatch, db_engine, backend):
+    monkeypatch.setattr("pipeline.CHUNK_SIZE", 16)
+    stats = run_pipeline(
+        io.BytesIO(SAMPLE_FEED), db_engine, parser=backend, queue_size=1
+    )
+    assert stats["stations"]["inserted"] == 2
+    assert stats["prices"]["inserted"] == 3
+    assert stats["stages"]["fetch"]["bytes"] == len(SAMPLE_FEED)
+    assert stats["stages"]["write"]["items"] == 2
+    # bounded queues, the fetch stage waited for the parser
+    assert stats["queues"]["chunks"]["max_depth"] == 1
+
+    # a failing stage stops the others and its error is raised
+    def fail(self, stations, prices):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr("loader.BulkLoader.write", fail)
+    with pytest.raises(RuntimeError, match="disk full"):
+        run_pipeline(io.BytesIO(SAMPLE_FEED), db_engine, queue_size=1)
+
+
+def test_shadow_database(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    engine = sa.create_engine(f"sqlite:///{path}")
+    follow_swaps(engine)
+    Base.metadata.create_all(engine)
+    users = User.__table__
+    user = {"email": "a@b.c", "username": "a", "name": "A"}
+
+    def count(table):
+        with engine.connect() as conn:
+            return conn.scalar(sa.select(sa.func.count()).select_from(table))
+
+    with shadow_database(path) as shadow_engine:
+        run_pipeline(io.BytesIO(SAMPLE_FEED), shadow_engine)
+        # the app keeps reading and writing the live database meanwhile
+        assert count(Station.__table__) == 0
+        with engine.begin() as conn:
+            conn.execute(users.insert().values(**user))
+    assert path.is_symlink()
+    assert count(Station.__table__) == 2
+    assert count(users) == 1
+
+    with pytest.raises(RuntimeError):
+        with shadow_database(path):
+            raise RuntimeError("feed truncated")
+    assert len(generations(path)) == 1
+    for _ in range(2):
+        with shadow_database(path):
+            pass
+    assert len(generations(path)) == 2
+    assert count(users) == 1
+    assert count(Price.__table__) == 3
+
+    # a transaction begun before a swap cannot commit to the old generation
+    from session import SwapSession
+
+    session = SwapSession(engine)
+    session.execute(sa.select(users.c.name))
+    with shadow_database(path):
+        pass
+    session.execute(users.update().values(name="B"))
+    with pytest.raises(GenerationSwapped):
+        session.commit()
+    # rolled back, the session writes to the current generation
+    session.execute(users.update().values(name="C"))
+    session.commit()
+    with engine.connect() as conn:
+        assert conn.scalar(sa.select(users.c.name)) == "C"
+    session.close()
+
+    # a generation still open is kept until it is closed
+    oldest = generations(path)[0]
+    reader = sqlite3.connect(oldest)
+    reader.execute("SELECT 1 FROM users").fetchall()
+    for _ in range(2):
+        with shadow_database(path):
+            pass
+    assert oldest.exists() and len(generations(path)) == 3
+    reader.close()
+    assert prune_generations(path) == [oldest]
+    # so are the journals left by the database file the link replaced
+    Path(f"{path}-wal").touch()
+    assert prune_generations(path) == [Path(f"{path}-wal")]
+
+
+def test_storage_engines(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    writer = create_writer_engine(path, "prod")
+    reader = create_reader_engine(path, "prod")
+    Base.metadata.create_all(writer)
+    run_pipeline(io.BytesIO(SAMPLE_FEED), writer)
+    with reader.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 15000
+        # a reader sees the last committed snapshot while a write is pending
+        with writer.begin() as write:
+            write.execute(sa.delete(Price))
+            assert conn.scalar(sa.select(sa.func.count(Price.price))) == 3
+        with pytest.raises(sa.exc.OperationalError, match="readonly"):
+            conn.execute(sa.delete(Station))
+    # the deletion is still in the write-ahead log, not in the database file
+    assert Path(f"{path}-wal").stat().st_size > 0
+    snapshot_database(reader, tmp_path / "copy.sqlite3")
+    with closing(sqlite3.connect(tmp_path / "copy.sqlite3")) as copy:
+        assert copy.execute("SELECT count(*) FROM stations").fetchone() == (2,)
+        assert copy.execute("SELECT count(*) FROM prices").fetchone() == (0,)
+    with pytest.raises(ValueError, match="Unknown storage profile"):
+        create_writer_engine(path, "fast")
+
+
+def test_station_catalog(db_engine):
+    rng = np.random.default_rng(0)
+    latitudes = rng.uniform(4200000, 5100000, 5000)
+    longitudes = rng.uniform(-500000, 800000, 5000)
+    catalog = StationCatalog(
+        np.arange(5000),
+        latitudes,
+        longitudes,
+        ["a"] * 5000,
+        ["t"] * 5000,
+        ["z"] * 5000,
+    )
+    for box in [
+        (4600000, 4630000, 500000, 560000),
+        (4000000, 4300000, -900000, -400000),
+        (5200000, 5300000, 0, 10000),
+    ]:
+        expected = np.flatnonzero(
+            (latitudes > box[0])
+            & (latitudes < box[1])
+            & (longitudes > box[2])
+            & (longitudes < box[3])
+        )
+        found = catalog.ids[catalog.in_viewport(*box)]
+        assert sorted(found) == list(expected)
+    positions, distances = catalog.within_radius(46.2, 5.2, 30)
+    all_distances = haversine_km(46.2, 5.2, latitudes / 1e5, longitudes / 1e5)
+    assert sorted(catalog.ids[positions]) == list(
+        np.flatnonzero(all_distances <= 30)
+    )
+    assert list(distances) == sorted(distances)
+    with pytest.raises(ValueError):
+        catalog.latitudes[0] = 0
+
+    run_pipeline(io.BytesIO(SAMPLE_FEED), db_engine)
+    with db_engine.connect() as conn:
+        catalog = StationCatalog.from_database(conn)
+        assert catalog.rows(
+            catalog.in_viewport(4620000, 4621000, 519000, 520000)
+        ) == [
+            StationRow(
+                1000001,
+                4620100.0,
+                519800.0,
+                "596 AVENUE DE TREVOUX",
+                "SAINT-DENIS-LÈS-BOURG",
+                "01000",
+            )
+        ]
+
+
+def test_catalog_generation(db_engine):
+    def generation():
+        with db_engine.connect() as conn:
+            return catalog_generation(conn)
+
+    empty = generation()
+    run_pipeline(io.BytesIO(SAMPLE_FEED), db_engine)
+    loaded = generation()
+    assert loaded != empty
+    # nothing changed, nothing written
+    run_pipeline(io.BytesIO(SAMPLE_FEED), db_engine)
+    assert generation() == loaded
+    # loads without ETL run, as the dump_stations action
+    moved = SAMPLE_FEED.replace(b'latitude="4620100"', b'latitude="4720100"')
+    load_records(iter_stations(io.BytesIO(moved)), db_engine)
+    assert generation() not in (empty, loaded)
+
+
+def test_cheapest_nearby(db_engine):
+    catalog = StationCatalog(
+        [1, 2, 3, 4],
+        [4620000, 4621000, 4640000, 4800000],
+        [520000, 520000, 520000, 520000],
+        ["a", "b", "c", "d"],
+        ["t"] * 4,
+        ["z"] * 4,
+    )
+    day = datetime(2024, 1, 2)
+    prices = CatalogPrices(
+        catalog,
+        [1, 2, 3, 4, 1, 99],
+        [2, 2, 2, 2, 1, 2],
+        [1.9, 1.8, 1.8, 1.1, 1.7, 0.5],
+        [day] * 6,
+    )
+    nearby = prices.cheapest_nearby(46.2, 5.2, [2, 1, 3], radius_km=30, k=2)
+    # station 4 is too far, station 99 is not in the catalog, 3 is for E85
+    assert [(item.gastype_id, item.station.id) for item in nearby] == [
+        (2, 2),
+        (2, 3),
+        (1, 1),
+    ]
+    assert nearby[0].price == 1.8
+    assert nearby[0].updated_at == day
+    assert nearby[0].distance_km == pytest.approx(1.11, abs=0.01)
+
+    run_pipeline(io.BytesIO(SAMPLE_FEED), db_engine)
+    with db_engine.connect() as conn:
+        catalog = StationCatalog.from_database(conn)
+        prices = CatalogPrices.from_database(conn, catalog)
+    nearby = prices.cheapest_nearby(46.2, 5.2, [5], radius_km=5)
+    assert [(item.station.id, item.price) for item in nearby] == [
+        (1000002, 1.759)
+    ]
+
+
+@pytest.mark.parametrize("followed", [1, 5])
+def test_prices_user_queries(monkeypatch, db_engine, followed):
+    import utils
+
+    day = datetime(2024, 1, 2)
+    with sa.orm.Session(db_engine) as session:
+        gazole = GasType(id=1, xml_id="1", name="Gazole")
+        e10 = GasType(id=2, xml_id="5", name="E10")
+        sp98 = GasType(id=3, xml_id="6", name="SP98")
+        user = User(
+            id=1, email="a@b.c", username="driver", name="D", gastypes=[e10]
+        )
+        user.gastypes.append(gazole)
+        session.add_all([gazole, e10, sp98, user])
+        for station_id in range(1, 6):
+            session.add(
+                Station(
+                    id=station_id,
+                    latitude=station_id,
+                    longitude=0,
+                    town="t",
+                    address="a",
+                    zip_code="z",
+                )
+            )
+            for gastype_id in (1, 5, 6):
+                session.add(
+                    Price(
+                        station_id=station_id,
+                        gastype_id=gastype_id,
+                        price=1 + station_id / 10 + gastype_id / 100,
+                        updated_at=day,
+                    )
+                )
+        for station_id in range(1, followed + 1):
+            session.add(
+                CustomStation(
+                    id=station_id, user_id=1, custom_name=f"S{station_id}"
+                )
+            )
+        session.commit()
+
+    statements = []
+    sa.event.listen(
+        db_engine,
+        "before_cursor_execute",
+        lambda *args: statements.append(args[2]),
+    )
+    with db_engine.connect() as conn:
+        df = utils.query_prices_user(conn, "driver")
+    # a single query whatever the number of followed stations
+    assert len(statements) == 1
+    assert len(df) == 2 * followed
+    assert set(df["Type"]) == {"Gazole", "E10"}
+    assert df["Price"].iloc[:2].tolist() == pytest.approx([1.11, 1.15])
+    assert df["Updated_at"].iloc[0] == day
+
+    monkeypatch.setattr("utils.reader_engine", db_engine)
+    monkeypatch.setattr("utils.current_generation", lambda: ("db", 1))
+    utils.invalidate_prices_user()
+    statements.clear()
+    for _ in range(3):
+        utils.get_prices_user("driver")
+    assert len(statements) == 1
+    # editing the followed stations or gas types loads the prices again
+    utils.invalidate_prices_user("driver")
+    utils.get_prices_user("driver")
+    assert len(statements) == 2
+
+
+def test_cluster_pyramid():
+    rng = np.random.default_rng(0)
+    latitudes = rng.uniform(4200000, 5100000, 5000)
+    longitudes = rng.uniform(-500000, 800000, 5000)
+    catalog = StationCatalog(
+        np.arange(5000),
+        latitudes,
+        longitudes,
+        ["a"] * 5000,
+        ["t"] * 5000,
+        ["z"] * 5000,
+    )
+    costs = rng.uniform(1.5, 2.0, 5000)
+    # only the even stations sell E10
+    prices = CatalogPrices(
+        catalog,
+        np.concatenate([np.arange(5000), np.arange(0, 5000, 2)]),
+        [2] * 5000 + [5] * 2500,
+        np.concatenate([costs, costs[::2]]),
+        [None] * 7500,
+    )
+    pyramid = ClusterPyramid(prices)
+    box = (4400000, 4800000, 0, 600000)
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        clusters = pyramid.clusters(zoom, *box)
+        # every station of the cells crossed by the viewport, once
+        size = cell_size(zoom)
+        rows = np.floor(latitudes / size)
+        columns = np.floor(longitudes / size)
+        crossed = (
+            (rows >= np.floor(box[0] / size))
+            & (rows <= np.floor(box[1] / size))
+            & (columns >= np.floor(box[2] / size))
+            & (columns <= np.floor(box[3] / size))
+        )
+        assert sum(cluster.count for cluster in clusters) == crossed.sum()
+        assert min(cluster.min_prices[2] for cluster in clusters) == (
+            costs[crossed].min()
+        )
+        assert min(
+            cluster.min_prices.get(5, np.inf) for cluster in clusters
+        ) == (costs[::2][crossed[::2]].min())
+    # fewer and larger clusters when zooming out
+    counts = [len(pyramid.level(zoom)) for zoom in range(MIN_ZOOM, 13)]
+    assert counts == sorted(counts)
+    assert pyramid.level(3) is pyramid.level(MIN_ZOOM)
+    assert len(pyramid.clusters(18, 4600000, 4601000, 0, 1000)) <= 4
+
+
+def test_tile_store(tmp_path, monkeypatch):
+    catalog = StationCatalog(
+        [1, 2, 3],
+        # two stations in the same tile, one far away
+        [4620100, 4620200, 4800000],
+        [519800, 519900, 200000],
+        ["a", "b", "c"],
+        ["t"] * 3,
+        ["z"] * 3,
+    )
+    prices = CatalogPrices(catalog, [1, 3], [2, 1], [1.8, 1.7], [None] * 2)
+    store = TileStore(tmp_path, max_tiles=1)
+    assert store.build(prices, ("db", 1)) == 2
+    assert store.build(prices, ("db", 1)) == 0
+    x, y = tiles_in_bounds(46.201, 46.202, 5.198, 5.199)[0]
+    features = store.features(("db", 1), x, y)
+    assert [feature["properties"]["id"] for feature in features] == [1, 2]
+    assert features[0]["properties"]["prices"] == {"2": 1.8}
+    assert features[1]["properties"]["prices"] == {}
+    assert features[0]["geometry"]["coordinates"] == [5.198, 46.201]
+    assert store.features(("db", 1), x, y) is features
+    assert store.features(("db", 1), x + 1, y) == []
+    # evicted by the previous tile
+    assert store.features(("db", 1), x, y) is not features
+    assert (store.hits, store.misses) == (1, 3)
+    # the bounds of a city at zoom 13 cover a few tiles
+    assert 1 <= len(tiles_in_bounds(46.18, 46.22, 5.18, 5.26)) <= 12
+
+    store.build(prices, ("db", 2))
+    store.build(prices, ("db", 3))
+    assert not store.has(("db", 1))
+    assert store.has(("db", 2)) and store.has(("db", 3))
+
+    # another process renames the same generation first
+    other = TileStore(tmp_path)
+    monkeypatch.setattr(other, "has", lambda generation: False)
+    assert other.build(prices, ("db", 3)) == 0
+    assert store.has(("db", 3))
+    assert [
+        path.name for path in tmp_path.iterdir() if ".tmp-" in path.name
+    ] == []
+
+
+def test_tile_store_eviction(tmp_path):
+    catalog = StationCatalog([1], [4620100], [519800], ["a"], ["t"], ["z"])
+    prices = CatalogPrices(catalog, [], [], [], [])
+    now = [0.0]
+    store = TileStore(tmp_path, ttl=10, clock=lambda: now[0])
+    store.build(prices, ("db", 1))
+    x, y = tiles_in_bounds(46.201, 46.202, 5.198, 5.199)[0]
+    features = store.features(("db", 1), x, y)
+    assert store.features(("db", 1), x, y) is features
+    # expired, read again from disk
+    now[0] = 11
+    assert store.features(("db", 1), x, y) is not features
+    assert (store.hits, store.misses) == (1, 2)
+    # the tiles of the previous generation leave memory with the next one
+    store.build(prices, ("db", 2))
+    assert len(store.cache) == 0
+    store.features(("db", 2), x, y)
+    assert list(store.cache) == [(("db", 2), x, y)]
+
+
+def test_stations_layer():
+    catalog = StationCatalog(
+        [1000001, 1000002],
+        [4620100, 4621842.23],
+        [519800, 522767.38],
+        ["596 avenue de trevoux", "16 avenue de marboz"],
+        ["t"] * 2,
+        ["z"] * 2,
+    )
+    prices = CatalogPrices(catalog, [1000001], [2], [1.899], [None])
+    features = station_features(prices, np.arange(2))
+    for mode in MARKER_MODES:
+        m = folium.Map(prefer_canvas=True)
+        stations_layer(features, [1000002], mode=mode).add_to(m)
+        html = m.get_root().render()
+        assert "1000001" in html and "1000002" in html
+    # only the ids and coordinates are sent, ids as strings for the popups
+    assert "avenue" not in html and "1.899" not in html
+    assert '"id": "1000001"' in html
+    assert "[5.22767, 46.21842]" in html
+    with pytest.raises(ValueError):
+        stations_layer(features, mode="svg")
+
+
+def test_viewport_state():
+    tiles = {
+        (0, 0): [{"properties": {"id": 1}}, {"properties": {"id": 2}}],
+        (0, 1): [{"properties": {"id": 3}}],
+        (1, 1): [],
+    }
+    loaded = []
+
+    def load_tile(x, y):
+        loaded.append((x, y))
+        return tiles[(x, y)]
+
+    state = ViewportState(followed=[2])
+    assert state.update("a", [(0, 0), (0, 1)], load_tile) == ({1, 2, 3}, set())
+    assert len(state) == 3
+    # only the tiles entering the viewport are loaded
+    assert state.update("a", [(0, 1), (1, 1)], load_tile) == (set(), {1, 2})
+    assert sorted(loaded) == [(0, 0), (0, 1), (1, 1)]
+    assert [f["properties"]["id"] for f in state.features()] == [3]
+    # a new generation loads all the tiles again
+    assert state.update("b", [(0, 1)], load_tile) == ({3}, set())
+    assert len(loaded) == 4
+    assert state.is_followed(2) and not state.is_followed(3)
+    state.follow({3})
+    assert state.is_followed(3) and not state.is_followed(2)
+    state.clear()
+    assert len(state) == 0
+
+
+def test_cheapest_along_route():
+    gpx = b"""<?xml version="1.0"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1">
+  <trk><trkseg>
+    <trkpt lat="46.0" lon="5.0"/><trkpt lat="46.0" lon="5.5"/>
+    <trkpt lat="46.5" lon="5.5"/>
+  </trkseg></trk>
+</gpx>"""
+    route = read_route(gpx, "trip.gpx")
+    geojson = {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": [[5.0, 46.0], [5.5, 46.0], [5.5, 46.5]],
+        },
+    }
+    other = read_route(json.dumps(geojson).encode(), "trip.geojson")
+    assert np.allclose(route.latitudes, other.latitudes)
+    assert route.length_km == pytest.approx(38.6 + 55.6, abs=0.5)
+    with pytest.raises(ValueError):
+        read_route(b"<gpx/>", "trip.gpx")
+    with pytest.raises(ValueError):
+        read_route(b"", "trip.kml")
+
+    catalog = StationCatalog(
+        [1, 2, 3, 4],
+        # 2 km south of the first leg, near the corner, 10 km away, on the
+        # second leg
+        [4598200, 4600000, 4610000, 4625000],
+        [510000, 549000, 520000, 550000],
+        ["a", "b", "c", "d"],
+        ["t"] * 4,
+        ["z"] * 4,
+    )
+    prices = CatalogPrices(
+        catalog, [1, 2, 3, 4], [2, 2, 2, 2], [1.8, 1.7, 1.1, 1.8], [None] * 4
+    )
+    along = cheapest_along(prices, route, [2], width_km=5)
+    assert [item.station.id for item in along] == [2, 1, 4]
+    assert along[1].distance_km == pytest.approx(2.0, abs=0.05)
+    assert along[1].offset_km == pytest.approx(7.7, abs=0.1)
+    assert along[2].offset_km == pytest.approx(38.6 + 27.8, abs=0.5)
+
+
+def test_etl_run_recorder(db_engine):
+    with EtlRunRecorder(db_engine, interval=0.01) as run:
+        stats = run_pipeline(
+            io.BytesIO(SAMPLE_FEED), db_engine, on_start=run.watch
+        )
+        run.finish(stats)
+    with pytest.raises(RuntimeError, match="disk full"):
+        with EtlRunRecorder(db_engine):
+            raise RuntimeError("disk full")
+    with EtlRunRecorder(db_engine) as run:
+        run.skip()
+    runs = load_runs(db_engine)
+    assert list(runs["status"]) == ["skipped", "failed", "success"]
+    success = runs.iloc[2]
+    assert success["feed_bytes"] == len(SAMPLE_FEED)
+    assert success["stations_processed"] == 2
+    assert success["prices_inserted"] == 3
+    assert success["lock_wait_seconds"] >= 0
+    assert success["commit_seconds"] > 0
+    assert success["peak_rss_mb"] > 0
+    assert runs.iloc[1]["error"] == "RuntimeError: disk full"
+
+
+def test_stage_records():
+    records = list(iter_stations(io.BytesIO(SAMPLE_FEED)))
+    records += [
+        StationRecord("1", "4620100", "519800", None, "BOURG", "01000", []),
+        StationRecord(
+            "2",
+            "4620200",
+            "519900",
+            "1 RUE",
+            "BOURG",
+            "01000",
+            [
+                ("1", "0", "2024-01-02 07:53:00"),
+                ("2", "10.0", "2024-01-02 07:53:00"),
+                ("5", "1.749", "not a date"),
+                ("6", "1.949", "2024-01-02 07:53:00"),
+            ],
+        ),
+    ]
+    batch = stage_records(records)
+    assert batch.rejected == 1
+    assert batch.invalid_prices == 3
+    assert list(batch.stations["id"]) == [1000001, 1000002, 2]
+    assert batch.station_rows()[1]["latitude"] == 4621842.23
+    assert batch.price_rows()[-1] == {
+        "station_id": 2,
+        "gastype_id": 6,
+        "price": 1.949,
+        "updated_at": datetime(2024, 1, 2, 7, 53),
+    }
+
+
+def test_split_feed(monkeypatch, db_engine):
+    monkeypatch.setattr("pipeline.CHUNK_SIZE", 16)
+    chunks = list(split_feed(io.BytesIO(SAMPLE_FEED), 1))
+    assert len(chunks) == 2
+    # each chunk is a standalone document holding one station
+    ids = [
+        record.id
+        for chunk in chunks
+        for record in iter_stations(io.BytesIO(chunk))
+    ]
+    assert ids == [
+        record.id for record in iter_stations(io.BytesIO(SAMPLE_FEED))
+    ]
+
+    stats = run_pipeline(
+        io.BytesIO(SAMPLE_FEED), db_engine, batch_size=1, workers=2
+    )
+    assert stats["stations"]["inserted"] == 2
+    assert stats["prices"]["inserted"] == 3
+    assert stats["batches"] == 2
+
+
+def test_backfill(tmp_path):
+    # yearly archives hold every price event, dates in ISO 8601 and older
+    # prices in thousandths of euro
+    archive = tmp_path / "PrixCarburants_annuel_2021.zip"
+    archive.write_bytes(
+        make_archive(
+            SAMPLE_FEED.replace(
+                b'maj="2024-01-02 07:53:00" valeur="1.869"',
+                b'maj="2021-01-02T07:53:00" valeur="1369"/>'
+                b'<prix nom="Gazole" id="1" maj="2021-01-09T10:00:00" '
+                b'valeur="1389"',
+            )
+        )
+    )
+    store = SQLiteHistoryStore(tmp_path / "history.sqlite3")
+    with store, open_archive(archive) as source:
+        stats = backfill(source, store, batch_size=1)
+    assert stats["events"] == stats["stored"] == 4
+    with store.engine.connect() as conn:
+        rows = conn.execute(
+            sa.select(price_history.c.updated_at, price_history.c.price)
+            .where(price_history.c.gastype_id == 1)
+            .order_by(price_history.c.updated_at)
+        ).all()
+    assert rows == [
+        (datetime(2021, 1, 2, 7, 53), 1.369),
+        (datetime(2021, 1, 9, 10, 0), 1.389),
+    ]
+
+    # events already stored are ignored
+    with store, open_archive(archive) as source:
+        assert backfill(source, store)["stored"] == 0
+
+
+def test_parquet_history_store(tmp_path, db_engine):
+    xmlfile = tmp_path / "feed.xml"
+    xmlfile.write_bytes(SAMPLE_FEED)
+    root = tmp_path / "history"
+    # each ETL run appends the prices it wrote
+    for _ in range(2):
+        with ParquetHistoryStore(root, flush_rows=1) as history:
+            load_records(
+                iter_stations(str(xmlfile)), db_engine, history=history
+            )
+    store = ParquetHistoryStore(root)
+    assert store.partitions() == ["2024-01-02", "2024-01-03"]
+    assert len(store.scan()) == 3
+
+    # backfilled events are deduplicated when the partitions are compacted
+    events = store.scan(station_ids=[1000001])
+    with store:
+        store.write(pd.concat([events, events.assign(price=1.5)]))
+    partition = store.partition_path("2024-01-02")
+    assert len(list(partition.glob("*.parquet"))) == 1
+    assert list(store.scan(station_ids=[1000001])["price"]) == [1.869, 1.899]
+
+    # a time range only reads the partitions it overlaps
+    start, end = datetime(2024, 1, 3), datetime(2024, 1, 4)
+    assert store.partitions(start, end) == ["2024-01-03"]
+    events = store.scan(start, end)
+    assert events.to_dict("records") == [
+        {
+            "station_id": 1000002,
+            "gastype_id": 5,
+            "price": 1.759,
+            "updated_at": pd.Timestamp("2024-01-03 09:00:00"),
+        }
+    ]
+    assert store.scan(end=datetime(2024, 1, 1)).empty
+
+
+def test_synthetic_feeds(tmp_path, db_engine):
+    feeds = write_runs(tmp_path, 50, runs=2, changes=0.2, seed=1)
+    with open_archive(feeds[0]) as source:
+        stats = load_records(iter_stations(source), db_engine)
+    assert stats["stations"]["inserted"] == 50
+    assert stats["rejected"] == stats["invalid_prices"] == 0
+    prices = stats["prices"]["inserted"]
+    # the next run only moves a share of the prices
+    with open_archive(feeds[1]) as source:
+        stats = load_records(iter_stations(source), db_engine)
+    assert stats["stations"]["skipped"] == 50
+    assert 0 < stats["prices"]["updated"] < prices * 0.4
+    assert stats["prices"]["updated"] + stats["prices"]["skipped"] == prices
+
+
 def test_about_page(mock_load_mode, mock_config_path):
     """
     Test the about page of the application.
@@ -87,6 +1102,18 @@ def test_demo_page(mock_load_mode, mock_config_path):
     assert at.title[0].value == "Stations dashboard ⛽"
 
 
+def test_route_page(mock_load_mode, mock_config_path):
+    """
+    Test the route page of the application.
+    """
+    at = AppTest.from_file("home.py")
+    at.secrets["LOAD_MODE"] = "local"
+    at.switch_page("pages/route.py")
+    at.run()
+    assert not at.exception
+    assert at.title[0].value == "Route dashboard 🛣️"
+
+
 def test_forgot_page(mock_load_mode, mock_config_path):
     """
     Test the forgot page of the application.
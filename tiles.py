@@ -0,0 +1,324 @@
+"""Pre-rendered GeoJSON tiles of the stations layer of the maps.
+
+The stations and their current prices are cut along the tiles of the Web
+Mercator grid at TILE_ZOOM, each tile being a GeoJSON FeatureCollection of
+the points of its stations. After each ETL run, the tiles of the new
+generation of the data are written to disk, under
+``TILES_DIR/<generation>/<zoom>/<x>/<y>.geojson``. The pages read them
+through an in-memory LRU shared by all the sessions: panning the map costs a
+dictionary lookup instead of a query and the conversion of its rows. The
+tiles read expire after a time to live, and those of a generation are
+dropped once another one is read or built.
+"""
+
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+# the pages show the stations above zoom 12 only, the grid of zoom 13 serves
+# them all: a viewport is covered by a few tiles at zoom 13, by one at 18
+TILE_ZOOM = 13
+TILES_DIR = Path("tiles")
+# tiles held in memory, and for how long, in seconds
+CACHE_TILES = 4096
+CACHE_TTL = 600
+# generations kept on disk, the current one and the previous one
+KEEP_GENERATIONS = 2
+
+
+def tile_xy(latitudes, longitudes, zoom=TILE_ZOOM):
+    """
+    Web Mercator tiles of points, vectorized.
+
+    Args:
+        latitudes (array): latitudes, in degrees
+        longitudes (array): longitudes, in degrees
+        zoom (int): zoom level of the tiles
+
+    Returns:
+        tuple: x and y of the tiles, as numpy arrays
+    """
+    n = 2**zoom
+    latitudes = np.radians(np.clip(latitudes, -85.0511, 85.0511))
+    x = np.floor((np.asarray(longitudes) + 180.0) / 360.0 * n)
+    y = np.floor((1.0 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2.0 * n)
+    return (
+        np.clip(x, 0, n - 1).astype("int64"),
+        np.clip(y, 0, n - 1).astype("int64"),
+    )
+
+
+def tiles_in_bounds(lat_min, lat_max, lon_min, lon_max, zoom=TILE_ZOOM):
+    """
+    Tiles covering a viewport.
+
+    Args:
+        lat_min (float): south bound, in degrees
+        lat_max (float): north bound
+        lon_min (float): west bound
+        lon_max (float): east bound
+        zoom (int): zoom level of the tiles
+
+    Returns:
+        list of tuple: x and y of the tiles
+    """
+    (x_min, x_max), (y_max, y_min) = tile_xy(
+        [lat_min, lat_max], [lon_min, lon_max], zoom
+    )
+    return [
+        (x, y)
+        for x in range(int(x_min), int(x_max) + 1)
+        for y in range(int(y_min), int(y_max) + 1)
+    ]
+
+
+def generation_name(generation):
+    """
+    Name of the directory of the tiles of a generation of the data.
+
+    Args:
+        generation: key of the version of the stations, see
+            spatial.catalog_generation
+
+    Returns:
+        str
+    """
+    return hashlib.sha1(repr(generation).encode()).hexdigest()[:16]
+
+
+def station_features(prices, positions):
+    """
+    GeoJSON points of stations, with their current prices.
+
+    Args:
+        prices (spatial.CatalogPrices): stations and their prices
+        positions (array): positions of the stations in the catalog
+
+    Returns:
+        list of dict: GeoJSON features, the prices by gas type id
+    """
+    catalog = prices.catalog
+    gastypes = [str(gastype) for gastype in prices.gastypes.tolist()]
+    features = []
+    for station, costs in zip(
+        catalog.rows(positions), prices.prices[positions].tolist()
+    ):
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Point",
+                    "coordinates": [
+                        station.longitude / 100000,
+                        station.latitude / 100000,
+                    ],
+                },
+                "properties": {
+                    "id": station.id,
+                    "address": station.address,
+                    "town": station.town,
+                    "zip_code": station.zip_code,
+                    "prices": {
+                        gastype: price
+                        for gastype, price in zip(gastypes, costs)
+                        if not math.isnan(price)
+                    },
+                },
+            }
+        )
+    return features
+
+
+class TileStore:
+    """
+    GeoJSON tiles of the stations on disk, with an LRU of the tiles read.
+
+    The LRU holds the tiles of a single generation of the data, the last one
+    read or built.
+
+    Args:
+        directory (Path): directory of the tiles
+        max_tiles (int): tiles held in memory
+        zoom (int): zoom level of the tiles
+        ttl (float): seconds a tile is served from memory
+        clock (callable): current time, in seconds
+    """
+
+    def __init__(
+        self,
+        directory=TILES_DIR,
+        max_tiles=CACHE_TILES,
+        zoom=TILE_ZOOM,
+        ttl=CACHE_TTL,
+        clock=None,
+    ):
+        self.directory = Path(directory)
+        self.max_tiles = max_tiles
+        self.zoom = zoom
+        self.ttl = ttl
+        self.clock = clock or time.monotonic
+        self.cache = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def path(self, generation, x, y):
+        return (
+            self.directory
+            / generation_name(generation)
+            / str(self.zoom)
+            / str(x)
+            / f"{y}.geojson"
+        )
+
+    def evict(self, generation):
+        """
+        Drop the tiles of the other generations from memory.
+
+        Called with the lock held.
+
+        Args:
+            generation: key of the version of the stations
+        """
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
+
+    def has(self, generation):
+        """
+        Whether the tiles of a generation are on disk.
+
+        Args:
+            generation: key of the version of the stations
+
+        Returns:
+            bool
+        """
+        return (self.directory / generation_name(generation)).is_dir()
+
+    def build(self, prices, generation):
+        """
+        Write the tiles of a generation of the data.
+
+        The tiles are written to a temporary directory renamed once
+        complete, the pages never read a partial generation. A generation
+        renamed first by another process is kept as is. The oldest
+        generations are removed.
+
+        Args:
+            prices (spatial.CatalogPrices): stations and their prices
+            generation: key of the version of the stations
+
+        Returns:
+            int: number of tiles written, tiles without station are not
+        """
+        with self.build_lock:
+            if self.has(generation):
+                return 0
+            catalog = prices.catalog
+            x, y = tile_xy(
+                catalog.latitudes / 100000,
+                catalog.longitudes / 100000,
+                self.zoom,
+            )
+            keys = x * 2**self.zoom + y
+            order = np.argsort(keys, kind="stable")
+            _, starts = np.unique(keys[order], return_index=True)
+            final = self.directory / generation_name(generation)
+            staging = final.with_name(f"{final.name}.tmp-{os.getpid()}")
+            shutil.rmtree(staging, ignore_errors=True)
+            for group in np.split(order, starts[1:]) if len(order) else []:
+                tile_x, tile_y = int(x[group[0]]), int(y[group[0]])
+                path = (
+                    staging / str(self.zoom) / str(tile_x) / f"{tile_y}.geojson"
+                )
+                path.parent.mkdir(parents=True, exist_ok=True)
+                collection = {
+                    "type": "FeatureCollection",
+                    "features": station_features(prices, group),
+                }
+                path.write_text(json.dumps(collection, separators=(",", ":")))
+            staging.mkdir(parents=True, exist_ok=True)
+            try:
+                os.replace(staging, final)
+            except OSError:
+                # built meanwhile by another process, the ETL or the app
+                if not final.is_dir():
+                    raise
+                shutil.rmtree(staging, ignore_errors=True)
+                return 0
+            with self.lock:
+                self.evict(generation)
+            self.prune()
+            return len(starts)
+
+    def prune(self, keep=KEEP_GENERATIONS):
+        """
+        Remove the oldest generations of tiles.
+
+        Args:
+            keep (int): number of generations kept
+        """
+        built = sorted(
+            (
+                path
+                for path in self.directory.iterdir()
+                # generations being written by other processes are kept
+                if path.is_dir() and ".tmp-" not in path.name
+            ),
+            key=lambda path: path.stat().st_mtime,
+            reverse=True,
+        )
+        for path in built[keep:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def features(self, generation, x, y):
+        """
+        Features of a tile, from memory or from disk.
+
+        Reading another generation drops the tiles of the previous one.
+
+        Args:
+            generation: key of the version of the stations, whose tiles are
+                built
+            x (int): x of the tile
+            y (int): y of the tile
+
+        Returns:
+            list of dict: GeoJSON features of the stations, not to be changed
+        """
+        key = (generation, x, y)
+        now = self.clock()
+        with self.lock:
+            self.evict(generation)
+            if key in self.cache:
+                expires, features = self.cache[key]
+                if expires > now:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return features
+                del self.cache[key]
+            self.misses += 1
+        path = self.path(generation, x, y)
+        # tiles without station are not written
+        features = (
+            json.loads(path.read_text())["features"] if path.exists() else []
+        )
+        with self.lock:
+            # another generation was read meanwhile
+            if generation != self.generation:
+                return features
+            self.cache[key] = (now + self.ttl, features)
+            while len(self.cache) > self.max_tiles:
+                self.cache.popitem(last=False)
+        return features
@@ -1,12 +1,13 @@
 import argparse
+import functools
 import hashlib
+import json
 import os
 import signal
 import smtplib
 import threading
 import time
-import xml.etree.ElementTree as ET
-import zipfile
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from email.mime.text import MIMEText
 from io import BytesIO
@@ -14,21 +15,55 @@ from pathlib import Path
 from threading import Timer
 
 import boto3
+import folium
 import pandas as pd
 import pytz
-import requests
 import sqlalchemy
 import streamlit as st
 import streamlit_authenticator as stauth
 import yaml
 from discord_webhook import DiscordWebhook
 from dotenv import load_dotenv
-from requests.exceptions import HTTPError
+from requests.exceptions import RequestException
 from tqdm import tqdm
 from yaml.loader import SafeLoader
 
-from models import CustomStation, GasType, Price, Station, Transfer, User
-from session import db_session
+from clusters import ClusterPyramid
+from corpus import CORPUS_DIR, Corpus, replay, replay_database
+from fetch import FEED_URL, open_feed
+from history import (
+    BACKFILL_BATCH_SIZE,
+    DEFAULT_HISTORY_STORE,
+    HISTORY_STORES,
+    backfill,
+    format_backfill_stats,
+    open_backfill_source,
+    open_history_store,
+)
+from loader import DEFAULT_BATCH_SIZE, format_stats, load_records
+from models import (
+    CustomStation,
+    FeedState,
+    GasType,
+    Price,
+    Station,
+    Transfer,
+    User,
+    association_table,
+)
+from parsers import DEFAULT_PARSER, PARSER_BACKENDS, iter_stations
+from pipeline import (
+    DEFAULT_WORKERS,
+    QUEUE_SIZE,
+    format_pipeline_stats,
+    run_pipeline,
+)
+from routes import cheapest_along
+from session import db_session, engine, reader_engine, reader_session
+from shadow import shadow_database
+from spatial import CatalogPrices, StationCatalog, catalog_generation
+from telemetry import EtlRunRecorder
+from tiles import TileStore, tiles_in_bounds
 
 VERSION = "0.8.0"
 
@@ -216,30 +251,37 @@ def dump_config(config):
 ###################
 
 
-def loadXML():
+@contextmanager
+def loadXML(url=FEED_URL):
     """
-    This function downloads the XML file from the url and extracts it.
+    This function streams the XML file out of the zip archive of the url.
+
+    The archive is decompressed on the fly as it is downloaded, nothing is
+    written on disk. The request is conditional on the validators of the
+    last successful fetch, which are only saved once the block using the
+    stream completed without error.
 
     Args:
-        None
+        url (str): url of the zip archive
+
+    Yields:
+        binary file object of the XML feed, None if the feed did not change
     """
-    urls = ["https://donnees.roulez-eco.fr/opendata/instantane_ruptures"]
-    for url in urls:
-        try:
-            response = requests.get(url, verify=False)
-            # If the response was successful, no Exception will be raised
-            response.raise_for_status()
-            ziped = open("ZIP.zip", "wb")
-            ziped.write(response.content)
-            ziped.close()
-            with zipfile.ZipFile("ZIP.zip", "r") as zip_ref:
-                zip_ref.extractall("./")
-                zip_ref.close()
-            Path("ZIP.zip").unlink(missing_ok=True)
-        except HTTPError as http_err:
-            print(f"HTTP error occurred: {http_err}")
-        else:
-            print("Success!")
+    feed_state = db_session.query(FeedState).filter_by(url=url).first()
+    validators = feed_state.validators() if feed_state else None
+    # release the connection while the feed is loaded, the database may be
+    # swapped meanwhile, see shadow.py
+    db_session.commit()
+    with open_feed(url, validators=validators) as response:
+        yield response.stream
+    if feed_state is None:
+        feed_state = FeedState(url=url)
+    feed_state.etag = response.validators.get("etag")
+    feed_state.last_modified = response.validators.get("last_modified")
+    feed_state.content_hash = response.validators.get("content_hash")
+    feed_state.fetched_at = datetime.now()
+    db_session.add(feed_state)
+    db_session.commit()
 
 
 def create_gastypes():
@@ -263,68 +305,168 @@ def create_gastypes():
         st.error("Gas type already exists")
 
 
-def dump_stations():
-    xmlfile = "PrixCarburants_instantane_ruptures.xml"
-    # create element tree object
-    tree = ET.parse(xmlfile)
-    # get root element
-    root = tree.getroot()
-    # compute the total amount of stations for tqdm progress bar
-    total_stations = len(root.findall("pdv"))
-    for pdv in tqdm(root.iter("pdv"), total=total_stations):
-        id_station = pdv.get("id")
-        latitude = pdv.get("latitude")
-        longitude = pdv.get("longitude")
-        address = pdv.find("adresse").text
-        town = pdv.find("ville").text
-        zip_code = pdv.get("cp")
-        if (
-            not db_session.query(Station)
-            .filter(Station.id == id_station)
-            .first()
-        ):
-            station = Station(
-                id=id_station,
-                latitude=latitude,
-                longitude=longitude,
-                address=address,
-                town=town,
-                zip_code=zip_code,
+def dump_stations(
+    source,
+    parser=DEFAULT_PARSER,
+    batch_size=DEFAULT_BATCH_SIZE,
+    incremental=True,
+    workers=DEFAULT_WORKERS,
+    history=None,
+    shadow=False,
+):
+    """
+    Load the stations and prices of the XML feed into the database.
+
+    The feed is streamed station by station, so that memory does not grow
+    with the size of the file, and written with batched upserts, committed
+    every `batch_size` stations.
+
+    Args:
+        source: path or binary file object of the XML feed
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations written per transaction
+        incremental (bool): write only new prices and changed stations
+        workers (int): number of processes parsing the feed in parallel, 0
+            to parse it in the current process
+        history: history.HistoryStore receiving the written prices
+        shadow (bool): load a copy of the database and swap it in once
+            loaded, see shadow.py
+
+    Returns:
+        dict: counts of inserted, updated and skipped rows
+    """
+    with ExitStack() as stack:
+        target = stack.enter_context(shadow_database()) if shadow else engine
+        if workers:
+            if isinstance(source, (str, os.PathLike)):
+                source = stack.enter_context(open(source, "rb"))
+            stats = run_pipeline(
+                source,
+                target,
+                parser=parser,
+                batch_size=batch_size,
+                incremental=incremental,
+                workers=workers,
+                history=history,
             )
-            db_session.add(station)
-        # fetch all the prices
-        for prix in pdv.findall("prix"):
-            id_price = prix.get("id")
-            valeur = prix.get("valeur")
-            maj_str = prix.get("maj")
-            maj = datetime.strptime(maj_str, "%Y-%m-%d %H:%M:%S")
-            price_from_db = (
-                db_session.query(Price)
-                .filter(
-                    Price.gastype_id == id_price, Price.station_id == id_station
-                )
-                .first()
+            print(format_pipeline_stats(stats))
+        else:
+            records = tqdm(iter_stations(source, backend=parser), unit="pdv")
+            stats = load_records(
+                records,
+                target,
+                batch_size=batch_size,
+                incremental=incremental,
+                history=history,
             )
-            if price_from_db is None:
-                price = Price(
-                    gastype_id=id_price,
-                    station_id=id_station,
-                    updated_at=maj,
-                    price=valeur,
-                )
-                db_session.add(price)
-            else:
-                # update the price
-                price_from_db.price = valeur
-                price_from_db.updated_at = maj
-                db_session.add(price_from_db)
-        try:
-            db_session.commit()
-        except sqlalchemy.exc.IntegrityError:
-            db_session.rollback()
-            st.error("Station already exists")
-    # remove xml file
-    Path("PrixCarburants_instantane_ruptures.xml").unlink(missing_ok=True)
+    print(format_stats(stats))
+    return stats
+
+
+def backfill_history(
+    year=None,
+    day=None,
+    file=None,
+    parser=DEFAULT_PARSER,
+    batch_size=BACKFILL_BATCH_SIZE,
+    workers=DEFAULT_WORKERS,
+    history_store=DEFAULT_HISTORY_STORE,
+):
+    """
+    Load the price events of a yearly or daily archive into the history.
+
+    Args:
+        year (int): year of the archive to download
+        day (str): day of the archive to download, formatted as YYYYMMDD
+        file (str): path of a local archive, used instead of downloading
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations per batch
+        workers (int): number of processes parsing the archive
+        history_store (str): one of history.HISTORY_STORES keys
+
+    Returns:
+        dict: counts of read and stored price events
+    """
+    print("Running backfill at ", datetime.now())
+    with (
+        open_history_store(history_store) as store,
+        open_backfill_source(year=year, day=day, file=file) as source,
+    ):
+        stats = backfill(
+            source,
+            store,
+            parser=parser,
+            batch_size=batch_size,
+            workers=workers,
+        )
+    print(format_backfill_stats(stats))
+    print(format_pipeline_stats(stats))
+    return stats
+
+
+def record_feed(corpus_dir=CORPUS_DIR):
+    """
+    Download the live feed archive into the replay corpus.
+
+    Args:
+        corpus_dir (str): directory of the corpus
+
+    Returns:
+        dict: entry of the download in the index of the corpus
+    """
+    entry = Corpus(corpus_dir).record()
+    print(
+        f"Archive {entry['sha256']} recorded at {entry['recorded_at']} "
+        f"({entry['size']} bytes)"
+    )
+    return entry
+
+
+def replay_corpus(
+    corpus_dir=CORPUS_DIR,
+    archives=None,
+    database=None,
+    parser=DEFAULT_PARSER,
+    workers=DEFAULT_WORKERS,
+    incremental=True,
+    output=None,
+):
+    """
+    Load recorded archives through the ETL, offline.
+
+    Args:
+        corpus_dir (str): directory of the corpus
+        archives (list): hashes of the archives, default to all of them in
+            the order they were recorded
+        database (str): path of the database, default to a new one
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        workers (int): number of processes parsing the archives
+        incremental (bool): write only new prices and changed stations
+        output (str): path of a JSON report of the loads
+
+    Returns:
+        list of dict: timings and counters of each load
+    """
+    engine = replay_database(database)
+    print(f"Replaying into {engine.url.database}")
+    results = replay(
+        Corpus(corpus_dir),
+        engine,
+        archives=archives,
+        parser=parser,
+        workers=workers,
+        incremental=incremental,
+    )
+    for result in results:
+        print(
+            f"{result['sha256'][:12]} in {result['seconds']:.3f}s | "
+            f"{format_stats(result)}"
+        )
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {output}")
+    return results
 
 
 def get_hash_of_file(file_path):
@@ -684,6 +826,7 @@ def restore_database():
             print("Custom station already exists")
         else:
             print(f"Custom stations restored {os.environ.get('LOAD_MODE')}")
+            invalidate_prices_user()
     # do the same for gastypes
     if df_gastypes is not None:
         # loop over the dataframe and add the gas types to the users
@@ -727,17 +870,321 @@ def restore_database():
             print("Gas type already exists")
         else:
             print(f"Gas types restored {os.environ.get('LOAD_MODE')}")
+            invalidate_prices_user()
+
+
+def current_generation():
+    """
+    Key of the current version of the stations, see spatial.catalog_generation.
+
+    Returns:
+        tuple
+    """
+    with reader_engine.connect() as conn:
+        return catalog_generation(conn)
+
+
+@st.cache_resource(max_entries=1)
+def load_station_catalog(generation):
+    """
+    Build the catalog of the stations, shared by all the sessions.
+
+    Args:
+        generation: key of the version of the stations, a new catalog is
+            built when it changes
+
+    Returns:
+        spatial.StationCatalog
+    """
+    with reader_engine.connect() as conn:
+        return StationCatalog.from_database(conn, generation)
+
+
+@st.cache_resource(max_entries=1)
+def load_catalog_prices(generation):
+    """
+    Load the prices of the stations of the catalog, shared by all the sessions.
+
+    Args:
+        generation: key of the version of the stations and of their prices
+
+    Returns:
+        spatial.CatalogPrices
+    """
+    catalog = load_station_catalog(generation)
+    with reader_engine.connect() as conn:
+        return CatalogPrices.from_database(conn, catalog)
+
+
+def catalog_prices():
+    """
+    Prices of the current version of the stations.
+
+    Returns:
+        spatial.CatalogPrices
+    """
+    generation = current_generation()
+    return load_catalog_prices(generation)
+
+
+def gastype_ids(gastype_names):
+    """
+    Ids in the feed of gas types.
+
+    Args:
+        gastype_names (list): names of the gas types
+
+    Returns:
+        dict: name of each gas type by id
+    """
+    gastypes = (
+        reader_session.query(GasType)
+        .filter(GasType.name.in_(gastype_names))
+        .all()
+    )
+    names = {int(gastype.xml_id): gastype.name for gastype in gastypes}
+    reader_session.close()
+    return names
+
+
+def cheapest_stations(latitude, longitude, gastype_names, radius_km=10, k=5):
+    """
+    Cheapest stations around a point for some gas types.
+
+    Args:
+        latitude (float): latitude of the point, in degrees
+        longitude (float): longitude of the point, in degrees
+        gastype_names (list): names of the gas types
+        radius_km (float): distance, in km
+        k (int): number of stations per gas type
+
+    Returns:
+        pandas.DataFrame: one row per station and gas type
+    """
+    names = gastype_ids(gastype_names)
+    nearby = catalog_prices().cheapest_nearby(
+        latitude, longitude, list(names), radius_km=radius_km, k=k
+    )
+    columns = ["Type", "Price", "Distance", "Address", "Town", "Updated_at"]
+    return pd.DataFrame(
+        [
+            (
+                names[item.gastype_id],
+                item.price,
+                item.distance_km,
+                item.station.address.upper(),
+                item.station.town.upper(),
+                item.updated_at,
+            )
+            for item in nearby
+        ],
+        columns=columns,
+    )
+
+
+def cheapest_along_route(route, gastype_names, width_km=5, k=10):
+    """
+    Cheapest stations along a route for some gas types.
+
+    Args:
+        route (routes.Route): route of the trip
+        gastype_names (list): names of the gas types
+        width_km (float): distance to the route, in km
+        k (int): number of stations per gas type
+
+    Returns:
+        pandas.DataFrame: one row per station and gas type
+    """
+    names = gastype_ids(gastype_names)
+    along = cheapest_along(
+        catalog_prices(), route, list(names), width_km=width_km, k=k
+    )
+    columns = [
+        "Type",
+        "Price",
+        "Kilometer",
+        "Detour",
+        "Address",
+        "Town",
+        "Updated_at",
+        "Latitude",
+        "Longitude",
+    ]
+    return pd.DataFrame(
+        [
+            (
+                names[item.gastype_id],
+                item.price,
+                item.offset_km,
+                item.distance_km,
+                item.station.address.upper(),
+                item.station.town.upper(),
+                item.updated_at,
+                item.station.latitude / 100000,
+                item.station.longitude / 100000,
+            )
+            for item in along
+        ],
+        columns=columns,
+    )
+
+
+def show_cheapest_nearby(position, gastype_names, key):
+    """
+    Panel of the cheapest stations around the user.
+
+    Args:
+        position (list): latitude and longitude, None if unknown
+        gastype_names (list): names of the followed gas types
+        key (str): suffix of the keys of the widgets
+    """
+    st.subheader("Cheapest stations nearby")
+    if position is None:
+        st.info(
+            "Get geolocated or move the map to find the cheapest stations",
+            icon="ℹ️",
+        )
+        return
+    if not gastype_names:
+        st.info("Follow a gas type to find the cheapest stations", icon="ℹ️")
+        return
+    radius_km = st.slider(
+        "Distance (km)", 1, 50, 10, key=f"cheapest_radius{key}"
+    )
+    df = cheapest_stations(position[0], position[1], gastype_names, radius_km)
+    if df.empty:
+        st.warning(f"No station within {radius_km} km")
+        return
+    column_config = {
+        col: st.column_config.Column(disabled=True)
+        for col in ["Type", "Address", "Town"]
+    }
+    column_config["Price"] = st.column_config.NumberColumn(
+        disabled=True, format="%.3f €"
+    )
+    column_config["Distance"] = st.column_config.NumberColumn(
+        disabled=True, format="%.1f km"
+    )
+    column_config["Updated_at"] = st.column_config.DateColumn(
+        disabled=True,
+        format="DD-MM-YYYY",
+    )
+    st.dataframe(
+        data=df,
+        hide_index=True,
+        use_container_width=True,
+        column_config=column_config,
+    )
+
+
+@st.cache_resource(max_entries=1)
+def load_cluster_pyramid(generation):
+    """
+    Build the clusters of the stations at low zoom, shared by all the sessions.
+
+    Args:
+        generation: key of the version of the stations and of their prices
+
+    Returns:
+        clusters.ClusterPyramid
+    """
+    return ClusterPyramid(load_catalog_prices(generation))
+
+
+def bounding_clusters(bounds, zoom, gastype_names):
+    """
+    Clusters of the stations of the bounds, at a low zoom level.
+
+    Args:
+        bounds: dict, as for update_viewport
+        zoom (int): zoom level of the map
+        gastype_names (list): names of the gas types of the lowest prices
+
+    Returns:
+        list of clusters.Cluster: with the lowest price by gas type name
+    """
+    names = gastype_ids(gastype_names)
+    generation = current_generation()
+    clusters = load_cluster_pyramid(generation).clusters(
+        zoom,
+        bounds["_southWest"]["lat"] * 100000,
+        bounds["_northEast"]["lat"] * 100000,
+        bounds["_southWest"]["lng"] * 100000,
+        bounds["_northEast"]["lng"] * 100000,
+    )
+    return [
+        cluster._replace(
+            min_prices={
+                names[gastype]: price
+                for gastype, price in cluster.min_prices.items()
+                if gastype in names
+            }
+        )
+        for cluster in clusters
+    ]
 
 
-def bounding_stations(bounds):
+def cluster_marker(cluster):
     """
-    Filter the stations based on the bounds.
+    Marker of a cluster of stations, with its count.
 
     Args:
-        bounds: dict
+        cluster (clusters.Cluster): cluster, as returned by bounding_clusters
 
     Returns:
-        nearby_states: list of Station
+        folium.Marker
+    """
+    tooltip = f"{cluster.count} stations"
+    for name, price in cluster.min_prices.items():
+        tooltip += f"<br>{name} from {price:.3f} €"
+    size = 30 + 4 * len(str(cluster.count))
+    return folium.Marker(
+        [cluster.latitude, cluster.longitude],
+        tooltip=tooltip,
+        icon=folium.DivIcon(
+            icon_size=(size, size),
+            icon_anchor=(size // 2, size // 2),
+            html=(
+                f'<div style="width:{size}px;height:{size}px;'
+                "border-radius:50%;background:rgba(49,136,255,0.8);"
+                "color:white;font-weight:bold;text-align:center;"
+                f'line-height:{size}px">{cluster.count}</div>'
+            ),
+        ),
+    )
+
+
+# GeoJSON tiles of the stations layer, shared by the sessions and the ETL
+station_tiles = TileStore()
+
+
+def build_station_tiles():
+    """
+    Write the tiles of the stations layer of the current data, once loaded.
+
+    Returns:
+        int: number of tiles written, 0 if they already exist
+    """
+    with reader_engine.connect() as conn:
+        generation = catalog_generation(conn)
+        catalog = StationCatalog.from_database(conn, generation)
+        prices = CatalogPrices.from_database(conn, catalog)
+    return station_tiles.build(prices, generation)
+
+
+def update_viewport(state, bounds):
+    """
+    Move the stations of a map to the tiles covering its bounds.
+
+    The tiles are read from the tile cache, see tiles.py, and built if the
+    data changed without an ETL run of this process.
+
+    Args:
+        state (viewport.ViewportState): stations of the map
+        bounds: dict, bounds of the map as returned by st_folium
+
+    Returns:
+        tuple: sets of the ids of the stations entering and leaving the map
     """
     # bounds_example = {
     #   "_southWest": {
@@ -749,49 +1196,109 @@ def bounding_stations(bounds):
     #     "lng": -0.6320571899414062
     #   }
     # }
-    lat_min = bounds["_southWest"]["lat"] * 100000
-    lat_max = bounds["_northEast"]["lat"] * 100000
-    lon_min = bounds["_southWest"]["lng"] * 100000
-    lon_max = bounds["_northEast"]["lng"] * 100000
-    nearby_states = (
-        db_session.query(Station)
-        .filter(
-            Station.latitude > lat_min,
-            Station.latitude < lat_max,
-            Station.longitude > lon_min,
-            Station.longitude < lon_max,
+    generation = current_generation()
+    if not station_tiles.has(generation):
+        station_tiles.build(load_catalog_prices(generation), generation)
+    tiles = tiles_in_bounds(
+        bounds["_southWest"]["lat"],
+        bounds["_northEast"]["lat"],
+        bounds["_southWest"]["lng"],
+        bounds["_northEast"]["lng"],
+    )
+    return state.update(
+        generation, tiles, functools.partial(station_tiles.features, generation)
+    )
+
+
+# users whose prices are held in memory
+PRICES_USER_CACHE_ENTRIES = 1000
+# version of the followed stations and gas types of each user, bumped on edit
+prices_user_versions = {}
+
+
+def query_prices_user(conn, user_name):
+    """
+    Prices of the followed gas types at the followed stations of a user.
+
+    A single query joins the custom stations of the user to their prices,
+    filtered by the followed gas types.
+
+    Args:
+        conn: sqlalchemy connection
+        user_name (str): username of the user
+
+    Returns:
+        pd.DataFrame: with Name, Type, Price and Updated_at columns
+    """
+    query = (
+        sqlalchemy.select(
+            CustomStation.custom_name,
+            GasType.name,
+            Price.price,
+            Price.updated_at,
         )
-        .all()
+        .select_from(User)
+        .join(CustomStation, CustomStation.user_id == User.id)
+        .join(association_table, association_table.c.user_id == User.id)
+        .join(GasType, GasType.id == association_table.c.gastype_id)
+        # the prices reference the gas types by their id in the feed
+        .join(
+            Price,
+            (Price.station_id == CustomStation.id)
+            & (
+                Price.gastype_id
+                == sqlalchemy.cast(GasType.xml_id, sqlalchemy.Integer)
+            ),
+        )
+        .where(User.username == user_name)
+        .order_by(CustomStation.id, Price.gastype_id)
+    )
+    return pd.DataFrame(
+        conn.execute(query).all(),
+        columns=["Name", "Type", "Price", "Updated_at"],
     )
-    return nearby_states
 
 
-def get_prices_user(user_name):
-    user = db_session.query(User).filter_by(username=user_name).first()
-    # get custom stations
-    data = {"Name": [], "Type": [], "Price": [], "Updated_at": []}
-    gastypes_followed_id = [gastype.xml_id for gastype in user.gastypes]
-    for custom_station in user.stations:
-        # get prices for each custom station
-        prices = (
-            db_session.query(Price)
-            .filter_by(station_id=custom_station.id)
-            .all()
+@st.cache_data(max_entries=PRICES_USER_CACHE_ENTRIES)
+def load_prices_user(user_name, generation, version):
+    """
+    Prices of the followed stations of a user, shared by their sessions.
+
+    Args:
+        user_name (str): username of the user
+        generation: key of the version of the prices, they are loaded again
+            when an ETL run finishes
+        version (int): version of the followed stations and gas types of the
+            user, see invalidate_prices_user
+
+    Returns:
+        pd.DataFrame
+    """
+    with reader_engine.connect() as conn:
+        return query_prices_user(conn, user_name)
+
+
+def invalidate_prices_user(user_name=None):
+    """
+    Load again the prices of a user, after editing their stations or gas types.
+
+    Args:
+        user_name (str): username of the user, all the users if None
+    """
+    if user_name is None:
+        load_prices_user.clear()
+    else:
+        prices_user_versions[user_name] = (
+            prices_user_versions.get(user_name, 0) + 1
         )
-        for price in prices:
-            if str(price.gastype_id) in gastypes_followed_id:
-                gas_type = (
-                    db_session.query(GasType)
-                    .filter_by(xml_id=price.gastype_id)
-                    .first()
-                )
-                data["Name"].append(custom_station.custom_name)
-                data["Type"].append(gas_type.name)
-                # round the price at 2 decimals
-                data["Price"].append(price.price)
-                data["Updated_at"].append(price.updated_at)
-    columns = ["Name", "Type", "Price", "Updated_at"]
-    df = pd.DataFrame(data, columns=columns)
+
+
+def get_prices_user(user_name):
+    df = load_prices_user(
+        user_name,
+        current_generation(),
+        prices_user_versions.get(user_name, 0),
+    )
     column_config = {
         col: st.column_config.Column(disabled=True) for col in ["Name", "Type"]
     }
@@ -828,21 +1335,21 @@ def get_prices_demo(followed_stations_list, followed_gastypes_list):
         # get prices for each custom station
         custom_station_id = int(custom_station["id"])
         prices = (
-            db_session.query(Price)
+            reader_session.query(Price)
             .filter_by(station_id=custom_station_id)
             .all()
         )
         followed_gastypes_id_list = []
         for gas_name in followed_gastypes_list:
             gas_type = (
-                db_session.query(GasType).filter_by(name=gas_name).first()
+                reader_session.query(GasType).filter_by(name=gas_name).first()
             )
             if gas_type:
                 followed_gastypes_id_list.append(int(gas_type.xml_id))
         for price in prices:
             if price.gastype_id in followed_gastypes_id_list:
                 gas_type = (
-                    db_session.query(GasType)
+                    reader_session.query(GasType)
                     .filter_by(xml_id=price.gastype_id)
                     .first()
                 )
@@ -865,6 +1372,7 @@ def get_prices_demo(followed_stations_list, followed_gastypes_list):
     )
     # apply a style to highlight the min price
     # data=df.style.highlight_min(subset=["Price"], color="red"),
+    reader_session.close()
     # order the df by the lowest price
     df = df.sort_values(by=["Price"], ascending=True)
     st.dataframe(
@@ -943,23 +1451,100 @@ class Job(threading.Thread):
             self.execute(*self.args, **self.kwargs)
 
 
-def main_etl():
+def main_etl(
+    parser=DEFAULT_PARSER,
+    batch_size=DEFAULT_BATCH_SIZE,
+    incremental=True,
+    queue_size=QUEUE_SIZE,
+    workers=DEFAULT_WORKERS,
+    history_store=DEFAULT_HISTORY_STORE,
+    shadow=False,
+):
+    """
+    Fetch the feed and load it into the database.
+
+    Download, parsing and writes run as concurrent stages, see pipeline.py.
+    The run and its metrics are recorded in the etl_runs table, see
+    telemetry.py.
+
+    Args:
+        parser (str): name of the parser backend, see parsers.PARSER_BACKENDS
+        batch_size (int): number of stations written per transaction
+        incremental (bool): write only new prices and changed stations
+        queue_size (int): number of items held by each queue of the pipeline
+        workers (int): number of processes parsing the feed in parallel
+        history_store (str): one of history.HISTORY_STORES keys, receiving
+            the prices that changed
+        shadow (bool): load a copy of the database and swap it in once
+            loaded, so that the pages never wait for the ETL, see shadow.py
+    """
     print("Running ETL job at ", datetime.now())
     # print the process pid
     print("Process ID: ", os.getpid())
     with open("lastjob.txt", "w") as file:
         file.write(str(datetime.now()))
-    loadXML()
-    dump_stations()
-
-
-def etl_job():
+    try:
+        with EtlRunRecorder(engine) as run, loadXML() as feed:
+            if feed is None:
+                print("Feed did not change since last run, skipping")
+                run.skip()
+            else:
+                with ExitStack() as stack:
+                    history = stack.enter_context(
+                        open_history_store(history_store)
+                    )
+                    target = (
+                        stack.enter_context(shadow_database())
+                        if shadow
+                        else engine
+                    )
+                    stats = run_pipeline(
+                        feed,
+                        target,
+                        parser=parser,
+                        batch_size=batch_size,
+                        incremental=incremental,
+                        queue_size=queue_size,
+                        workers=workers,
+                        history=history,
+                        on_start=run.watch,
+                    )
+                run.finish(stats)
+                print(format_stats(stats))
+                print(format_pipeline_stats(stats))
+        if run.status == "success":
+            # once the run is recorded, as it changes the generation
+            print(f"Station tiles written: {build_station_tiles()}")
+    except RequestException as http_err:
+        print(f"HTTP error occurred: {http_err}")
+    else:
+        print("Success!")
+
+
+def etl_job(
+    parser=DEFAULT_PARSER,
+    batch_size=DEFAULT_BATCH_SIZE,
+    incremental=True,
+    queue_size=QUEUE_SIZE,
+    workers=DEFAULT_WORKERS,
+    history_store=DEFAULT_HISTORY_STORE,
+    shadow=False,
+):
     # check if status file exists
     if not os.path.exists("pid.txt"):
         with open("pid.txt", "w") as file:
             file.write(str(os.getpid()))
         # start etl at beginning of the thread
-        main_etl()
+        etl_kwargs = {
+            "parser": parser,
+            "batch_size": batch_size,
+            "incremental": incremental,
+            "queue_size": queue_size,
+            "workers": workers,
+            "history_store": history_store,
+            "shadow": shadow,
+        }
+        main_etl(**etl_kwargs)
         # check if the test user has custom stations, if not restore the database
         user = db_session.query(User).filter_by(username="test").first()
         if len(user.stations) == 0:
@@ -967,7 +1552,7 @@ def etl_job():
             restore_database()
         signal.signal(signal.SIGTERM, signal_handler)
         signal.signal(signal.SIGINT, signal_handler)
-        job = Timer(WAIT_TIME_SECONDS, main_etl)
+        job = Timer(WAIT_TIME_SECONDS, main_etl, kwargs=etl_kwargs)
         job_save = Timer(WAIT_TIME_SECONDS_SAVE, save_database)
         job_save.start()
         job.start()
@@ -992,9 +1577,103 @@ if __name__ == "__main__":
     # parse kwargs from script
     parser = argparse.ArgumentParser()
     parser.add_argument("--action")
+    parser.add_argument(
+        "--parser",
+        default=DEFAULT_PARSER,
+        choices=list(PARSER_BACKENDS),
+        help="XML parser backend used to stream the feed",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="number of stations written per transaction",
+    )
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="write every station and price, even the unchanged ones",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=QUEUE_SIZE,
+        help="number of items held by each queue of the ETL pipeline",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help="number of processes parsing the feed, 0 to parse in the ETL "
+        "process",
+    )
+    parser.add_argument(
+        "--year", type=int, help="year of the archive to backfill"
+    )
+    parser.add_argument(
+        "--day", help="day of the archive to backfill, as YYYYMMDD"
+    )
+    parser.add_argument(
+        "--file", help="local archive to backfill instead of downloading it"
+    )
+    parser.add_argument(
+        "--history-store",
+        default=DEFAULT_HISTORY_STORE,
+        choices=list(HISTORY_STORES),
+        help="store of the price history",
+    )
+    parser.add_argument(
+        "--corpus", default=CORPUS_DIR, help="directory of the replay corpus"
+    )
+    parser.add_argument(
+        "--archives",
+        nargs="+",
+        help="hashes of the recorded archives to replay, default to all",
+    )
+    parser.add_argument(
+        "--database", help="database of the replay, default to a new one"
+    )
+    parser.add_argument("--output", help="JSON report of the replay")
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="load a copy of the database and swap it in once loaded",
+    )
     args = parser.parse_args()
     if args.action == "etl":
-        etl_job()
+        etl_job(
+            parser=args.parser,
+            batch_size=args.batch_size,
+            incremental=not args.full_refresh,
+            queue_size=args.queue_size,
+            workers=args.workers,
+            history_store=args.history_store,
+            shadow=args.shadow,
+        )
+    elif args.action == "backfill":
+        if args.year is None and args.day is None and args.file is None:
+            print("Error : --year, --day or --file is required. Exiting...")
+            exit(1)
+        backfill_history(
+            year=args.year,
+            day=args.day,
+            file=args.file,
+            parser=args.parser,
+            workers=args.workers,
+            history_store=args.history_store,
+        )
+    elif args.action == "record":
+        record_feed(args.corpus)
+    elif args.action == "replay":
+        replay_corpus(
+            args.corpus,
+            archives=args.archives,
+            database=args.database,
+            parser=args.parser,
+            workers=args.workers,
+            incremental=not args.full_refresh,
+            output=args.output,
+        )
     elif args.action == "save":
         save_database()
     elif args.action == "restore":
@@ -1002,8 +1681,20 @@ if __name__ == "__main__":
     elif args.action == "create_gastypes":
         create_gastypes()
     elif args.action == "dump_stations":
-        loadXML()
-        dump_stations()
+        # always ingest the feed, even when it did not change
+        with (
+            open_feed() as response,
+            open_history_store(args.history_store) as history,
+        ):
+            dump_stations(
+                response.stream,
+                parser=args.parser,
+                batch_size=args.batch_size,
+                incremental=not args.full_refresh,
+                workers=args.workers,
+                history=history,
+                shadow=args.shadow,
+            )
     else:
         print(
             f"Error : Bad action specified, {args.action} unknown. Exiting..."
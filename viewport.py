@@ -0,0 +1,99 @@
+"""Stations shown by the map of a session, kept in sync with its viewport.
+
+The map of a page shows the stations of the tiles covering its viewport,
+see tiles.py. When the user pans, ``ViewportState.update`` compares the set
+of tiles of the new viewport to the previous one: only the stations of the
+tiles entering the viewport are added, and only those of the tiles leaving
+it are removed, in time linear in the number of changed stations. The ids
+of the followed stations are held in a set, for constant time lookups while
+drawing the markers.
+"""
+
+
+class ViewportState:
+    """
+    Stations of the viewport of a map, by tile and by id.
+
+    Args:
+        followed (iterable): ids of the followed stations
+    """
+
+    def __init__(self, followed=()):
+        self.generation = None
+        self.tiles = {}
+        self.stations = {}
+        self.followed = frozenset(followed)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def follow(self, followed):
+        """
+        Replace the ids of the followed stations.
+
+        Args:
+            followed (iterable): ids of the followed stations
+        """
+        self.followed = frozenset(followed)
+
+    def is_followed(self, station_id):
+        """
+        Whether a station is followed.
+
+        Args:
+            station_id (int): id of the station
+
+        Returns:
+            bool
+        """
+        return station_id in self.followed
+
+    def update(self, generation, tiles, load_tile):
+        """
+        Move the viewport to other tiles.
+
+        Args:
+            generation: key of the version of the stations, all the tiles
+                are loaded again when it changes
+            tiles (iterable): x and y of the tiles of the viewport
+            load_tile (callable): features of a tile, given its x and y
+
+        Returns:
+            tuple: sets of the ids of the stations entering and leaving the
+                viewport
+        """
+        if generation != self.generation:
+            self.clear()
+            self.generation = generation
+        tiles = set(tiles)
+        current = self.tiles.keys()
+        leaving = set()
+        for tile in current - tiles:
+            for station_id in self.tiles.pop(tile):
+                self.stations.pop(station_id, None)
+                leaving.add(station_id)
+        entering = set()
+        for tile in tiles - current:
+            features = load_tile(*tile)
+            ids = []
+            for feature in features:
+                station_id = feature["properties"]["id"]
+                self.stations[station_id] = feature
+                ids.append(station_id)
+            self.tiles[tile] = ids
+            entering.update(ids)
+        return entering, leaving
+
+    def clear(self):
+        """Remove all the stations, when the map shows clusters."""
+        self.tiles = {}
+        self.stations = {}
+
+    def features(self):
+        """
+        Features of the stations of the viewport.
+
+        Returns:
+            list of dict: GeoJSON features
+        """
+        return list(self.stations.values())